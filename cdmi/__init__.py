@@ -33,6 +33,23 @@ def filter_factory(global_conf, **local_conf):
     conf['cdmi_root_length'] = len(cdmi_root.split('/'))
     conf.setdefault('cdmi_version_supported', '1.0.1')
     conf.setdefault('cdmi_capability_id', 'cdmi_capabilities')
+    # Resource checks are sent to the downstream app as subrequests by
+    # default, set it to socket to send them over a new connection instead
+    conf.setdefault('cdmi_probe_mode', 'subrequest')
+    conf.setdefault('cdmi_pool_max_idle', '10')
+    conf.setdefault('cdmi_pool_idle_timeout', '60')
+    conf.setdefault('cdmi_pool_max_size', '100')
+    conf.setdefault('cdmi_pool_timeout', '60')
+    conf.setdefault('cdmi_type_cache_size', '10000')
+    conf.setdefault('cdmi_type_cache_ttl', '10')
+    conf.setdefault('cdmi_type_cache_negative_ttl', '2')
+    conf.setdefault('cdmi_type_cache_backend', 'memcache')
+    conf.setdefault('cdmi_hierarchy_index_size', '0')
+    conf.setdefault('cdmi_hierarchy_index_entries', '10000')
+    conf.setdefault('cdmi_hierarchy_index_max_age', '30')
+    conf.setdefault('cdmi_listing_checkpoints', '1000')
+    conf.setdefault('cdmi_path_cache_size', '1024')
+    conf.setdefault('cdmi_multipart_encoding', 'binary')
 
     def cdmi_filter(app):
         return CdmiMiddleware(app, conf)
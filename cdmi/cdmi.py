@@ -29,17 +29,23 @@ in front of the proxy-server middleware.
 """
 
 from cdmiapp.cdmibase import \
-    (Consts, concat_parts, ErrorController, AccountController)
+    (Consts, ErrorController, RequestContext)
 from cdmiapp.cdmibase import CapabilityController, LoginController
 from cdmiapp.cdmicontrollers import \
-    (ContainerController, ObjectController)
+    (AccountController, ContainerController, ObjectController)
 from cdmiapp.cdmicommoncontroller import \
     CDMICommonController
 from cdmiapp.noncdmicontrollers import \
     (NonCDMIContainerController, NonCDMIObjectController)
-from cdmiapp.cdmiutils import get_err_response
+from cdmiapp.cdmiutils import get_err_response, get_auth_token
+from cdmiapp.cdmipool import ConnectionPool
+from cdmiapp.cdmicache import \
+    (ResourceTypeCache, MemcacheResourceTypeCache, RequestTypeCache,
+     HierarchyIndex, ListingCheckpoints)
 from webob import Request, Response
 from urllib import unquote
+from collections import OrderedDict
+from itertools import product
 from swift.common.utils import get_logger
 from swift.common.utils import split_path
 
@@ -55,6 +61,48 @@ class CdmiMiddleware(object):
         self.cdmi_root_length = conf.get('cdmi_root_length')
         self.cdmi_capability_id = conf.get('cdmi_capability_id')
         self.logger = get_logger(conf, log_route='cdmi')
+        self.cdmi_prefix = '/' + self.cdmi_root
+        self.controllers = self.create_controllers()
+        self.routes = self.compile_routes()
+        self.path_cache_size = int(conf.get('cdmi_path_cache_size', 1024))
+        self.path_cache = OrderedDict()
+        self.conn_pool = ConnectionPool(
+            int(conf.get('cdmi_pool_max_idle', 10)),
+            float(conf.get('cdmi_pool_idle_timeout', 60)),
+            int(conf.get('cdmi_pool_max_size', 100)),
+            float(conf.get('cdmi_pool_timeout', 60)))
+        self.type_cache = ResourceTypeCache(
+            int(conf.get('cdmi_type_cache_size', 10000)),
+            float(conf.get('cdmi_type_cache_ttl', 10)),
+            float(conf.get('cdmi_type_cache_negative_ttl', 2)))
+        if conf.get('cdmi_type_cache_backend', 'memcache') == 'memcache':
+            self.shared_type_cache = MemcacheResourceTypeCache(
+                None, float(conf.get('cdmi_type_cache_ttl', 10)),
+                float(conf.get('cdmi_type_cache_negative_ttl', 2)))
+        else:
+            self.shared_type_cache = None
+        # The hierarchy index is kept only when it is given a size
+        if int(conf.get('cdmi_hierarchy_index_size', 0)) > 0:
+            self.hierarchy_index = HierarchyIndex(
+                int(conf.get('cdmi_hierarchy_index_size', 0)),
+                int(conf.get('cdmi_hierarchy_index_entries', 10000)),
+                float(conf.get('cdmi_hierarchy_index_max_age', 30)))
+        else:
+            self.hierarchy_index = None
+        self.listing_checkpoints = ListingCheckpoints(
+            int(conf.get('cdmi_listing_checkpoints', 1000)),
+            float(conf.get('cdmi_type_cache_ttl', 10)))
+
+    def get_type_cache(self, env):
+        """
+        Returns the resource type cache to use for a request, the one shared
+        through the Swift memcache when configured and available, the cache
+        of this process otherwise, wrapped for the request.
+        """
+        memcache = env.get('swift.cache')
+        if self.shared_type_cache is not None and memcache is not None:
+            return RequestTypeCache(self.shared_type_cache, memcache)
+        return RequestTypeCache(self.type_cache)
 
     def get_container_controller_by_version(self, version):
         if version == '1.0.1':
@@ -70,26 +118,105 @@ class CdmiMiddleware(object):
         # different controller
         return None
 
-    def get_controller(self, env, path, cdmi_version, method):
-        if path.startswith('/' + self.cdmi_root):
-            content_type = (env.get('CONTENT_TYPE') or '').lower()
-            accept = (env.get('HTTP_ACCEPT') or '').lower()
-
-            content_is_container = \
-                content_type.find('application/cdmi-container') >= 0 or False
-
-            content_is_object = (content_type.find('multipart/') >= 0 or
-                content_type.find('application/cdmi-object') >= 0 or False)
-
-            accept_is_container = \
-                accept.find('application/cdmi-container') >= 0 or False
-
-            accept_is_object = (accept.find('multipart/') >= 0 or
-                accept.find('application/cdmi-object') >= 0 or False)
-
-            content_length = int(env.get('CONTENT_LENGTH') or '0')
-
-            subs = path.lstrip('/ ').rstrip('/ ').split('/')
+    def select_controller(self, method, is_capability_request, shape,
+                          cdmi_version, content_is_container,
+                          accept_is_container, accept_is_object,
+                          trailing_slash):
+        """
+        Returns the controller for a request and whether the request wants
+        a container. The shape of the path is 'login' without an account,
+        'account' without a container and 'entity' otherwise.
+        """
+        if method in ['GET']:
+            if is_capability_request:
+                return CapabilityController, False
+            elif shape == 'login':
+                return LoginController, False
+            elif shape == 'account':
+                return AccountController, False
+            else:
+                # To setup a flag so that we know what the request wants
+                return CDMICommonController, (content_is_container or
+                                              accept_is_container or
+                                              trailing_slash)
+        elif method in ['PUT']:
+            if shape != 'login':
+                if cdmi_version:
+                    # Ensure that accept headers indicate what the client
+                    # want to do, header overwrite trailing slash
+                    # Only when no headers, the trailing slash plays
+                    # an important role.
+                    if (accept_is_container or
+                        (trailing_slash and not accept_is_object)):
+                        return ContainerController, False
+                    elif (accept_is_object or not trailing_slash):
+                        return ObjectController, False
+                    else:
+                        return ErrorController, False
+                else:
+                    if trailing_slash:
+                        return NonCDMIContainerController, False
+                    else:
+                        return NonCDMIObjectController, False
+            else:
+                return ErrorController, False
+        elif method in ['HEAD']:
+            if is_capability_request or shape != 'entity':
+                return ErrorController, False
+            else:
+                return CDMICommonController, (content_is_container or
+                                              accept_is_container or
+                                              trailing_slash)
+        elif method in ['DELETE']:
+            if shape == 'login':
+                return ErrorController, False
+            else:
+                return CDMICommonController, False
+        else:
+            return ErrorController, False
+
+    def create_controllers(self):
+        """
+        Create the controllers, each controller is created once and shared
+        by all requests.
+        """
+        controllers = {}
+        for controller in [ErrorController, CapabilityController,
+                           LoginController, AccountController,
+                           CDMICommonController, ContainerController,
+                           ObjectController, NonCDMIContainerController,
+                           NonCDMIObjectController]:
+            controllers[controller] = controller(self.conf, self.app,
+                                                 self.logger)
+        return controllers
+
+    def compile_routes(self):
+        """
+        Build the dispatch table giving the controller of every
+        combination of method, path shape and request flags, so that
+        routing a request is a single lookup.
+        """
+        routes = {}
+        flags = [False, True]
+        for method in ['GET', 'PUT', 'DELETE', 'HEAD', None]:
+            for shape in ['login', 'account', 'entity']:
+                for key in product(flags, flags, flags, flags, flags, flags):
+                    controller, wants_container = \
+                        self.select_controller(method, key[0], shape,
+                                               *key[1:])
+                    routes[(method, key[0], shape) + key[1:]] = \
+                        (self.controllers[controller], wants_container)
+        return routes
+
+    def parse_path(self, path):
+        """
+        Split a CDMI path into account name, container name, parent name,
+        object name and whether it is a capability path. Parsed paths are
+        kept in a bounded LRU cache.
+        """
+        parts = self.path_cache.pop(path, None)
+        if parts is None:
+            subs = path.strip('/ ').split('/')
 
             # We first get rid of the cdmi_root which is no important
             # for rest of the work
@@ -102,92 +229,78 @@ class CdmiMiddleware(object):
             else:
                 is_capability_request = False
 
-            if accept.find('application/cdmi-capability') >= 0:
-                is_capability_request = True
-
-            account_name = subs[0]
-            container_name = subs[1]
-            parent_name = concat_parts(*subs[2:])
-            if parent_name == '':
+            names = [sub for sub in subs[2:] if sub]
+            if names:
+                object_name = names[-1]
+                parent_name = '/'.join(names[:-1])
+            else:
                 parent_name = None
                 object_name = None
+            parts = (subs[0], subs[1], parent_name, object_name,
+                     is_capability_request)
+        if self.path_cache_size > 0:
+            self.path_cache[path] = parts
+            while len(self.path_cache) > self.path_cache_size:
+                self.path_cache.popitem(last=False)
+        return parts
+
+    def get_controller(self, env, path, cdmi_version, method):
+        if path.startswith(self.cdmi_prefix):
+            content_type = (env.get('CONTENT_TYPE') or '').lower()
+            accept = (env.get('HTTP_ACCEPT') or '').lower()
+            # A malformed content length makes the request invalid
+            int(env.get('CONTENT_LENGTH') or '0')
+
+            account_name, container_name, parent_name, object_name, \
+                is_capability_request = self.parse_path(path)
+
+            if 'application/cdmi-capability' in accept:
+                is_capability_request = True
+
+            if account_name is None:
+                shape = 'login'
+            elif container_name is None:
+                shape = 'account'
             else:
-                newsubs = parent_name.split('/')
-                object_name = newsubs[-1]
-                parent_name = '/'.join(newsubs[0:-1])
-
-            if method in ['GET']:
-                if is_capability_request:
-                    controller = CapabilityController
-                elif account_name is None:
-                    controller = LoginController
-                elif container_name is None:
-                    controller = AccountController
-                else:
-                    controller = CDMICommonController
-                    # To setup a flag so that we know what the request wants
-                    if (content_is_container or accept_is_container or
-                        path.endswith('/')):
-                        env['X-WANTS-CONTAINER'] = 'True'
-                d = dict(container_name=container_name,
-                         parent_name=parent_name,
-                         object_name=object_name)
-                return account_name, controller, d
-            elif method in ['PUT']:
-                if account_name:
-                    if cdmi_version:
-                        # Ensure that accept headers indicate what the client
-                        # want to do, header overwrite trailing slash
-                        # Only when no headers, the trailing slash plays
-                        # an important role.
-                        if (accept_is_container or
-                            (path.endswith('/') and not accept_is_object)):
-                            controller = ContainerController
-                        elif (accept_is_object or not path.endswith('/')):
-                            controller = ObjectController
-                        else:
-                            controller = ErrorController
-                    else:
-                        if path.endswith('/'):
-                            controller = NonCDMIContainerController
-                        else:
-                            controller = NonCDMIObjectController
-                else:
-                    controller = ErrorController
-                d = dict(container_name=container_name,
-                         parent_name=parent_name,
-                         object_name=object_name)
-                return account_name, controller, d
-            elif method in ['DELETE']:
-                if account_name is None:
-                    controller = ErrorController
-                else:
-                    controller = CDMICommonController
-                d = dict(container_name=container_name,
-                         parent_name=parent_name,
-                         object_name=object_name)
-                return account_name, controller, d
-            else:
-                controller = ErrorController
-                d = dict(container_name=container_name,
-                         parent_name=parent_name,
-                         object_name=object_name)
-                return account_name, controller, d
+                shape = 'entity'
+
+            if method not in ('GET', 'PUT', 'DELETE', 'HEAD'):
+                method = None
+            controller, wants_container = self.routes[(
+                method, is_capability_request, shape, bool(cdmi_version),
+                'application/cdmi-container' in content_type,
+                'application/cdmi-container' in accept,
+                ('multipart/' in accept or
+                 'application/cdmi-object' in accept),
+                path.endswith('/'))]
+            d = dict(container_name=container_name,
+                     parent_name=parent_name,
+                     object_name=object_name,
+                     wants_container=wants_container)
+            return account_name, controller, d
         else:
             d = dict(container_name=None, object_name=None)
             return None, None, d
 
     def __call__(self, env, start_response):
 
-        path = unquote(env.get('PATH_INFO', ''))
+        path = env.get('PATH_INFO', '')
         cdmi_version = env.get('HTTP_X_CDMI_SPECIFICATION_VERSION', False)
-        method = env.get('REQUEST_METHOD').upper()
 
         # All CDMI requests have to have header with
         # the X-CDMI-Specification-Version
         if cdmi_version and self.cdmi_version_supported.find(cdmi_version) < 0:
             return get_err_response('VersionNotSupported')(env, start_response)
 
+        # Requests outside of the cdmi root go straight to the next app,
+        # only a path quoting part of the root has to be unquoted first.
+        if (not path.startswith(self.cdmi_prefix) and
+            '%' not in path[:3 * len(self.cdmi_prefix)]):
+            return self.app(env, start_response)
+
+        path = unquote(path)
+        method = env.get('REQUEST_METHOD').upper()
+
         # All non-CDMI request should not have the header
         # We use this header as the identifier to identify CDMI request.
         try:
@@ -197,10 +310,26 @@ class CdmiMiddleware(object):
             return get_err_response('InvalidURI')(env, start_response)
 
         if controller is not None:
-            controller = controller(env, self.conf, self.app,
-                                    self.logger, account, **path_parts)
+            env['cdmi.conn_pool'] = self.conn_pool
+            env['cdmi.type_cache'] = self.get_type_cache(env)
+            env['cdmi.hierarchy_index'] = self.hierarchy_index
+            env['cdmi.listing_checkpoints'] = self.listing_checkpoints
+            ctx = RequestContext(env, account,
+                                 auth_token=get_auth_token(env),
+                                 **path_parts)
+            env['cdmi.context'] = ctx
+            controller.setup_request(env, ctx)
             if hasattr(controller, method) and not method.startswith('_'):
                 res = getattr(controller, method)(env, start_response)
+                probe_cache = env.get('cdmi.probe_cache')
+                if probe_cache is not None:
+                    self.logger.debug('CDMI %s %s: %d resource checks, %d '
+                                      'duplicates avoided, type cache %s, '
+                                      'connection pool %s' %
+                                      (method, path, probe_cache.lookups,
+                                       probe_cache.hits,
+                                       env['cdmi.type_cache'].stats(),
+                                       self.conn_pool.stats()))
                 return res(env, start_response)
             else:
                 return get_err_response('BadRequest')(env, start_response)
@@ -222,6 +351,23 @@ def filter_factory(global_conf, **local_conf):
     conf['cdmi_root_length'] = len(cdmi_root.split('/'))
     conf.setdefault('cdmi_version_supported', '1.0.1')
     conf.setdefault('cdmi_capability_id', 'cdmi_capabilities')
+    # Resource checks are sent to the downstream app as subrequests by
+    # default, set it to socket to send them over a new connection instead
+    conf.setdefault('cdmi_probe_mode', 'subrequest')
+    conf.setdefault('cdmi_pool_max_idle', '10')
+    conf.setdefault('cdmi_pool_idle_timeout', '60')
+    conf.setdefault('cdmi_pool_max_size', '100')
+    conf.setdefault('cdmi_pool_timeout', '60')
+    conf.setdefault('cdmi_type_cache_size', '10000')
+    conf.setdefault('cdmi_type_cache_ttl', '10')
+    conf.setdefault('cdmi_type_cache_negative_ttl', '2')
+    conf.setdefault('cdmi_type_cache_backend', 'memcache')
+    conf.setdefault('cdmi_hierarchy_index_size', '0')
+    conf.setdefault('cdmi_hierarchy_index_entries', '10000')
+    conf.setdefault('cdmi_hierarchy_index_max_age', '30')
+    conf.setdefault('cdmi_listing_checkpoints', '1000')
+    conf.setdefault('cdmi_path_cache_size', '1024')
+    conf.setdefault('cdmi_multipart_encoding', 'binary')
 
     def cdmi_filter(app):
         return CdmiMiddleware(app, conf)
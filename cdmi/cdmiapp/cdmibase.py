@@ -14,7 +14,8 @@
 # limitations under the License.
 
 from webob import Request, Response
-from swift.common.bufferedhttp import http_connect_raw
+from cdmipool import get_conn_pool
+from hashlib import md5
 import json
 
 
@@ -42,51 +43,121 @@ class Consts(object):
     VALUE_ENCODING = 'x-object-meta-valuetransferencoding'
     ENCODING_BASE64 = 'base64'
     MULTIPART_TYPE = 'multipart/mixed'
+    # Types of the resources a path within a container can point to
+    RESOURCE_OBJECT = 'object'
+    RESOURCE_DIRECTORY = 'directory'
+    RESOURCE_VIRTUAL = 'virtual'
+    RESOURCE_MISSING = 'missing'
+    RESOURCE_NO_CONTAINER = 'nocontainer'
+    # Completion status of a listing which failed once under way
+    LISTING_INCOMPLETE = 'Error: the listing of the children is incomplete'
+
+
+class RequestContext(object):
+    """
+    What the controllers need to know about a request, parsed once when the
+    request comes in and kept in the env as cdmi.context.
+    """
+    __slots__ = ('account_name', 'container_name', 'parent_name',
+                 'object_name', 'metadata_prefix', 'wants_container',
+                 'cdmi_version', 'content_type', 'accept', 'range',
+                 'auth_token', 'fields', 'request')
+
+    def __init__(self, env, account_name, container_name=None,
+                 parent_name=None, object_name=None, wants_container=False,
+                 auth_token=None):
+        self.account_name = account_name
+        self.container_name = container_name
+        self.parent_name = parent_name
+        self.object_name = object_name
+        self.metadata_prefix = None
+        self.wants_container = wants_container
+        self.cdmi_version = env.get('HTTP_X_CDMI_SPECIFICATION_VERSION',
+                                    False)
+        self.content_type = (env.get('CONTENT_TYPE') or '').lower()
+        self.accept = (env.get('HTTP_ACCEPT') or '').lower()
+        self.range = env.get('HTTP_RANGE')
+        self.auth_token = auth_token
+        # The fields a read asks for, set once the query string is parsed
+        self.fields = None
+        # The request reads and writes the env, so it stays up to date
+        # when the env is changed while the request is handled.
+        self.request = Request(env)
 
 
 class Controller(object):
     def __init__(self, conf, app, logger):
         self.app = app
         self.conf = conf
-        self.response_args = []
         self.logger = logger
         self.cdmi_root = conf.get('cdmi_root')
         self.cdmi_version_supported = conf.get('cdmi_version_supported')
         self.cdmi_capability_id = conf.get('cdmi_capability_id')
+        # Resource checks are either dispatched into the downstream app
+        # as subrequests or sent over a new connection to the proxy.
+        if conf.get('cdmi_probe_mode', 'subrequest') == 'subrequest':
+            self.probe_app = app
+        else:
+            self.probe_app = None
+        # Multipart reads carry the raw value unless told to encode it
+        self.multipart_base64 = (conf.get('cdmi_multipart_encoding',
+                                          'binary').lower() == 'base64')
 
-    def do_start_response(self, *args):
-        self.response_args.extend(args)
+    def setup_request(self, env, ctx):
+        """
+        Controllers are shared by all requests and keep no state for a
+        request, whatever a request needs is kept in its context. This
+        method prepares the env before the request is handled.
+        """
+        pass
+
+    def _check_not_modified(self, env, res, etag, last_modified=None):
+        """
+        Set the validators of a read response and make it vary on the
+        headers which choose its representation. The etag is made from the
+        given parts. When the conditions of the request show that the client
+        already has the entity, the response becomes a 304 without body and
+        True is returned, so the entity itself does not need to be read.
+        """
+        req = env['cdmi.context'].request
+        res.vary = ('Accept', Consts.CDMI_VERSION)
+        res.etag = md5(':'.join([str(part) for part in etag])).hexdigest()
+        if last_modified:
+            res.last_modified = last_modified
+        # If-Modified-Since is only looked at without If-None-Match
+        if 'HTTP_IF_NONE_MATCH' in env:
+            not_modified = res.etag in req.if_none_match
+        elif req.if_modified_since and res.last_modified:
+            not_modified = res.last_modified <= req.if_modified_since
+        else:
+            not_modified = False
+        if not_modified:
+            res.status_int = 304
+            res.app_iter = []
+        return not_modified
 
 
 class ErrorController(Controller):
     """
     Error controller, handles cdmi path error requests
     """
-    def __init__(self, env, conf, app, logger, account_name, **kwargs):
-        Controller.__init__(self, conf, app, logger)
 
 
 class CapabilityController(Controller):
     """
     Capability controller to handles cdmi capability request
     """
-    def __init__(self, env, conf, app, logger, account_name, container_name,
-                 parent_name, object_name, **kwargs):
-        Controller.__init__(self, conf, app, logger)
-        self.account_name = account_name
-        self.container_name = container_name
-        self.object_name = object_name
-        self.parent_name = parent_name
 
     # Use GET to handle all cdmi log in attempt and respond with X-Storage-Url
     def GET(self, env, start_response):
         """
         Handle for GET method
         """
+        ctx = env['cdmi.context']
         res = Response()
 
         # System wide capability request
-        if self.container_name is None or self.container_name == '':
+        if ctx.container_name is None or ctx.container_name == '':
             #this is a system capability request.
             res.status = 200
             res.headers['Content-Type'] = Consts.CDMI_APP_CAPABILITY
@@ -94,7 +165,7 @@ class CapabilityController(Controller):
 
             body = {}
             body['parentURI'] = '/'.join(['', self.cdmi_root,
-                                          self.account_name, ''])
+                                          ctx.account_name, ''])
             body['objectName'] = 'cdmi_capabilities/'
             body['objectType'] = Consts.CDMI_APP_CAPABILITY
             body['capabilities'] = {}
@@ -107,14 +178,14 @@ class CapabilityController(Controller):
             body['children'] = ['rootcontainer/', 'container/',
                                 'dataobject/']
             body['completionStatus'] = 'Complete'
-        elif self.container_name == 'rootcontainer':
+        elif ctx.container_name == 'rootcontainer':
             res.status = 200
             res.headers['Content-Type'] = Consts.CDMI_APP_CAPABILITY
             res.headers[Consts.CDMI_VERSION] = Consts.CDMI_VERSION_VALUE
 
             body = {}
             body['parentURI'] = '/'.join(['', self.cdmi_root,
-                                          self.account_name,
+                                          ctx.account_name,
                                           'cdmi_capabilities/'])
             body['objectName'] = 'rootcontainer/'
             body['objectType'] = Consts.CDMI_APP_CAPABILITY
@@ -124,14 +195,14 @@ class CapabilityController(Controller):
             body['childrenRange'] = '0-0'
             body['children'] = {}
             body['completionStatus'] = 'Complete'
-        elif self.container_name == 'container':
+        elif ctx.container_name == 'container':
             res.status = 200
             res.headers['Content-Type'] = Consts.CDMI_APP_CAPABILITY
             res.headers[Consts.CDMI_VERSION] = Consts.CDMI_VERSION_VALUE
 
             body = {}
             body['parentURI'] = '/'.join(['', self.cdmi_root,
-                                          self.account_name,
+                                          ctx.account_name,
                                           'cdmi_capabilities/'])
             body['objectName'] = 'container/'
             body['objectType'] = Consts.CDMI_APP_CAPABILITY
@@ -146,14 +217,14 @@ class CapabilityController(Controller):
             body['childrenRange'] = '0-0'
             body['children'] = {}
             body['completionStatus'] = 'Complete'
-        elif self.container_name == 'dataobject':
+        elif ctx.container_name == 'dataobject':
             res.status = 200
             res.headers['Content-Type'] = Consts.CDMI_APP_CAPABILITY
             res.headers[Consts.CDMI_VERSION] = Consts.CDMI_VERSION_VALUE
 
             body = {}
             body['parentURI'] = '/'.join(['', self.cdmi_root,
-                                          self.account_name,
+                                          ctx.account_name,
                                           'cdmi_capabilities/'])
             body['objectName'] = 'dataobject/'
             body['objectType'] = Consts.CDMI_APP_CAPABILITY
@@ -171,6 +242,8 @@ class CapabilityController(Controller):
             body = {}
 
         res.body = json.dumps(body, indent=2)
+        if res.status_int == 200:
+            self._check_not_modified(env, res, [res.body])
         return res
 
 
@@ -178,8 +251,7 @@ class LoginController(Controller):
     """
     Login controller, handles cdmi login request
     """
-    def __init__(self, env, conf, app, logger, account_name, **kwargs):
-        Controller.__init__(self, conf, app, logger)
+    def setup_request(self, env, ctx):
         env['PATH_INFO'] = '/auth/v1.0'
 
     # Use GET to handle all cdmi log in attempt and respond with X-Storage-Url
@@ -187,13 +259,14 @@ class LoginController(Controller):
         """
         Handle GET Data Object request
         """
-        # Create a new WebOb Request object according to the current request
-        req = Request(env)
+        req = env['cdmi.context'].request
         ssl = True if req.scheme.lower() == 'https' else False
 
-        conn = http_connect_raw(req.server_name, req.server_port, 'GET',
-                                '/auth/v1.0', req.headers, None, ssl)
-        res = conn.getresponse()
+        # The auth request is sent to the proxy since the auth middleware
+        # sits in front of this middleware in the pipeline.
+        res, body = get_conn_pool(env).request(req.server_name,
+                                               req.server_port, ssl, 'GET',
+                                               '/auth/v1.0', dict(req.headers))
 
         # Create a new response
         resp = Response()
@@ -208,60 +281,3 @@ class LoginController(Controller):
         else:
             resp.status = res.status
             return resp
-
-
-class AccountController(Controller):
-    """
-    Account controller, handles requests related to user account
-    """
-    def __init__(self, env, conf, app, logger, account_name, **kwargs):
-        Controller.__init__(self, conf, app, logger)
-        self.account_name = account_name
-        env['PATH_INFO'] = '/v1/%s' % (account_name)
-
-    def _read_root(self, env, start_response):
-
-        req = Request(env)
-        req.headers['Accept'] = Consts.APP_JSON
-        res = req.get_response(self.app)
-
-        body = {}
-
-        # Setup required attributes for response body
-        body['objectType'] = Consts.CDMI_APP_CONTAINER
-        body['objectName'] = self.account_name + '/'
-        body['parentURI'] = '/'.join(['', self.cdmi_root, ''])
-        body['capabilitiesURI'] = '/'.join(['', self.cdmi_root,
-                                            self.account_name,
-                                            self.cdmi_capability_id,
-                                           'rootcontainer/'])
-        body['metadata'] = {}
-
-        body['children'] = []
-
-        if res.status_int == 200:
-            children = json.loads(res.body)
-            for child in children:
-                body['children'].append(child['name'] + '/')
-
-        if body['children'] == []:
-            body['childrenRange'] = ''
-        else:
-            body['childrenRange'] = '0-' + str(len(body['children']) - 1)
-        res.body = json.dumps(body, indent=2)
-
-        return res
-
-    # Use GET to retrieve all cdmi containers for a given user
-    def GET(self, env, start_response):
-        """
-        Handle request for container listing of an account
-        """
-        # Create a new WebOb Request object according to the current request
-        req = Request(env)
-        # if cdmi content, then we return response in cdmi format
-        if req.headers.get(Consts.CDMI_VERSION, False):
-            return self._read_root(env, start_response)
-        else:
-            res = req.get_response(self.app)
-            return res
@@ -0,0 +1,673 @@
+# Copyright (c) 2011 IBM
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module defines the caches the cdmi middleware keeps across requests
+
+from cdmibase import Consts
+from collections import OrderedDict
+import time
+
+
+class ResourceTypeCache(object):
+    """
+    A bounded LRU cache of resource types keyed by account, container and
+    the name of the resource in the container. A type is one of the
+    Consts.RESOURCE_* values. Entries saying a resource does not exist
+    expire after the negative ttl, the other entries after the ttl.
+    Each container has a generation which is part of the keys, bumping it
+    drops every entry of the container at once. The generations are taken
+    from a counter, only the most recently bumped ones are kept, the other
+    containers share a floor generation which moves up to the counter
+    when a generation is dropped, so their entries are dropped as well.
+    """
+
+    def __init__(self, max_size=10000, ttl=10.0, negative_ttl=2.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # (account, container, generation, name) -> (type, expire time)
+        self.entries = OrderedDict()
+        # (account, container) -> generation, least recently bumped first
+        self.generations = OrderedDict()
+        self.counter = 0
+        self.floor = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """ Returns the cache counters """
+        lookups = self.hits + self.misses
+        hit_rate = float(self.hits) / lookups if lookups else 0.0
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': hit_rate, 'size': len(self.entries)}
+
+    def generation(self, account, container):
+        """ Returns the current generation of a container """
+        return self.generations.get((account, container), self.floor)
+
+    def _key(self, account, container, name, generation=None):
+        if generation is None:
+            generation = self.generation(account, container)
+        return (account, container, generation, name.strip('/'))
+
+    def get(self, account, container, name, generation=None):
+        """
+        Returns the cached type of a resource or None. Given a generation,
+        the entry of that generation of the container is looked up.
+        """
+        key = self._key(account, container, name, generation)
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[1] < time.time():
+            self.misses += 1
+            return None
+        # Put the entry back so that it becomes the most recently used
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def set(self, account, container, name, resource_type, generation=None):
+        """
+        Cache the type of a resource. Given a generation, the entry is
+        stored under that generation of the container, the one read before
+        the type was checked, so that it is dropped by any invalidation of
+        the container done since.
+        """
+        if self.max_size <= 0:
+            return
+        if (generation is not None and
+                generation != self.generation(account, container)):
+            # The container changed since the type was checked
+            return
+        if resource_type in (Consts.RESOURCE_MISSING,
+                             Consts.RESOURCE_NO_CONTAINER):
+            ttl = self.negative_ttl
+        else:
+            ttl = self.ttl
+        if ttl <= 0:
+            return
+        key = self._key(account, container, name, generation)
+        self.entries.pop(key, None)
+        self.entries[key] = (resource_type, time.time() + ttl)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, account, container, name):
+        """
+        Drop the cached types of the whole container by bumping its
+        generation, whatever the name written is. Creating or removing a
+        resource may turn its parents into virtual containers or make them
+        disappear, and a type checked while the resource was written is
+        then stored under the former generation, where it is never seen.
+        """
+        self.counter += 1
+        self.generations.pop((account, container), None)
+        self.generations[(account, container)] = self.counter
+        while len(self.generations) > max(self.max_size, 1):
+            self.generations.popitem(last=False)
+            self.floor = self.counter
+
+
+class MemcacheResourceTypeCache(object):
+    """
+    A resource type cache stored in memcache, so that all the proxy server
+    processes share it. It offers the same methods as ResourceTypeCache.
+    Each container has a version kept in memcache which is part of the
+    keys of its entries, incrementing the version once drops every entry
+    of the container at once, so any write in a container invalidates the
+    whole container. The memcache client is the one Swift puts in the env
+    as swift.cache, any object with the same get, set and incr methods,
+    such as InMemoryMemcache, can be used instead. Since the cache is
+    shared by the requests, each method can be given the memcache client
+    of the request, the one the cache was created with is used otherwise.
+    """
+
+    def __init__(self, memcache=None, ttl=10.0, negative_ttl=2.0,
+                 prefix='cdmi'):
+        self.memcache = memcache
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """ Returns the cache counters """
+        lookups = self.hits + self.misses
+        hit_rate = float(self.hits) / lookups if lookups else 0.0
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': hit_rate}
+
+    def _version_key(self, account, container):
+        return '/'.join([self.prefix, 'version', account, container])
+
+    def generation(self, account, container, memcache=None):
+        """ Returns the current version of a container """
+        memcache = memcache or self.memcache
+        return memcache.get(self._version_key(account, container)) or 0
+
+    def _key(self, account, container, name, generation, memcache):
+        if generation is None:
+            generation = self.generation(account, container, memcache)
+        return '/'.join([self.prefix, 'type', account, container,
+                         str(generation), name.strip('/')])
+
+    def get(self, account, container, name, generation=None,
+            memcache=None):
+        """ Returns the cached type of a resource or None """
+        memcache = memcache or self.memcache
+        resource_type = memcache.get(self._key(account, container, name,
+                                               generation, memcache))
+        if resource_type is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return resource_type
+
+    def set(self, account, container, name, resource_type, generation=None,
+            memcache=None):
+        """
+        Cache the type of a resource, under the given version of the
+        container if any, see ResourceTypeCache.set.
+        """
+        if resource_type in (Consts.RESOURCE_MISSING,
+                             Consts.RESOURCE_NO_CONTAINER):
+            ttl = self.negative_ttl
+        else:
+            ttl = self.ttl
+        if ttl <= 0:
+            return
+        memcache = memcache or self.memcache
+        # Memcache takes the ttl in whole seconds
+        memcache.set(self._key(account, container, name, generation,
+                               memcache),
+                     resource_type, True, max(int(ttl), 1))
+
+    def invalidate(self, account, container, name, memcache=None):
+        """
+        Drop the cached types of the whole container, a single increment of
+        the container version does it whatever the name written is.
+        """
+        memcache = memcache or self.memcache
+        memcache.incr(self._version_key(account, container))
+
+
+class RequestTypeCache(object):
+    """
+    The resource type cache as seen by one request, it offers the same
+    methods as ResourceTypeCache. The generation of a container is read
+    the first time the request uses the container, which is before the
+    request checks any resource in it, and the types are then stored
+    under that generation. A type checked while another request wrote in
+    the container is thus dropped by that write. When the cache is kept in
+    memcache, the memcache client of the request is given on each call.
+    """
+
+    def __init__(self, cache, memcache=None):
+        self.cache = cache
+        self.kwargs = {}
+        if memcache is not None:
+            self.kwargs['memcache'] = memcache
+        # (account, container) -> generation seen by the request
+        self.generations = {}
+
+    def stats(self):
+        """ Returns the counters of the cache """
+        return self.cache.stats()
+
+    def _generation(self, account, container):
+        key = (account, container)
+        if key not in self.generations:
+            self.generations[key] = self.cache.generation(account, container,
+                                                          **self.kwargs)
+        return self.generations[key]
+
+    def get(self, account, container, name):
+        """ Returns the cached type of a resource or None """
+        return self.cache.get(account, container, name,
+                              self._generation(account, container),
+                              **self.kwargs)
+
+    def set(self, account, container, name, resource_type):
+        """ Cache the type of a resource """
+        self.cache.set(account, container, name, resource_type,
+                       self._generation(account, container), **self.kwargs)
+
+    def invalidate(self, account, container, name):
+        """
+        Drop the cached types a write of the request changed, the types
+        the request checks afterwards go under the new generation.
+        """
+        self.cache.invalidate(account, container, name, **self.kwargs)
+        self.generations.pop((account, container), None)
+
+
+class InMemoryMemcache(object):
+    """
+    A local stand-in for the Swift memcache client, it keeps the values in
+    a dict and honors their timeouts. It can be used to run the memcache
+    backed cache without a memcache server, for example in tests.
+    """
+
+    def __init__(self):
+        # key -> (value, expire time or None)
+        self.store = {}
+
+    def get(self, key):
+        entry = self.store.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] < time.time():
+            del self.store[key]
+            return None
+        return entry[0]
+
+    def set(self, key, value, serialize=True, timeout=0):
+        self.store[key] = (value, time.time() + timeout if timeout else None)
+
+    def incr(self, key, delta=1, timeout=0):
+        value = int(self.get(key) or 0) + delta
+        self.set(key, value, True, timeout)
+        return value
+
+    def delete(self, key):
+        self.store.pop(key, None)
+
+
+class HierarchyNode(object):
+    """
+    A name within a container in the hierarchy index. The type is one of
+    Consts.RESOURCE_OBJECT, RESOURCE_DIRECTORY and RESOURCE_VIRTUAL, or
+    None when it is not known. A complete node holds every name right
+    under it, any other name there does not exist.
+    """
+    __slots__ = ('type', 'children', 'complete')
+
+    def __init__(self, resource_type=None):
+        self.type = resource_type
+        self.children = {}
+        self.complete = False
+
+
+def _count_nodes(node):
+    count = 1
+    for child in node.children.itervalues():
+        count += _count_nodes(child)
+    return count
+
+
+class ContainerHierarchy(object):
+    """
+    The known names of a container, kept as a trie keyed by the parts of
+    the names. The root node is the container itself.
+    """
+
+    def __init__(self, max_entries):
+        self.root = HierarchyNode(Consts.RESOURCE_DIRECTORY)
+        self.max_entries = max_entries
+        self.size = 1
+        self.created = time.time()
+
+    def _split(self, name):
+        # Swift lists the names decoded, the trie is keyed the same way
+        if isinstance(name, str):
+            name = name.decode('utf-8')
+        name = name.strip('/')
+        return name.split('/') if name else []
+
+    def _find(self, parts):
+        node = self.root
+        for part in parts:
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def _ensure(self, parts):
+        """
+        Returns the node of a name, adding the missing nodes on the way.
+        Returns None when the container holds too many nodes already, the
+        nodes on the way then no longer know all their children.
+        """
+        node = self.root
+        for part in parts:
+            child = node.children.get(part)
+            if child is None:
+                if self.size >= self.max_entries:
+                    node.complete = False
+                    return None
+                child = node.children[part] = HierarchyNode()
+                self.size += 1
+            node = child
+        return node
+
+    def get(self, name):
+        """ Returns the type of a name or None when it is not known """
+        node = self.root
+        for part in self._split(name):
+            child = node.children.get(part)
+            if child is None:
+                if node.complete:
+                    return Consts.RESOURCE_MISSING
+                return None
+            node = child
+        return node.type
+
+    def set(self, name, resource_type):
+        """ Record the type of a name """
+        parts = self._split(name)
+        if resource_type == Consts.RESOURCE_MISSING:
+            self._remove(parts, False)
+            return
+        node = self._ensure(parts)
+        if node is not None:
+            node.type = resource_type
+
+    def add_listing(self, name, entries, complete):
+        """
+        Record the entries of a delimited listing of the names under a
+        name. When the listing is complete, the node of the name keeps
+        only the listed names. Nothing is recorded when the listing does
+        not fit in the container.
+        """
+        parts = self._split(name)
+        prefix = '/'.join(parts + ['']) if parts else ''
+        listed = {}
+        for entry in entries:
+            if entry.get('name') is not None:
+                part = entry['name'][len(prefix):]
+                if not part or '/' in part:
+                    continue
+                content_type = (entry.get('content_type') or '').lower()
+                if content_type.find('application/directory') < 0:
+                    listed[part] = Consts.RESOURCE_OBJECT
+                else:
+                    listed[part] = Consts.RESOURCE_DIRECTORY
+            elif entry.get('subdir') is not None and complete:
+                # Only a complete listing tells that there is no marker
+                # with the same name, which is listed right before
+                part = entry['subdir'][len(prefix):].rstrip('/')
+                if part and '/' not in part:
+                    listed.setdefault(part, Consts.RESOURCE_VIRTUAL)
+
+        if self.size + len(parts) + len(listed) > self.max_entries:
+            return
+        node = self._ensure(parts)
+        if complete:
+            for part in node.children.keys():
+                if part not in listed:
+                    self.size -= _count_nodes(node.children.pop(part))
+            node.complete = True
+        for part, resource_type in listed.iteritems():
+            child = node.children.get(part)
+            if child is None:
+                child = node.children[part] = HierarchyNode()
+                self.size += 1
+            child.type = resource_type
+
+    def remove(self, name):
+        """
+        Record that a name was removed. A virtual container left without
+        anything under it is gone as well.
+        """
+        self._remove(self._split(name), True)
+
+    def discard(self, name):
+        """ Forget what is known about a name """
+        parts = self._split(name)
+        if parts:
+            parent = self._find(parts[:-1])
+            if parent is not None:
+                parent.complete = False
+            self._remove(parts, False)
+
+    def _remove(self, parts, removed):
+        if not parts:
+            return
+        nodes = [self.root]
+        for part in parts[:-1]:
+            node = nodes[-1].children.get(part)
+            if node is None:
+                return
+            nodes.append(node)
+        child = nodes[-1].children.pop(parts[-1], None)
+        if child is not None:
+            self.size -= _count_nodes(child)
+        if not removed:
+            return
+        # Walk up through the virtual containers which may have vanished
+        index = len(parts) - 1
+        while index > 0:
+            node = nodes[index]
+            if node.type != Consts.RESOURCE_VIRTUAL:
+                break
+            if not node.complete:
+                node.type = None
+                break
+            if node.children:
+                break
+            nodes[index - 1].children.pop(parts[index - 1], None)
+            self.size -= 1
+            index -= 1
+
+
+class HierarchyIndex(object):
+    """
+    An in-process index of the names known in the most active containers.
+    Each container is kept as a ContainerHierarchy holding at most
+    max_entries names, at most max_containers containers are kept and the
+    least recently used one is dropped first. A container is dropped and
+    indexed again from scratch once it is older than max_age seconds, so
+    changes made without going through this process are seen after that.
+    """
+
+    def __init__(self, max_containers=100, max_entries=10000, max_age=30.0):
+        self.max_containers = max_containers
+        self.max_entries = max_entries
+        self.max_age = max_age
+        # (account, container) -> ContainerHierarchy
+        self.containers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """ Returns the index counters """
+        lookups = self.hits + self.misses
+        hit_rate = float(self.hits) / lookups if lookups else 0.0
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': hit_rate, 'containers': len(self.containers)}
+
+    def _get(self, account, container, create=False):
+        key = (account, container)
+        hierarchy = self.containers.pop(key, None)
+        if hierarchy is not None and \
+                hierarchy.created + self.max_age < time.time():
+            hierarchy = None
+        if hierarchy is None:
+            if not create:
+                return None
+            hierarchy = ContainerHierarchy(self.max_entries)
+        # Put the container back so that it becomes the most recently used
+        self.containers[key] = hierarchy
+        while len(self.containers) > self.max_containers:
+            self.containers.popitem(last=False)
+        return hierarchy
+
+    def get(self, account, container, name):
+        """ Returns the indexed type of a name or None """
+        hierarchy = self._get(account, container)
+        resource_type = hierarchy.get(name) if hierarchy else None
+        if resource_type is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return resource_type
+
+    def set(self, account, container, name, resource_type):
+        """ Record the type of a name """
+        if resource_type == Consts.RESOURCE_NO_CONTAINER:
+            self.drop(account, container)
+        elif name:
+            self._get(account, container, True).set(name, resource_type)
+
+    def add_listing(self, account, container, name, entries, complete):
+        """ Record the entries of a delimited listing under a name """
+        self._get(account, container, True).add_listing(name, entries,
+                                                        complete)
+
+    def remove(self, account, container, name):
+        """ Record that a name was removed """
+        hierarchy = self._get(account, container)
+        if hierarchy is not None:
+            hierarchy.remove(name)
+
+    def discard(self, account, container, name):
+        """ Forget what is known about a name """
+        hierarchy = self._get(account, container)
+        if hierarchy is not None:
+            hierarchy.discard(name)
+
+    def drop(self, account, container):
+        """ Forget the whole container """
+        self.containers.pop((account, container), None)
+
+
+class ListingCheckpoints(object):
+    """
+    Checkpoints in the delimited listings of the most recently read
+    containers. A checkpoint tells, for an offset in the children under a
+    prefix, the marker the listing resumes from and the directory markers
+    found before it whose subdir entry was not listed yet. A read of a
+    range deep in a large container then starts from the closest
+    checkpoint instead of paging through the listing from the start.
+    Once a listing was read to its end, the number of children under the
+    prefix is kept as well, so reading how many children there are does
+    not need the listing again.
+    At most max_listings listings are kept, the least recently used one is
+    dropped first, and the checkpoints of a listing expire after ttl
+    seconds. Like the resource type cache, each container has a
+    generation which is part of the keys, taken from a counter, and at
+    most max_listings generations are kept above a shared floor.
+    """
+
+    def __init__(self, max_listings=1000, ttl=10.0, max_checkpoints=100):
+        self.max_listings = max_listings
+        self.ttl = ttl
+        self.max_checkpoints = max_checkpoints
+        # (account, container, generation, prefix) ->
+        #     [expire time, {offset: (marker, pending)}, count]
+        self.listings = OrderedDict()
+        # (account, container) -> generation, least recently bumped first
+        self.generations = OrderedDict()
+        self.counter = 0
+        self.floor = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """ Returns the checkpoint counters """
+        lookups = self.hits + self.misses
+        hit_rate = float(self.hits) / lookups if lookups else 0.0
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': hit_rate, 'size': len(self.listings)}
+
+    def generation(self, account, container):
+        """ Returns the current generation of a container """
+        return self.generations.get((account, container), self.floor)
+
+    def _key(self, account, container, prefix, generation=None):
+        if generation is None:
+            generation = self.generation(account, container)
+        return (account, container, generation, prefix)
+
+    def _get(self, account, container, prefix, create=False,
+             generation=None):
+        key = self._key(account, container, prefix, generation)
+        listing = self.listings.pop(key, None)
+        if listing is not None and listing[0] < time.time():
+            listing = None
+        if listing is None:
+            if not create:
+                return None
+            listing = [time.time() + self.ttl, {}, None]
+        # Put the listing back so that it becomes the most recently used
+        self.listings[key] = listing
+        while len(self.listings) > self.max_listings:
+            self.listings.popitem(last=False)
+        return listing
+
+    def get(self, account, container, prefix, offset):
+        """
+        Returns the closest checkpoint at or before an offset as a tuple
+        (offset, marker, pending) or None.
+        """
+        listing = self._get(account, container, prefix)
+        offsets = []
+        if listing is not None:
+            offsets = [at for at in listing[1] if at <= offset]
+        if not offsets:
+            self.misses += 1
+            return None
+        self.hits += 1
+        at = max(offsets)
+        marker, pending = listing[1][at]
+        return at, marker, pending
+
+    def _is_current(self, account, container, generation):
+        return (generation is None or
+                generation == self.generation(account, container))
+
+    def add(self, account, container, prefix, offset, marker, pending=(),
+            generation=None):
+        """
+        Record where the listing under a prefix resumes for an offset.
+        Given a generation, the one read before the listing started, the
+        checkpoint is dropped when the container changed since.
+        """
+        if (self.max_listings <= 0 or self.ttl <= 0 or
+                not self._is_current(account, container, generation)):
+            return
+        listing = self._get(account, container, prefix, True, generation)
+        if (offset in listing[1] or
+                len(listing[1]) < self.max_checkpoints):
+            listing[1][offset] = (marker, tuple(pending))
+
+    def get_count(self, account, container, prefix):
+        """ Returns the number of children under a prefix or None """
+        listing = self._get(account, container, prefix)
+        if listing is None or listing[2] is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return listing[2]
+
+    def set_count(self, account, container, prefix, count,
+                  generation=None):
+        """
+        Record the number of children under a prefix, unless the container
+        changed since the given generation.
+        """
+        if (self.max_listings <= 0 or self.ttl <= 0 or
+                not self._is_current(account, container, generation)):
+            return
+        self._get(account, container, prefix, True, generation)[2] = count
+
+    def invalidate(self, account, container):
+        """ Drop the checkpoints of all the listings of a container """
+        self.counter += 1
+        self.generations.pop((account, container), None)
+        self.generations[(account, container)] = self.counter
+        while len(self.generations) > max(self.max_listings, 1):
+            self.generations.popitem(last=False)
+            self.floor = self.counter
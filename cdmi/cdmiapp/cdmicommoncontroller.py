@@ -16,10 +16,20 @@
 from cdmibase import \
     (Consts, Controller, concat_parts)
 from cdmiutils import \
-    (get_pair_from_header, get_err_response, check_resource, send_manifest)
-from webob import Request, Response
+    (get_pair_from_header, get_err_response, check_resource, send_manifest,
+     ProbeCache, get_marker_before, get_json_envelope, iter_base64_value,
+     iter_text_value, get_base64_value_length, iter_multipart,
+     get_multipart_length, get_value_ranges, get_auth_token,
+     make_subrequest, get_cdmi_fields, iter_json_list, iter_json_fields,
+     iter_json_tree, load_listing, is_authorized, get_swift_err_response)
+from webob import Response
+from eventlet import GreenPool
 from swift.common.utils import get_logger
-from urlparse import parse_qs
+from swift.common.constraints import CONTAINER_LISTING_LIMIT
+from urlparse import parse_qsl
+from urllib import quote
+from itertools import chain
+from heapq import heappush, heappop
 import json
 import base64
 import email
@@ -30,40 +40,670 @@ import random
 class CDMIBaseController(Controller):
     """
     Handles container request.
-    This is the base class for other controllers. In the constructor,
-    it sets up new path for handing the request to OS and also set up
-    the parent_name, metadata_prefix according to OS structure. This base
+    This is the base class for other controllers. Before a request is
+    handled, it sets up new path for handing the request to OS and also set
+    up the metadata_prefix according to OS structure. This base
     class defines few more utility methods to process metadata and check
     parent status according to the request path.
     """
-    def __init__(self, env, conf, app, logger, account_name, container_name,
-                 parent_name, object_name, **kwargs):
-        Controller.__init__(self, conf, app, logger)
-        self.account_name = account_name
-        self.container_name = container_name
-        self.object_name = object_name
-        self.parent_name = parent_name
-        if self.object_name:
-            self.metadata_prefix = Consts.META_OBJECT_ID
+    # How many entries the listing used to resolve a write target asks for
+    target_listing_limit = 10
+    # The most entries Swift returns in a single listing, as the cluster
+    # is configured. A shorter page is the last one.
+    listing_limit = CONTAINER_LISTING_LIMIT
+    # The most ranges of a value read at once, as Swift allows
+    max_value_ranges = 50
+
+    def setup_request(self, env, ctx):
+        if ctx.object_name:
+            ctx.metadata_prefix = Consts.META_OBJECT_ID
         else:
-            self.metadata_prefix = Consts.META_CONTAINER_ID
-        env['PATH_INFO'] = '/v1/' + concat_parts(self.account_name,
-                                                 self.container_name,
-                                                 self.parent_name,
-                                                 self.object_name)
+            ctx.metadata_prefix = Consts.META_CONTAINER_ID
+        env['PATH_INFO'] = '/v1/' + concat_parts(ctx.account_name,
+                                                 ctx.container_name,
+                                                 ctx.parent_name,
+                                                 ctx.object_name)
 
-    def _process_metadata(self, headers):
+    def _process_metadata(self, env, headers):
         """ Get CDMI metadata from the header and add to the body """
+        ctx = env['cdmi.context']
         metadata = {}
         for header, value in headers.iteritems():
             key = header.lower()
-            if key.startswith(self.metadata_prefix):
+            if key.startswith(ctx.metadata_prefix):
                 key, value = get_pair_from_header(value)
                 if key != '' and value != '':
                     metadata[key] = value
 
         return metadata
 
+    def _wants_field(self, env, *names):
+        """ Tells if a read asks for any of the given fields """
+        fields = env['cdmi.context'].fields
+        if not fields:
+            return True
+        for name in names:
+            if name.lower() in fields:
+                return True
+        return False
+
+    def _select_fields(self, env, body):
+        """
+        Keep only the fields of the body a read asks for. When prefixes are
+        given for the metadata, only the metadata items starting with one of
+        them are kept.
+        """
+        fields = env['cdmi.context'].fields
+        if not fields:
+            return body
+        selected = {}
+        for key, value in body.iteritems():
+            qualifiers = fields.get(key.lower())
+            if qualifiers is None:
+                continue
+            if key == 'metadata' and qualifiers:
+                value = dict([(name, item) for name, item in value.iteritems()
+                              if [prefix for prefix in qualifiers
+                                  if name.startswith(prefix)]])
+            selected[key] = value
+        return selected
+
+    def _check_resource(self, env, method, path, get_body=False,
+                        query_string=None):
+        """
+        Check if a resource exists, see cdmiutils.check_resource. Depending
+        on the configured probe mode, the check is either a subrequest to
+        the downstream app or a new connection to the proxy. The checks
+        are memoized for the request in the env, so the same check is only
+        sent once while serving a request.
+        """
+        cache = env.get('cdmi.probe_cache')
+        if cache is None:
+            cache = env['cdmi.probe_cache'] = ProbeCache()
+        method = 'GET' if not method else method
+        key = (method, path.rstrip('/'), query_string or '')
+        return cache.check(key, get_body, check_resource, env, method, path,
+                           self.logger, get_body, query_string,
+                           self.probe_app)
+
+    def _head_resource(self, env, path):
+        """
+        Check if a resource exists and get its headers with a HEAD request,
+        which transfers neither the object content nor the container
+        listing. The check goes through the probe cache of the request.
+        """
+        exists, headers, dummy = self._check_resource(env, 'HEAD', path)
+        return exists, headers
+
+    def _probe_children(self, env, name):
+        """
+        This method checks if there is anything under a name within the
+        container without listing the children, it only asks for the first
+        entry of the listing. Without a name, the whole container is
+        checked. Returns whether the container exists and whether there is
+        anything under the name, which is None when the listing can not be
+        parsed.
+        """
+        ctx = env['cdmi.context']
+        path = '/' + concat_parts('v1', ctx.account_name,
+                                  ctx.container_name)
+        query_string = 'delimiter=/&limit=1'
+        if name:
+            query_string += '&prefix=' + quote(name + '/')
+        exists, dummy, body = self._check_resource(env, 'GET', path, True,
+                                                   query_string)
+        if not exists:
+            return False, False
+        try:
+            return True, len(json.loads(body)) > 0
+        except (TypeError, ValueError):
+            return True, None
+
+    def _get_children_range(self, env):
+        """
+        Returns the offsets of the first and the last child a read asks
+        for with ?children:first-last, the last one is None when the range
+        has no end or when no range is asked for. A malformed range raises
+        a ValueError.
+        """
+        ranges = (env['cdmi.context'].fields or {}).get('children')
+        if not ranges:
+            return 0, None
+        first, sep, last = ranges[0].partition('-')
+        first = int(first)
+        last = int(last) if last else None
+        if not sep or first < 0 or (last is not None and last < first):
+            raise ValueError('InvalidRange')
+        return first, last
+
+    def _get_children_depth(self, env):
+        """
+        Returns how deep under a container a read asks for its children
+        with ?children&depth=N, 1 for the children right under it only.
+        A malformed depth raises a ValueError.
+        """
+        for key, value in parse_qsl(env.get('QUERY_STRING') or ''):
+            if key == 'depth':
+                depth = int(value)
+                if depth < 1:
+                    raise ValueError('InvalidArgument')
+                return depth
+        return 1
+
+    def _get_page_limit(self, offset, last):
+        """
+        Returns how many entries to ask for in the listing page starting
+        at an offset, one more than the range needs so that the end of the
+        listing may be seen, and at most what Swift returns in a page.
+        """
+        if last is None:
+            return self.listing_limit
+        return max(1, min(self.listing_limit, last - offset + 2))
+
+    def _get_first_page_limit(self, env):
+        """
+        Returns how many entries the first listing of the children of a
+        container asks for. A range starting past the first child may
+        resume from a checkpoint, the first page then only tells whether
+        there is anything in the container. So does it for a read of the
+        children down to a depth, which lists the container without a
+        delimiter.
+        """
+        try:
+            first, last = self._get_children_range(env)
+            depth = self._get_children_depth(env)
+        except ValueError:
+            first, last, depth = 0, None, 1
+        if first > 0 or depth > 1:
+            return 1
+        return self._get_page_limit(0, last)
+
+    def _get_listing_page(self, env, name, marker, limit, delimiter='/'):
+        """
+        Returns the page of the listing under a name which starts after
+        the marker, or None when it can not be read. Without a delimiter,
+        all the names under the name are listed. Pages are not shared with
+        the other checks of the request, each one is read once.
+        """
+        ctx = env['cdmi.context']
+        path = '/' + concat_parts('v1', ctx.account_name,
+                                  ctx.container_name)
+        query_string = 'limit=%d' % limit
+        if delimiter:
+            query_string = 'delimiter=%s&%s' % (delimiter, query_string)
+        if name:
+            query_string += '&prefix=' + quote(name + '/')
+        if marker:
+            query_string += '&marker=' + quote(marker.encode('utf-8'))
+        exists, dummy, body = check_resource(env, 'GET', path, self.logger,
+                                             True, query_string,
+                                             self.probe_app)
+        if not exists:
+            return None
+        try:
+            return load_listing(body)
+        except (TypeError, ValueError):
+            return None
+
+    def _may_use_cache(self, env):
+        """
+        The cached types, the hierarchy index and the counts of children
+        are shared by all the callers and are not checked by Swift, they
+        may only answer the requests of the owner of the account. The
+        requests of other callers go to Swift, which applies the ACLs.
+        """
+        if 'cdmi.authorized' not in env:
+            ctx = env['cdmi.context']
+            env['cdmi.authorized'] = is_authorized(
+                env, '/' + concat_parts('v1', ctx.account_name,
+                                        ctx.container_name))
+        return env['cdmi.authorized']
+
+    def _get_children_count(self, env):
+        """
+        Returns the number of children of the container of a request when
+        it is known from an earlier listing, None otherwise.
+        """
+        ctx = env['cdmi.context']
+        checkpoints = env.get('cdmi.listing_checkpoints')
+        if checkpoints is None or not self._may_use_cache(env):
+            return None
+        name = concat_parts(ctx.parent_name, ctx.object_name)
+        return checkpoints.get_count(ctx.account_name, ctx.container_name,
+                                     (name + '/') if name else '')
+
+    def _get_listing_generation(self, env):
+        """
+        Returns the generation of the listing checkpoints of the container
+        of a request. It is read once, before the request lists the
+        container, so that the checkpoints and the count the listing
+        leaves are dropped when the container is written meanwhile.
+        """
+        if 'cdmi.listing_generation' not in env:
+            ctx = env['cdmi.context']
+            env['cdmi.listing_generation'] = \
+                env['cdmi.listing_checkpoints'].generation(
+                    ctx.account_name, ctx.container_name)
+        return env['cdmi.listing_generation']
+
+    def _set_children_count(self, env, count):
+        """ Record the number of children of the container of a request """
+        ctx = env['cdmi.context']
+        checkpoints = env.get('cdmi.listing_checkpoints')
+        if checkpoints is not None:
+            name = concat_parts(ctx.parent_name, ctx.object_name)
+            checkpoints.set_count(ctx.account_name, ctx.container_name,
+                                  (name + '/') if name else '', count,
+                                  self._get_listing_generation(env))
+
+    def _iter_children(self, env, name, entries, limit, first=0,
+                       last=None, listing=None):
+        """
+        Yields the children under a name from offset first to last. The
+        entries are the first page of the listing, read with the given
+        limit, the next pages are read with markers as the children are
+        consumed, so only a page of the listing is held at a time.
+        A directory marker and the subdir entry of the same directory are
+        one child, even when they are listed in different pages. A range
+        starting past the first page resumes from the closest checkpoint
+        kept for the listing, and each page read leaves a checkpoint.
+        When given, the listing dict is told how many children were
+        yielded, how many children there are when the listing was read to
+        its end, and whether a page could not be read.
+        """
+        ctx = env['cdmi.context']
+        if listing is None:
+            listing = {}
+        listing['returned'] = 0
+        prefix = (name + '/') if name else ''
+        checkpoints = env.get('cdmi.listing_checkpoints')
+        offset, pending = 0, ()
+        if checkpoints is not None:
+            generation = self._get_listing_generation(env)
+        if first > 0 and checkpoints is not None:
+            checkpoint = checkpoints.get(ctx.account_name,
+                                         ctx.container_name, prefix, first)
+            if checkpoint is not None:
+                offset, marker, pending = checkpoint
+                limit = self._get_page_limit(offset, last)
+                entries = self._get_listing_page(env, name, marker, limit)
+        # Swift lists the names decoded, so is the prefix cut from them
+        uprefix = prefix.decode('utf-8')
+        # The directory markers whose subdir entry is still to come
+        pending = set(pending)
+        while entries is not None:
+            for entry in entries:
+                child = entry.get('name') or entry.get('subdir')
+                if not child:
+                    continue
+                child = child[len(uprefix):]
+                if 'subdir' in entry:
+                    if child in pending:
+                        pending.discard(child)
+                        continue
+                else:
+                    content_type = entry.get('content_type') or ''
+                    if (not child.endswith('/') and
+                            content_type.find('directory') >= 0):
+                        child += '/'
+                    if child.endswith('/'):
+                        pending.add(child)
+                if offset >= first and (last is None or offset <= last):
+                    listing['returned'] += 1
+                    yield child
+                offset += 1
+            if len(entries) < limit:
+                listing['count'] = offset
+                return
+            if last is not None and offset > last:
+                return
+            marker = entries[-1].get('name') or entries[-1].get('subdir')
+            pending = set([part for part in pending
+                           if uprefix + part > marker])
+            if checkpoints is not None:
+                checkpoints.add(ctx.account_name, ctx.container_name,
+                                prefix, offset, marker, pending, generation)
+            limit = self._get_page_limit(offset, last)
+            entries = self._get_listing_page(env, name, marker, limit)
+        listing['error'] = True
+
+    def _iter_subtree(self, env, name, entries, listing):
+        """
+        Yields the nodes of the tree under a name, from the listing of all
+        the names under it, as iter_json_tree takes them. The entries are
+        the first page of the listing, the next pages are read as the
+        nodes are consumed. A directory marker sorts as its subdir would,
+        after the names which only start like it, so it waits until the
+        listing gets there. The listing dict is told how many children
+        the name has and whether a page could not be read.
+        """
+        uprefix = ((name + '/') if name else '').decode('utf-8')
+        # The directory markers still to be written, by the name their
+        # content starts with
+        markers = []
+        last_child = None
+        listing['returned'] = 0
+        while entries is not None:
+            for entry in entries + [None]:
+                nodes = []
+                if entry is None:
+                    if len(entries) >= self.listing_limit:
+                        break
+                    # The end of the listing
+                    while markers:
+                        nodes.append((heappop(markers)[1], True))
+                elif entry.get('name', '')[len(uprefix):].strip('/'):
+                    entry_name = entry['name']
+                    while markers and markers[0][0] <= entry_name:
+                        nodes.append((heappop(markers)[1], True))
+                    content_type = entry.get('content_type') or ''
+                    names = entry_name[len(uprefix):].strip('/').split('/')
+                    if entry_name.endswith('/'):
+                        nodes.append((names, True))
+                    elif content_type.find('directory') >= 0:
+                        heappush(markers, (entry_name + '/', names))
+                    else:
+                        nodes.append((names, False))
+                for names, is_container in nodes:
+                    child = (names[0], is_container or len(names) > 1)
+                    if child != last_child:
+                        listing['returned'] += 1
+                        last_child = child
+                    yield names, is_container
+            if len(entries) < self.listing_limit:
+                listing['count'] = listing['returned']
+                return
+            entries = self._get_listing_page(env, name, entries[-1]['name'],
+                                             self.listing_limit, None)
+        listing['error'] = True
+
+    def _get_resource_type(self, env, name):
+        """
+        This method finds out what a name within the container points to.
+        Returns one of the Consts.RESOURCE_* values, the type is an object
+        or a directory when the name exists, a virtual container when the
+        name does not exist but there is something under it, missing when
+        there is nothing at all and no container when the container itself
+        does not exist. Returns None when the listing can not be parsed.
+        Types are kept in the middleware resource type cache, so the same
+        name is not checked again on every request.
+        """
+        ctx = env['cdmi.context']
+        resource_type = self._get_cached_type(env, name)
+        if resource_type is not None:
+            return resource_type
+
+        # Hit the resource url to see if it exists and, at the same time,
+        # check if there is anything below that name, if it is, then
+        # this is actually a virtual container.
+        pool = GreenPool()
+        path = '/' + concat_parts('v1', ctx.account_name,
+                                  ctx.container_name, name)
+        target = pool.spawn(self._check_resource, env, 'HEAD', path)
+        below = pool.spawn(self._probe_children, env, name)
+        pool.waitall()
+
+        exists, headers, body = target.wait()
+        # A failed check, like a denied one, says nothing about the
+        # resource and must not be shared with other requests.
+        cacheable = not exists or body is not None
+        if exists:
+            content_type = (headers.get('content-type') or '').lower()
+            if content_type.find('application/directory') < 0:
+                resource_type = Consts.RESOURCE_OBJECT
+            else:
+                resource_type = Consts.RESOURCE_DIRECTORY
+        else:
+            container_exists, has_children = below.wait()
+            if not container_exists:
+                resource_type = Consts.RESOURCE_NO_CONTAINER
+            elif has_children is None:
+                return None
+            elif has_children:
+                resource_type = Consts.RESOURCE_VIRTUAL
+            else:
+                resource_type = Consts.RESOURCE_MISSING
+
+        if cacheable:
+            self._set_cached_type(env, name, resource_type)
+        return resource_type
+
+    def _get_cached_type(self, env, name):
+        """
+        This method returns the type of a name within the container from
+        the hierarchy index or from the resource type cache, or None when
+        neither of them knows it or the caller may not use them.
+        """
+        ctx = env['cdmi.context']
+        if not self._may_use_cache(env):
+            return None
+        index = env.get('cdmi.hierarchy_index')
+        if index is not None:
+            resource_type = index.get(ctx.account_name,
+                                      ctx.container_name, name)
+            if resource_type is not None:
+                return resource_type
+        type_cache = env.get('cdmi.type_cache')
+        if type_cache is not None:
+            return type_cache.get(ctx.account_name, ctx.container_name,
+                                  name)
+        return None
+
+    def _set_cached_type(self, env, name, resource_type):
+        """
+        This method records the type of a name within the container in
+        the hierarchy index and in the resource type cache.
+        """
+        ctx = env['cdmi.context']
+        index = env.get('cdmi.hierarchy_index')
+        if index is not None:
+            index.set(ctx.account_name, ctx.container_name, name,
+                      resource_type)
+        type_cache = env.get('cdmi.type_cache')
+        if type_cache is not None:
+            type_cache.set(ctx.account_name, ctx.container_name, name,
+                           resource_type)
+
+    def _invalidate_resource_type(self, env, res=None, resource_type=None):
+        """
+        This method drops the cached types the request may have changed,
+        it should be called once the request wrote or removed the resource.
+        Given the response and the type written, Consts.RESOURCE_MISSING
+        for a removal, the hierarchy index records a successful write,
+        otherwise it forgets what it knows about the names involved.
+        """
+        ctx = env['cdmi.context']
+        name = concat_parts(ctx.parent_name, ctx.object_name)
+        # The request may have been redirected to a segment of a large
+        # data object, which is under another name.
+        written_name = name
+        prefix = '/' + concat_parts('v1', ctx.account_name,
+                                    ctx.container_name) + '/'
+        path = env.get('PATH_INFO', '')
+        if ctx.object_name and path.startswith(prefix):
+            written_name = path[len(prefix):]
+
+        type_cache = env.get('cdmi.type_cache')
+        if type_cache is not None:
+            type_cache.invalidate(ctx.account_name, ctx.container_name,
+                                  name)
+            if written_name != name:
+                type_cache.invalidate(ctx.account_name,
+                                      ctx.container_name, written_name)
+
+        checkpoints = env.get('cdmi.listing_checkpoints')
+        if checkpoints is not None:
+            checkpoints.invalidate(ctx.account_name, ctx.container_name)
+            env.pop('cdmi.listing_generation', None)
+
+        index = env.get('cdmi.hierarchy_index')
+        if index is None:
+            return
+        if not ctx.object_name:
+            index.drop(ctx.account_name, ctx.container_name)
+        elif (res is None or resource_type is None or
+              res.status_int // 100 != 2 or written_name != name):
+            index.discard(ctx.account_name, ctx.container_name, name)
+            index.discard(ctx.account_name, ctx.container_name,
+                          written_name)
+        elif resource_type == Consts.RESOURCE_MISSING:
+            index.remove(ctx.account_name, ctx.container_name, name)
+        else:
+            index.set(ctx.account_name, ctx.container_name, name,
+                      resource_type)
+
+    def _resolve_write_target(self, env):
+        """
+        This method finds out what the request path and its parent point to
+        before a data object or a container is written there. Returns the
+        type of the target and the type of its parent, see
+        _get_resource_type. When the target sits right in the top
+        container, the parent is a directory if the container exists.
+        Returns None for a type which can not be found out.
+
+        The target is found in a single delimited listing of its parent
+        which starts right before the target name: the target shows up with
+        its content type, a virtual container under the target name shows
+        up as a subdir, and any entry at all means the parent is not empty.
+        A HEAD on the parent, sent at the same time, tells if it is a real
+        directory or a data object. A second listing, limited to a single
+        entry, is only needed when the first one stops before it gets past
+        the target name, or when the parent is not a real directory and
+        nothing sorts after the target name in it.
+        """
+        ctx = env['cdmi.context']
+        name = concat_parts(ctx.parent_name, ctx.object_name)
+        target_type = self._get_cached_type(env, name)
+        parent_type = None
+        if ctx.parent_name:
+            parent_type = self._get_cached_type(env, ctx.parent_name)
+        if not ctx.parent_name and target_type is not None:
+            if target_type == Consts.RESOURCE_NO_CONTAINER:
+                return target_type, Consts.RESOURCE_NO_CONTAINER
+            return target_type, Consts.RESOURCE_DIRECTORY
+        if target_type is not None:
+            if parent_type is None:
+                parent_type = self._get_resource_type(env, ctx.parent_name)
+            return target_type, parent_type
+
+        pool = GreenPool()
+        parent = None
+        if ctx.parent_name and parent_type is None:
+            path = '/' + concat_parts('v1', ctx.account_name,
+                                      ctx.container_name, ctx.parent_name)
+            parent = pool.spawn(self._check_resource, env, 'HEAD', path)
+        container_path = '/' + concat_parts('v1', ctx.account_name,
+                                            ctx.container_name)
+        prefix = (ctx.parent_name + '/') if ctx.parent_name else ''
+        query_string = ('delimiter=/&limit=%d&prefix=%s&marker=%s' %
+                        (self.target_listing_limit, quote(prefix),
+                         quote(get_marker_before(name))))
+        listing = pool.spawn(self._check_resource, env, 'GET',
+                             container_path, True, query_string)
+        pool.waitall()
+
+        container_exists, dummy, body = listing.wait()
+        if container_exists and body is None:
+            # A failed listing, like a denied one, says nothing about the
+            # names in it, check the target and the parent on their own.
+            target_type = self._get_resource_type(env, name)
+            if not ctx.parent_name:
+                return target_type, Consts.RESOURCE_DIRECTORY
+            return target_type, self._get_resource_type(env,
+                                                        ctx.parent_name)
+        entries = []
+        if not container_exists:
+            target_type = Consts.RESOURCE_NO_CONTAINER
+        else:
+            try:
+                entries = json.loads(body)
+            except (TypeError, ValueError):
+                return None, None
+            index = env.get('cdmi.hierarchy_index')
+            if index is not None:
+                # The listing starts at the target, it does not hold all
+                # the names of the parent
+                index.add_listing(ctx.account_name, ctx.container_name,
+                                  ctx.parent_name, entries, False)
+            target_type = Consts.RESOURCE_MISSING
+            # The listing is sorted, once an entry sorts after the subdir
+            # of the target, all there is to know about the target is seen.
+            complete = len(entries) < self.target_listing_limit
+            # Swift lists the names decoded, so is the target compared
+            uname = name.decode('utf-8')
+            for entry in entries:
+                entry_name = entry.get('name') or entry.get('subdir') or ''
+                if entry.get('name') == uname:
+                    content_type = (entry.get('content_type') or '').lower()
+                    if content_type.find('application/directory') < 0:
+                        target_type = Consts.RESOURCE_OBJECT
+                    else:
+                        target_type = Consts.RESOURCE_DIRECTORY
+                    complete = True
+                    break
+                elif entry.get('subdir') == uname + '/':
+                    target_type = Consts.RESOURCE_VIRTUAL
+                    complete = True
+                    break
+                elif entry_name > uname + '/':
+                    complete = True
+                    break
+            if not complete:
+                # Too many names sort between the marker and the target,
+                # check the target on its own.
+                target_type = self._get_resource_type(env, name)
+                if target_type is None:
+                    return None, None
+        self._set_cached_type(env, name, target_type)
+
+        if not ctx.parent_name:
+            if target_type == Consts.RESOURCE_NO_CONTAINER:
+                return target_type, Consts.RESOURCE_NO_CONTAINER
+            return target_type, Consts.RESOURCE_DIRECTORY
+        if parent_type is not None:
+            return target_type, parent_type
+
+        exists, headers, body = parent.wait()
+        cacheable = not exists or body is not None
+        if exists:
+            content_type = (headers.get('content-type') or '').lower()
+            if content_type.find('application/directory') < 0:
+                parent_type = Consts.RESOURCE_OBJECT
+            else:
+                parent_type = Consts.RESOURCE_DIRECTORY
+        elif target_type == Consts.RESOURCE_NO_CONTAINER:
+            parent_type = Consts.RESOURCE_NO_CONTAINER
+        elif entries:
+            parent_type = Consts.RESOURCE_VIRTUAL
+        else:
+            dummy, has_children = self._probe_children(env,
+                                                       ctx.parent_name)
+            if has_children is None:
+                return target_type, None
+            elif has_children:
+                parent_type = Consts.RESOURCE_VIRTUAL
+            else:
+                parent_type = Consts.RESOURCE_MISSING
+        if cacheable:
+            self._set_cached_type(env, ctx.parent_name, parent_type)
+        return target_type, parent_type
+
+    def _get_parent_error(self, resource_type):
+        """
+        This method returns the error for a parent of the given type, or
+        None when the parent is a valid container.
+        """
+        if resource_type is None:
+            return get_err_response('InconsistantState')
+        elif resource_type == Consts.RESOURCE_OBJECT:
+            return get_err_response('InvalidContainerName')
+        elif resource_type in (Consts.RESOURCE_MISSING,
+                               Consts.RESOURCE_NO_CONTAINER):
+            # No children under or the root container does not even
+            # exist, this is an error
+            return get_err_response('NoParentContainer')
+        return None
+
     def _check_parent(self, env, start_response):
         """
         This method checks if the parent really represents a directory.
@@ -71,44 +711,59 @@ class CDMIBaseController(Controller):
         to a non directory. Returns None means that the parent points to a
         valid container (top container or virtual container)
         """
-        if self.parent_name:
-            # Try to hit the resource url and see if it exists
-            path = '/' + concat_parts('v1', self.account_name,
-                                      self.container_name, self.parent_name)
-            exists, headers, dummy = check_resource(env, 'GET',
-                                                    path, self.logger)
-            if exists:
-                content_type = str(headers.get('content-type', ''))
-                if content_type.find('application/directory') < 0:
-                    return get_err_response('InvalidContainerName')
-                else:
-                    return None
-            else:
-                # Check if there is anything below that parent, if it is,
-                # then this is actually a virtual container.
-                path = '/' + concat_parts('v1', self.account_name,
-                                          self.container_name)
-                query_string = 'delimiter=/&prefix=' + self.parent_name + '/'
-                parent_exists, dummy, body = check_resource(env, 'GET', path,
-                                                            self.logger, True,
-                                                            query_string)
-                if parent_exists:
-                    try:
-                        children = json.loads(body)
-                        if len(children) <= 0:
-                            # No children under, no resource exist
-                            return get_err_response('NoParentContainer')
-                        else:
-                            return None
-                    except ValueError:
-                        return get_err_response('InconsistantState')
-                # The root container does not event exist, this is an error
-                else:
-                    return get_err_response('NoParentContainer')
+        ctx = env['cdmi.context']
+        if ctx.parent_name:
+            return self._get_parent_error(
+                self._get_resource_type(env, ctx.parent_name))
 
         return None
 
-    def _check_resource_attribute(self, env, start_response):
+    def _check_object_target(self, env, start_response):
+        """
+        This method checks if a data object can be written at the request
+        path. The target must not be a directory nor a virtual container and
+        its parent must be a valid container. Returns error if the object
+        can not be written, None otherwise.
+        """
+        resource_type, parent_type = self._resolve_write_target(env)
+        if resource_type is None:
+            return get_err_response('InconsistantState')
+        elif resource_type in (Consts.RESOURCE_DIRECTORY,
+                               Consts.RESOURCE_VIRTUAL):
+            return get_err_response('Conflict')
+        elif resource_type == Consts.RESOURCE_NO_CONTAINER:
+            return get_err_response('NoParentContainer')
+
+        # Check if the parent is OK. it should be either a real directory or
+        # a virtual directory
+        return self._get_parent_error(parent_type)
+
+    def _check_container_target(self, env, start_response):
+        """
+        This method checks if a container can be created or updated at the
+        request path. An existing directory can be updated, an existing
+        data object can not be turned into a container and a new container
+        needs a valid parent. A top container has no parent to check, Swift
+        creates or updates it as requested. Returns error if the container
+        can not be written, None otherwise.
+        """
+        ctx = env['cdmi.context']
+        if not ctx.object_name:
+            return None
+
+        resource_type, parent_type = self._resolve_write_target(env)
+        if resource_type == Consts.RESOURCE_OBJECT:
+            return get_err_response('Conflict')
+        elif resource_type == Consts.RESOURCE_DIRECTORY:
+            return None
+        elif not ctx.parent_name:
+            # Right in the top container, Swift tells if it exists
+            return None
+        # Not a top container, so it has to be virtual container
+        return self._get_parent_error(parent_type)
+
+    def _check_resource_attribute(self, env, start_response,
+                                  get_children=True):
         """
         This method checks if a given url points to either a container, or
         an object or does not exist. It will also check if a resource is a
@@ -120,57 +775,122 @@ class CDMIBaseController(Controller):
         False
         headers - if the resource exists, this holds the headers
         children - if it is a container, return container's child list
+        When get_children is False, the child list is not fetched, only
+        whether there is anything under the resource is checked.
         """
+        ctx = env['cdmi.context']
         path = env['PATH_INFO']
         res, is_container, headers, children = None, False, {}, None
-        exists, headers, dummy = check_resource(env, 'GET', path, self.logger)
+        name = concat_parts(ctx.parent_name, ctx.object_name)
+        resource_type = None
+        if ctx.object_name:
+            resource_type = self._get_cached_type(env, name)
+            # Known not to exist, no need to check anything
+            if resource_type in (Consts.RESOURCE_MISSING,
+                                 Consts.RESOURCE_NO_CONTAINER):
+                return get_err_response('NoSuchKey'), False, {}, None
+
+        # The children are listed with a delimiter, only the names right
+        # under the resource are returned.
+        listing_path = '/' + concat_parts('v1', ctx.account_name,
+                                          ctx.container_name)
+        query_string = 'delimiter=/'
+        limit = self.listing_limit
+        if get_children:
+            limit = self._get_first_page_limit(env)
+            if limit < self.listing_limit:
+                query_string += '&limit=%d' % limit
+        if ctx.object_name:
+            query_string += ('&prefix=' + name + '/')
+
+        # A known virtual container does not exist as a resource
+        cacheable = True
+        if resource_type == Consts.RESOURCE_VIRTUAL:
+            exists, headers = False, {}
+        elif get_children and not ctx.object_name:
+            # The listing of a top container also carries the headers of
+            # the container, a single request tells both.
+            exists, headers, body = self._check_resource(
+                env, 'GET', listing_path, True, query_string)
+            cacheable = not exists or body is not None
+        else:
+            if get_children:
+                # The children are listed while the resource is checked,
+                # the listing below then gets the result of this one.
+                pool = GreenPool()
+                pool.spawn(self._check_resource, env, 'GET', listing_path,
+                           True, query_string)
+                head = pool.spawn(self._check_resource, env, 'HEAD', path)
+                pool.waitall()
+                exists, headers, body = head.wait()
+            else:
+                exists, headers, body = self._check_resource(env, 'HEAD',
+                                                             path)
+            # A failed check must not be shared with other requests
+            cacheable = not exists or body is not None
         # If exists, we need to check if the resource is a container
         if exists:
             content_type = (headers.get('content-type') or '').lower()
             if (content_type.find('application/directory') < 0 and
-                self.object_name):
+                ctx.object_name):
                 is_container = False
+                resource_type = Consts.RESOURCE_OBJECT
             else:
                 is_container = True
-        # None self.object_name means that we are dealing with a real OS
+                resource_type = Consts.RESOURCE_DIRECTORY
+        # None ctx.object_name means that we are dealing with a real OS
         # container, return resource not found error
-        elif not self.object_name:
+        elif not ctx.object_name:
             res = get_err_response('NoSuchKey')
 
         if res is None and (not exists or is_container):
             # Now we will try to get the children of the container and also
             # do more checks to see if there is any virtual resources.
-            path = '/' + concat_parts('v1', self.account_name,
-                                      self.container_name)
-            query_string = 'delimiter=/'
-            if self.object_name:
-                query_string += ('&prefix=' +
-                                 concat_parts(self.parent_name,
-                                              self.object_name) +
-                                 '/')
-
-            container_exists, dummy, body = check_resource(env, 'GET', path,
-                                                           self.logger, True,
-                                                           query_string)
-            if container_exists:
-                try:
-                    children = json.loads(body)
-                    no_of_children = len(children)
-                    # The entity could be a virtual container since it
-                    # does not exist
-                    if not exists:
-                        # There is no children under also not exists,
-                        # it is not virtual container.
-                        if no_of_children <= 0:
-                            res = get_err_response('NoSuchKey')
-                        # There are children under and not exist, it is
-                        # a virtual container
-                        elif no_of_children > 0 and not exists:
-                            is_container = True
-                except ValueError:
-                    res = get_err_response('InconsistantState')
+            if get_children:
+                container_exists, dummy, body = \
+                    self._check_resource(env, 'GET', listing_path, True,
+                                         query_string)
+                if container_exists:
+                    try:
+                        children = load_listing(body)
+                        has_children = len(children) > 0
+                    except ValueError:
+                        has_children = None
+                    index = env.get('cdmi.hierarchy_index')
+                    if has_children is not None and index is not None:
+                        index.add_listing(ctx.account_name,
+                                          ctx.container_name, name,
+                                          children,
+                                          len(children) < limit)
+            elif not exists:
+                container_exists, has_children = \
+                    self._probe_children(env, name)
             else:
+                # An existing directory, nothing more to check
+                container_exists, has_children = True, False
+
+            if not container_exists:
                 res = get_err_response('NoSuchKey')
+                resource_type = Consts.RESOURCE_NO_CONTAINER
+            elif has_children is None:
+                res = get_err_response('InconsistantState')
+                resource_type = None
+            # The entity could be a virtual container since it
+            # does not exist
+            elif not exists:
+                # There is no children under also not exists,
+                # it is not virtual container.
+                if not has_children:
+                    res = get_err_response('NoSuchKey')
+                    resource_type = Consts.RESOURCE_MISSING
+                # There are children under and not exist, it is
+                # a virtual container
+                else:
+                    is_container = True
+                    resource_type = Consts.RESOURCE_VIRTUAL
+
+        if ctx.object_name and resource_type and cacheable:
+            self._set_cached_type(env, name, resource_type)
 
         return res, is_container, headers, children
 
@@ -184,8 +904,8 @@ class CDMIBaseController(Controller):
         the request body and the mimetype being the content type
         '''
         body = {}
-        req = Request(env)
-        content_type = (req.headers['Content-Type'] or '').lower()
+        req = env['cdmi.context'].request
+        content_type = env['cdmi.context'].content_type
         # multipart
         if content_type.find('multipart/mixed') >= 0:
             try:
@@ -231,6 +951,7 @@ class CDMIBaseController(Controller):
         a large data object upload. inspect the headers such as
         X-Object-UploadID, X-CDMI-Partial, Content-Range
         '''
+        ctx = env['cdmi.context']
 
         try:
             upload_id = env.get('HTTP_X_CDMI_UPLOADID')
@@ -239,20 +960,20 @@ class CDMIBaseController(Controller):
             if upload_id and cdmi_partial:
                 start, end = self._get_range(content_range)
                 if start:
-                    new_name = self.object_name + '_segments/'
+                    new_name = ctx.object_name + '_segments/'
                     new_name += upload_id + '/' + start
                     new_name += '-' + end if end else ''
                     env['PATH_INFO'] = \
-                        '/v1/' + concat_parts(self.account_name,
-                                              self.container_name,
-                                              self.parent_name, new_name)
+                        '/v1/' + concat_parts(ctx.account_name,
+                                              ctx.container_name,
+                                              ctx.parent_name, new_name)
 
                 if cdmi_partial.find('false') >= 0:
-                    new_name = self.object_name + '_segments/' + upload_id
+                    new_name = ctx.object_name + '_segments/' + upload_id
                     new_name += '/'
                     env['HTTP_X_OBJECT_MANIFEST'] = \
-                        concat_parts(self.container_name,
-                                     self.parent_name, new_name)
+                        concat_parts(ctx.container_name,
+                                     ctx.parent_name, new_name)
                     #only when there is a content and cdmi_partial is false
                     #two requests are needed
                     if start:
@@ -265,11 +986,12 @@ class CDMIBaseController(Controller):
         '''
         This method will send the manifest request
         '''
+        ctx = env['cdmi.context']
         if env.get('HTTP_X_OBJECT_MANIFEST'):
-            path = '/v1/' + concat_parts(self.account_name,
-                                        self.container_name,
-                                        self.parent_name,
-                                        self.object_name)
+            path = '/v1/' + concat_parts(ctx.account_name,
+                                        ctx.container_name,
+                                        ctx.parent_name,
+                                        ctx.object_name)
             extra_header = {}
             extra_header['X-OBJECT-MANIFEST'] = \
                 env.get('HTTP_X_OBJECT_MANIFEST')
@@ -305,53 +1027,180 @@ class CDMICommonController(CDMIBaseController):
     extended the controllers will handle other operations.
     """
 
-    def _read_object(self, env, start_response, headers):
+    def _iter_value_range(self, env, first, last, etag=None):
+        """
+        Yields a range of the value of the object read by the request, the
+        range is only asked to Swift once the first chunk is needed. The
+        range has to come from the object with the given ETag, when the
+        object changed or the range is not served, the response which is
+        already under way is aborted.
+        """
+        headers = {'Range': 'bytes=%d-%d' % (first, last)}
+        if etag:
+            headers['If-Match'] = etag
+        if env.get('HTTP_X_AUTH_TOKEN'):
+            headers[Consts.AUTH_TOKEN] = get_auth_token(env)
+        req = make_subrequest(env, 'GET', env['PATH_INFO'], headers)
+        res = req.get_response(self.app)
+        if res.status_int != 206:
+            if hasattr(res.app_iter, 'close'):
+                res.app_iter.close()
+            self.logger.error('CDMI read of bytes %d-%d of %s failed: %s' %
+                              (first, last, env['PATH_INFO'], res.status))
+            raise IOError('Range %d-%d not served' % (first, last))
+        try:
+            for chunk in res.app_iter:
+                yield chunk
+        finally:
+            if hasattr(res.app_iter, 'close'):
+                res.app_iter.close()
 
+    def _get_object_etag(self, env, headers):
+        """ Returns the parts of the etag of the CDMI form of an object """
+        return [env['cdmi.context'].cdmi_version, headers.get('etag'),
+                headers.get('x-timestamp')]
+
+    def _get_value_specs(self, env):
+        """
+        Returns the ranges of the value a read asks for. Parts of the value
+        can be asked for with the CDMI field syntax, such as ?value:0-99,
+        with ?value:bytes=0-99 or, for CDMI reads, with a Range header.
+        Several ranges are separated by commas. The query string is left
+        with the parameters Swift should see.
+        """
+        ctx = env['cdmi.context']
+        specs = list(ctx.fields.get('value') or [])
         query_string = env.get('QUERY_STRING', '')
         if len(query_string) > 0:
-            params = parse_qs(query_string, True, False)
             new_qs = ''
-            for key, value in params.items():
-                if 'value:bytes' == key.lower():
-                    env['HTTP_RANGE'] = 'bytes=' + ''.join(value)
-                else:
-                    new_qs += key + '=' + ''.join(value) + '&'
+            for key, value in parse_qsl(query_string, True, False):
+                if key.lower() == 'value:bytes':
+                    specs.append(value)
+                elif value != '':
+                    new_qs += key + '=' + value + '&'
             env['QUERY_STRING'] = new_qs
+        if (ctx.cdmi_version and not specs and ctx.range and
+            ctx.range.startswith('bytes=')):
+            specs.append(ctx.range[6:])
+        return specs
+
+    def _read_object_once(self, env, start_response, specs):
+        """
+        Read a data object with a single request to Swift. Whether the path
+        is a data object is told by the headers of the response, which is
+        then streamed into the body. Only when nothing is found, the path
+        is checked for a virtual container.
+        """
+        ctx = env['cdmi.context']
+        name = concat_parts(ctx.parent_name, ctx.object_name)
+        resource_type = self._get_cached_type(env, name)
+        if resource_type in (Consts.RESOURCE_MISSING,
+                             Consts.RESOURCE_NO_CONTAINER):
+            return get_err_response('NoSuchKey')
+        elif resource_type in (Consts.RESOURCE_VIRTUAL,
+                               Consts.RESOURCE_DIRECTORY):
+            return get_err_response('Conflict')
+
+        if specs:
+            env['HTTP_RANGE'] = 'bytes=' + ','.join(specs)
+        os_res = ctx.request.get_response(self.app)
 
-        req = Request(env)
-        os_res = req.get_response(self.app)
+        headers = {}
+        for header, value in os_res.headers.iteritems():
+            headers[header.lower()] = value
+        is_directory = (os_res.status_int // 100 == 2 and
+                        headers.get('content-type', '').lower().find(
+                            'application/directory') >= 0)
+        if os_res.status_int == 404 or is_directory:
+            # The body of the response is not used
+            if hasattr(os_res.app_iter, 'close'):
+                os_res.app_iter.close()
+
+        if os_res.status_int == 404:
+            # Nothing there, it could still be a virtual container
+            container_exists, has_children = self._probe_children(env, name)
+            if not container_exists:
+                resource_type = Consts.RESOURCE_NO_CONTAINER
+                res = get_err_response('NoSuchKey')
+            elif has_children is None:
+                return get_err_response('InconsistantState')
+            elif has_children:
+                resource_type = Consts.RESOURCE_VIRTUAL
+                res = get_err_response('Conflict')
+            else:
+                resource_type = Consts.RESOURCE_MISSING
+                res = get_err_response('NoSuchKey')
+            self._set_cached_type(env, name, resource_type)
+            return res
+        elif is_directory:
+            self._set_cached_type(env, name, Consts.RESOURCE_DIRECTORY)
+            return get_err_response('Conflict')
+        elif os_res.status_int // 100 != 2:
+            # Only a data object is read as one, any other answer of Swift
+            # is the answer to the read
+            if not ctx.cdmi_version:
+                return os_res
+            return get_swift_err_response(os_res)
+
+        self._set_cached_type(env, name, Consts.RESOURCE_OBJECT)
+        return self._read_object(env, start_response, headers, specs, os_res)
+
+    def _read_object(self, env, start_response, headers, specs,
+                     os_res=None):
+        ctx = env['cdmi.context']
 
-        cdmi_version = env.get('HTTP_X_CDMI_SPECIFICATION_VERSION', False)
         # If this is not a CDMI content request, simply return the response
-        if not cdmi_version:
+        if not ctx.cdmi_version:
+            if os_res is None:
+                if specs:
+                    env['HTTP_RANGE'] = 'bytes=' + ','.join(specs)
+                os_res = ctx.request.get_response(self.app)
+            # The same URL gives the CDMI representation with the header
+            os_res.vary = ('Accept', Consts.CDMI_VERSION)
             return os_res
 
+        ranges = None
+        if specs:
+            # Only the bytes asked for are read from Swift, the ranges are
+            # resolved against the size of the object first.
+            try:
+                ranges = get_value_ranges(','.join(specs),
+                                          int(headers.get('content-length')))
+            except (TypeError, ValueError):
+                return get_err_response('InvalidRange')
+            if not ranges or len(ranges) > self.max_value_ranges:
+                return get_err_response('InvalidRange')
+            env['HTTP_RANGE'] = 'bytes=%d-%d' % ranges[0]
+            # The ranges were resolved against this very object, each
+            # range has to come from it
+            if headers.get('etag'):
+                env['HTTP_IF_MATCH'] = headers['etag']
+
         # For CDMI content request, more work need to be done.
         res = Response()
         # Set up CDMI required headers
         res.headers[Consts.CDMI_VERSION] = Consts.CDMI_VERSION_VALUE
         res.headers['Content-Type'] = Consts.CDMI_APP_OBJECT
 
-        object_body = os_res.body
         # Build the response message body according to CDMI specification
         body = {}
 
         # Setup required attributes for response body
         body['objectType'] = Consts.CDMI_APP_OBJECT
-        body['objectName'] = self.object_name
+        body['objectName'] = ctx.object_name
 
-        if self.parent_name != '':
+        if ctx.parent_name != '':
             body['parentURI'] = '/'.join(['', self.cdmi_root,
-                                          self.account_name,
-                                          self.container_name,
-                                          self.parent_name, ''])
+                                          ctx.account_name,
+                                          ctx.container_name,
+                                          ctx.parent_name, ''])
         else:
             body['parentURI'] = '/'.join(['', self.cdmi_root,
-                                          self.account_name,
-                                          self.container_name, ''])
+                                          ctx.account_name,
+                                          ctx.container_name, ''])
 
         body['capabilitiesURI'] = '/'.join(['', self.cdmi_root,
-                                            self.account_name,
+                                            ctx.account_name,
                                             self.cdmi_capability_id,
                                             'dataobject/'])
 
@@ -359,126 +1208,322 @@ class CDMICommonController(CDMIBaseController):
         body['metadata'] = {}
 
         # Handling CDMI metadata
-        body['metadata'] = self._process_metadata(headers)
+        body['metadata'] = self._process_metadata(env, headers)
         body['mimetype'] = headers.get('content-type', '')
         encoding = headers.get(Consts.VALUE_ENCODING, '7BIT')
         body['valuetransferencoding'] = encoding
-        if (encoding.lower() == Consts.ENCODING_BASE64 or
-            'text/' not in body['mimetype']):
+        is_base64 = (encoding.lower() == Consts.ENCODING_BASE64 or
+                     'text/' not in body['mimetype'])
+        if is_base64:
             body['valuetransferencoding'] = Consts.ENCODING_BASE64
-            body['value'] = base64.encodestring(object_body).strip('\n')
+
+        # The value and the metadata only change with the ETag and the
+        # timestamp of the object, so a client which already has them gets
+        # a 304 before the value is read. A multipart body differs at every
+        # read by its boundary, it gets no validators.
+        if (ctx.accept.find('multipart/') < 0 and
+            not (ranges and len(ranges) > 1)):
+            if self._check_not_modified(env, res, self._get_object_etag(
+                    env, headers), headers.get('last-modified')):
+                return res
+
+        # Without the value, everything comes from the headers of the
+        # check which was already done, the object is not read.
+        if not self._wants_field(env, 'value'):
+            size = int(headers.get('content-length') or 0)
+            body['valuerange'] = '0-' + str(size - 1)
+            res.body = json.dumps(self._select_fields(env, body), indent=2)
+            return res
+
+        if os_res is None:
+            os_res = ctx.request.get_response(self.app)
+            if os_res.status_int // 100 != 2:
+                return get_swift_err_response(os_res)
+        size = os_res.content_length
+        if ranges is not None and os_res.status_int == 206:
+            # The ranges are exact, the whole size is told as metadata
+            total = int(headers.get('content-length'))
+            body['metadata']['cdmi_size'] = str(total)
+            body['valuerange'] = ','.join(['%d-%d' % (first, last)
+                                           for first, last in ranges])
+            values = [(first, last, last - first + 1) for first, last in
+                      ranges]
+            size = values[0][2]
         else:
-            body['value'] = object_body
-        body['valuerange'] = '0-' + str(len(object_body) - 1)
-        if env.get('HTTP_ACCEPT', '').find('multipart/') >= 0:
-            # It is a multipart request, we need to make up the body
+            ranges = None
+
+        if ctx.accept.find('multipart/') >= 0 or (ranges and
+                                                  len(ranges) > 1):
+            # It is a multipart request or several ranges are asked for,
+            # each range of the value goes in its own part right after the
+            # part holding the rest of the body.
+            if ranges is None:
+                if size is None:
+                    value = [os_res.body]
+                    size = len(value[0])
+                else:
+                    value = os_res.app_iter
+                body['valuerange'] = '0-' + str(size - 1)
+                total = size
+                values = [(0, size - 1, size)]
+            # The JSON part tells how the value is encoded in the CDMI
+            # sense, the value parts themselves carry the raw bytes.
+            part_encoding = 'binary'
+            if self.multipart_base64:
+                part_encoding = body['valuetransferencoding']
             boundary = "%.32x" % random.randint(0, 256 ** 16)
-            res.body = '\r\n--' + boundary + '\r\n'
-            res.body += 'Content-Type: application/cdmi-object\r\n\r\n'
-            value = body['value']
-            del body['value']
-            res.body += json.dumps(body, indent=2)
-            res.body += '\r\n--' + boundary + '\r\n'
-            res.body += 'Content-Type: ' + body['mimetype'] + '\r\n'
-            res.body += ('Content-Range: bytes 0-' + str(len(value) - 1) +
-                         '/' + str(len(value)) + '\r\n') 
-            res.body += ('Content-Transfer-Encoding: ' +
-                         body['valuetransferencoding'] + '\r\n\r\n')
-            res.body += value
-            res.body += '\r\n--' + boundary + '--'
+            json_part = json.dumps(self._select_fields(env, body), indent=2)
+            parts = [(['Content-Type: application/cdmi-object'],
+                      [json_part], len(json_part))]
+            for index, (first, last, length) in enumerate(values):
+                if ranges is not None:
+                    value = (self._iter_value_range(
+                        env, first, last, headers.get('etag'))
+                        if index else os_res.app_iter)
+                if self.multipart_base64 and is_base64:
+                    value = iter_base64_value(value, '\n')
+                    length = get_base64_value_length(length, '\n')
+                parts.append((['Content-Type: ' + body['mimetype'],
+                               'Content-Range: bytes %d-%d/%d' %
+                               (first, last, total),
+                               'Content-Transfer-Encoding: ' +
+                               part_encoding],
+                              value, length))
             res.headers['Content-Type'] = ('multipart/mixed;boundary=' +
                                             boundary)
-        else:
-            res.body = json.dumps(body, indent=2)
+            res.app_iter = iter_multipart(boundary, parts)
+            res.content_length = get_multipart_length(boundary, parts)
+            res.status_int = os_res.status_int
+            return res
+
+        # When Swift tells the size of the value, the value is streamed
+        # from Swift into the response, so it is never held in memory.
+        if size is not None and os_res.status_int // 100 == 2:
+            if ranges is None:
+                body['valuerange'] = '0-' + str(size - 1)
+            head, tail = get_json_envelope(self._select_fields(env, body))
+            if is_base64:
+                res.app_iter = chain([head],
+                                     iter_base64_value(os_res.app_iter),
+                                     [tail])
+                res.content_length = (len(head) + len(tail) +
+                                      get_base64_value_length(size))
+            else:
+                # The length of the escaped text is only known once the
+                # text is read, the response is sent chunked and a HEAD,
+                # which does not read the text, gets no length either.
+                res.app_iter = chain([head],
+                                     iter_text_value(os_res.app_iter),
+                                     [tail])
             res.status_int = os_res.status_int
+            return res
+
+        object_body = os_res.body
+        if is_base64:
+            body['value'] = base64.encodestring(object_body).strip('\n')
+        else:
+            body['value'] = object_body
+        body['valuerange'] = '0-' + str(len(object_body) - 1)
+        res.body = json.dumps(self._select_fields(env, body), indent=2)
+        res.status_int = os_res.status_int
 
         return res
 
     def _read_container(self, env, start_response, headers, children):
+        ctx = env['cdmi.context']
 
         # Build the response message body according to CDMI specification
         res = Response()
         res.headers['content-type'] = 'application/json; charset=UTF-8'
+        if ctx.cdmi_version:
+            res.headers[Consts.CDMI_VERSION] = Consts.CDMI_VERSION_VALUE
 
         body = {}
 
         # Setup required attributes for response body
         body['objectType'] = Consts.CDMI_APP_CONTAINER
-        if self.object_name:
-            body['objectName'] = self.object_name + '/'
-            if self.parent_name != '':
+        if ctx.object_name:
+            body['objectName'] = ctx.object_name + '/'
+            if ctx.parent_name != '':
                 body['parentURI'] = '/'.join(['', self.cdmi_root,
-                                          self.account_name,
-                                          self.container_name,
-                                          self.parent_name, ''])
+                                          ctx.account_name,
+                                          ctx.container_name,
+                                          ctx.parent_name, ''])
             else:
                 body['parentURI'] = '/'.join(['', self.cdmi_root,
-                                          self.account_name,
-                                          self.container_name, ''])
+                                          ctx.account_name,
+                                          ctx.container_name, ''])
         else:
-            body['objectName'] = self.container_name + '/'
+            body['objectName'] = ctx.container_name + '/'
             body['parentURI'] = '/'.join(['', self.cdmi_root,
-                                          self.account_name, ''])
+                                          ctx.account_name, ''])
 
         body['capabilitiesURI'] = '/'.join(['', self.cdmi_root,
-                                            self.account_name,
+                                            ctx.account_name,
                                             self.cdmi_capability_id,
                                             'container/'])
-        body['completionStatus'] = 'Complete'
         body['metadata'] = {}
 
         #Get CDMI metadata from the header and add to the body
         for header, value in headers.iteritems():
             key = header.lower()
-            if key.startswith(self.metadata_prefix):
+            if key.startswith(ctx.metadata_prefix):
                 key, value = get_pair_from_header(value)
                 if key != '' and value != '':
                     body['metadata'][key] = value
+        # Swift tells the size of a top container in its headers, so every
+        # read gets it, whatever fields it selects
+        if 'x-container-bytes-used' in headers:
+            body['metadata']['cdmi_size'] = headers['x-container-bytes-used']
+        if 'x-container-object-count' in headers:
+            body['metadata']['cdmi_objectcount'] = \
+                headers['x-container-object-count']
 
-        body['children'] = []
-        if children:
-            string_to_cut = concat_parts(self.parent_name, self.object_name)
-            size = len(string_to_cut)
-            if size > 0:
-                size += 1
-            tracking_device = {}
-            for child in children:
-                if child.get('name', False):
-                    child_name = child.get('name')
-                else:
-                    child_name = child.get('subdir', False)
-                if child_name:
-                    child_name = child_name[size:]
-                    if not child_name.endswith('/'):
-                        content_type = child.get('content_type', '')
-                        if content_type.find('directory') >= 0:
-                            child_name += '/'
-                    if tracking_device.get(child_name) is None:
-                        tracking_device[child_name] = child_name
-                        body['children'].append(child_name)
-        if body['children'] == []:
-            body['childrenRange'] = ''
+        # The children come last, followed by the fields which are only
+        # known once all the children are read.
+        metadata = body.pop('metadata')
+        first, last = self._get_children_range(env)
+        depth = self._get_children_depth(env)
+        limit = self._get_first_page_limit(env)
+        listing = {}
+        if children and depth > 1:
+            # The whole tree is listed without a delimiter
+            name = concat_parts(ctx.parent_name, ctx.object_name)
+            limit = self.listing_limit
+            children = self._get_listing_page(env, name, None, limit, None)
+            if children is None:
+                return get_err_response('InconsistantState')
+            children_iter = iter_json_tree(
+                self._iter_subtree(env, name, children, listing), depth)
+        elif children:
+            children_iter = self._iter_children(
+                env, concat_parts(ctx.parent_name, ctx.object_name),
+                children, limit, first, last, listing)
         else:
-            body['childrenRange'] = '0-' + str(len(body['children']) - 1)
-        res.body = json.dumps(body, indent=2)
+            children_iter = iter([])
+            if children is None and self._wants_field(env, 'childrenRange'):
+                count = self._get_children_count(env)
+                if count is not None:
+                    listing['returned'] = count
+
+        def get_tail():
+            tail = {'metadata': metadata, 'completionStatus': 'Complete'}
+            if listing.get('error'):
+                # The body is already under way, it ends with the children
+                # read so far, which the children range tells, and with a
+                # completion status telling they are not all of them.
+                self.logger.error('CDMI listing of %s failed after %d '
+                                  'children' % (ctx.request.path,
+                                                listing['returned']))
+                tail['completionStatus'] = Consts.LISTING_INCOMPLETE
+            if 'count' in listing:
+                self._set_children_count(env, listing['count'])
+            if listing.get('returned'):
+                tail['childrenRange'] = '%d-%d' % (
+                    first, first + listing['returned'] - 1)
+            else:
+                tail['childrenRange'] = ''
+            # The number of children is told when only some are returned
+            if ctx.fields.get('children') and 'count' in listing:
+                metadata['cdmi_childrencount'] = str(listing['count'])
+            return tail
+
+        def select_tail():
+            tail = self._select_fields(env, get_tail())
+            if listing.get('error'):
+                # An incomplete listing is told even to the reads which
+                # did not ask for the completion status
+                tail['completionStatus'] = Consts.LISTING_INCOMPLETE
+            return tail
+
         res.status_int = 200
+        if not children or len(children) < limit:
+            # The whole listing is in the first page
+            if not self._wants_field(env, 'children'):
+                # Only the number of children is needed
+                for child in children_iter:
+                    pass
+            elif children and depth > 1:
+                body['children'] = json.loads(''.join(children_iter))
+            else:
+                body['children'] = list(children_iter)
+            if listing.get('error'):
+                return get_err_response('InconsistantState')
+            body.update(get_tail())
+            res.body = json.dumps(self._select_fields(env, body), indent=2)
+            # The children of a container change without changing the
+            # headers of the container, so the validators come from the
+            # body.
+            self._check_not_modified(env, res, [ctx.cdmi_version, res.body])
+            return res
 
+        # A listing of several pages is written as it is read, a page at
+        # a time, instead of being held in memory as a whole.
+        if depth > 1:
+            write = iter_json_fields
+        else:
+            write = iter_json_list
+        res.app_iter = write(
+            self._select_fields(env, body),
+            'children' if self._wants_field(env, 'children') else None,
+            children_iter, select_tail)
         return res
 
     def _read_entity(self, env, start_response):
+        ctx = env['cdmi.context']
+        ctx.fields = get_cdmi_fields(env.get('QUERY_STRING'))
+        specs = None
+        if not ctx.wants_container:
+            specs = self._get_value_specs(env)
+            # A data object is read with a single request to Swift. Range
+            # reads first need the size of the object to resolve the
+            # ranges, conditional reads and reads without the value may
+            # not need the value at all, so those check the object first.
+            if ctx.object_name and (not ctx.cdmi_version or (
+                    not specs and self._wants_field(env, 'value') and
+                    'HTTP_IF_NONE_MATCH' not in env and
+                    'HTTP_IF_MODIFIED_SINCE' not in env)):
+                return self._read_object_once(env, start_response, specs)
+        else:
+            try:
+                first, last = self._get_children_range(env)
+            except ValueError:
+                return get_err_response('InvalidRange')
+            try:
+                depth = self._get_children_depth(env)
+            except ValueError:
+                return get_err_response('InvalidArgument')
+            # A range of children is only read from the children right
+            # under the container
+            if depth > 1 and ctx.fields.get('children'):
+                return get_err_response('InvalidArgument')
+        # The children are only read when a container is asked for with
+        # its children
+        get_children = (ctx.wants_container and
+                        self._wants_field(env, 'children', 'childrenRange'))
+        # Without the children, childrenRange only needs their number,
+        # which may be known from an earlier listing of the container.
+        if (get_children and not self._wants_field(env, 'children') and
+                self._get_children_count(env) is not None):
+            get_children = False
+        if get_children and 'cdmi.listing_checkpoints' in env:
+            # What the listing leaves goes under the generation read first
+            self._get_listing_generation(env)
         res, is_container, headers, children = \
-            self._check_resource_attribute(env, start_response)
+            self._check_resource_attribute(env, start_response,
+                                           get_children)
 
         if res is None:
-            if ((is_container and not env.get('X-WANTS-CONTAINER')) or
-                (not is_container and env.get('X-WANTS-CONTAINER'))):
+            if ((is_container and not ctx.wants_container) or
+                (not is_container and ctx.wants_container)):
                 return get_err_response('Conflict')
 
             if is_container:
                 return self._read_container(env, start_response,
                                             headers, children)
             else:
-                return self._read_object(env, start_response, headers)
+                return self._read_object(env, start_response, headers,
+                                         specs)
         else:
             return res
 
@@ -490,32 +1535,38 @@ class CDMICommonController(CDMIBaseController):
         """
         return self._read_entity(env, start_response)
 
+    def HEAD(self, env, start_response):
+        """
+        Handle HEAD of both container and data object. The response is the
+        one a GET gets, with the same headers and validators, its body is
+        dropped when it is sent. The value of a data object is not read,
+        Swift is sent a HEAD as well, while the validators of a container
+        come from its children, which are listed like for a GET. Like the
+        GET, a data object with a text value gets no Content-Length, the
+        length of the escaped text is only known once the text is read.
+        """
+        return self._read_entity(env, start_response)
+
     def DELETE(self, env, start_response):
         """
         Handle DELETE both container and data object removal.
         """
+        ctx = env['cdmi.context']
 
-        path = '/v1/' + self.account_name + '/' + self.container_name
-        query_string = 'delimiter=/'
-        if self.object_name:
-            query_string += '&prefix=' + concat_parts(self.parent_name,
-                                                      self.object_name) + '/'
-        exists, dummy, body = check_resource(env, 'GET', path, self.logger,
-                                             True, query_string)
+        # Only ask if there is anything under, the children themselves are
+        # not needed.
+        exists, has_children = self._probe_children(
+            env, concat_parts(ctx.parent_name, ctx.object_name))
         # Not even the top container exist, so there is no such resource.
         if not exists:
             return get_err_response('NoSuchKey')
         # Top container exists, check if there is anything under.
-        else:
-            try:
-                children = json.loads(body)
-                #there are some children under
-                if len(children) > 0:
-                    return get_err_response('ContainerNotEmpty')
-            except ValueError:
-                return get_err_response('InconsistantState')
+        elif has_children is None:
+            return get_err_response('InconsistantState')
+        elif has_children:
+            return get_err_response('ContainerNotEmpty')
 
-        # Create a new WebOb Request object according to the current request
-        req = Request(env)
         # Now send the request over.
-        return req.get_response(self.app)
+        res = ctx.request.get_response(self.app)
+        self._invalidate_resource_type(env, res, Consts.RESOURCE_MISSING)
+        return res
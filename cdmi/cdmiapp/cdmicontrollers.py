@@ -14,20 +14,189 @@
 # limitations under the License.
 
 from cdmibase import \
-    (Consts, Controller, concat_parts)
+    (Consts, Controller)
 from cdmiutils import \
-    (get_err_response, check_resource)
+    (get_err_response, get_cdmi_fields, iter_json_list)
 from cdmicommoncontroller import \
     (CDMIBaseController)
 from urllib import unquote, quote
-from webob import Request, Response
+from urlparse import parse_qsl
+from webob import Response
 from swift.common.utils import get_logger
 from swift.common.utils import split_path
 from swift.common.bufferedhttp import http_connect_raw
+from swift.common.constraints import ACCOUNT_LISTING_LIMIT
 import json
 import base64
 
 
+class AccountController(CDMIBaseController):
+    """
+    Account controller, handles requests related to user account
+    """
+    # The most containers Swift returns in a single account listing
+    listing_limit = ACCOUNT_LISTING_LIMIT
+
+    def setup_request(self, env, ctx):
+        env['PATH_INFO'] = '/v1/%s' % (ctx.account_name)
+
+    def _get_root_page(self, env, marker, limit):
+        """
+        Returns the response to the request of the page of the account
+        listing which starts after the marker, and the entries of the
+        page, which are None when they can not be read.
+        """
+        req = env['cdmi.context'].request.copy_get()
+        req.headers['Accept'] = Consts.APP_JSON
+        query_string = 'format=json&limit=%d' % limit
+        if marker:
+            query_string += '&marker=' + quote(marker)
+        req.environ['QUERY_STRING'] = query_string
+        res = req.get_response(self.app)
+        if res.status_int == 204:
+            return res, []
+        if res.status_int != 200:
+            return res, None
+        try:
+            return res, json.loads(res.body)
+        except ValueError:
+            return res, None
+
+    def _iter_root_children(self, env, entries, limit, first, last,
+                            listing):
+        """
+        Yields the containers of the account from offset first to last.
+        The entries are the first page of the listing, read with the given
+        limit, the next pages are read with markers as the containers are
+        consumed. When the listing dict holds details, the number of
+        objects and of bytes of each container yielded go in them. The
+        listing dict is also told how many containers were yielded, how
+        many there are when the listing was read to its end, and whether
+        a page could not be read.
+        """
+        details = listing.get('details')
+        listing['returned'] = 0
+        offset = 0
+        while entries is not None:
+            for entry in entries:
+                if offset >= first and (last is None or offset <= last):
+                    listing['returned'] += 1
+                    if details is not None:
+                        details[entry['name'] + '/'] = {
+                            'count': entry.get('count'),
+                            'bytes': entry.get('bytes')}
+                    yield entry['name'] + '/'
+                offset += 1
+            if len(entries) < limit:
+                listing['count'] = offset
+                return
+            if last is not None and offset > last:
+                return
+            limit = self._get_page_limit(offset, last)
+            dummy, entries = self._get_root_page(
+                env, entries[-1]['name'].encode('utf-8'), limit)
+        listing['error'] = True
+
+    def _read_root(self, env, start_response):
+        ctx = env['cdmi.context']
+        ctx.fields = get_cdmi_fields(env.get('QUERY_STRING'))
+        try:
+            first, last = self._get_children_range(env)
+        except ValueError:
+            return get_err_response('InvalidRange')
+        # The containers may be listed from after a given one on
+        marker = dict(parse_qsl(env.get('QUERY_STRING') or '')).get('marker')
+        limit = self._get_page_limit(0, last)
+        res, entries = self._get_root_page(env, marker, limit)
+
+        body = {}
+
+        # Setup required attributes for response body
+        body['objectType'] = Consts.CDMI_APP_CONTAINER
+        body['objectName'] = ctx.account_name + '/'
+        body['parentURI'] = '/'.join(['', self.cdmi_root, ''])
+        body['capabilitiesURI'] = '/'.join(['', self.cdmi_root,
+                                            ctx.account_name,
+                                            self.cdmi_capability_id,
+                                           'rootcontainer/'])
+        metadata = {}
+
+        listing = {}
+        # The number of objects and bytes of the containers are only
+        # given when asked for
+        if ctx.fields and 'childrendetails' in ctx.fields:
+            listing['details'] = {}
+        if res.status_int == 200 and entries is not None:
+            children_iter = self._iter_root_children(
+                env, entries, limit, first, last, listing)
+        else:
+            entries = []
+            children_iter = iter([])
+
+        def get_tail():
+            tail = {'metadata': metadata}
+            if listing.get('error'):
+                # The body is already under way, it ends with the
+                # containers read so far, which the children range tells,
+                # and with a completion status telling they are not all.
+                self.logger.error('CDMI listing of %s failed after %d '
+                                  'children' % (ctx.request.path,
+                                                listing['returned']))
+                tail['completionStatus'] = Consts.LISTING_INCOMPLETE
+            if listing.get('returned'):
+                tail['childrenRange'] = '%d-%d' % (
+                    first, first + listing['returned'] - 1)
+            else:
+                tail['childrenRange'] = ''
+            # The number of children is told when only some are returned
+            if ctx.fields.get('children') and 'count' in listing:
+                metadata['cdmi_childrencount'] = str(listing['count'])
+            if 'details' in listing:
+                tail['childrenDetails'] = listing['details']
+            return tail
+
+        def select_tail():
+            tail = self._select_fields(env, get_tail())
+            if listing.get('error'):
+                # Told even to the reads which did not ask for it
+                tail['completionStatus'] = Consts.LISTING_INCOMPLETE
+            return tail
+
+        if len(entries) < limit:
+            # The whole listing is in the first page
+            body['children'] = list(children_iter)
+            if listing.get('error'):
+                return get_err_response('InconsistantState')
+            body.update(get_tail())
+            res.body = json.dumps(self._select_fields(env, body), indent=2)
+            # The listing tells the containers, the body is what changes
+            if res.status_int == 200:
+                self._check_not_modified(env, res, [res.body])
+            return res
+
+        # A listing of several pages is written as it is read
+        res.app_iter = iter_json_list(
+            self._select_fields(env, body),
+            'children' if self._wants_field(env, 'children') else None,
+            children_iter, select_tail)
+        return res
+
+    # Use GET to retrieve all cdmi containers for a given user
+    def GET(self, env, start_response):
+        """
+        Handle request for container listing of an account
+        """
+        ctx = env['cdmi.context']
+        # if cdmi content, then we return response in cdmi format
+        if ctx.cdmi_version:
+            return self._read_root(env, start_response)
+        else:
+            res = ctx.request.get_response(self.app)
+            # The same URL gives the CDMI representation with the header
+            res.vary = ('Accept', Consts.CDMI_VERSION)
+            return res
+
+
 class ContainerController(CDMIBaseController):
     """
     Handles container request.
@@ -39,26 +208,15 @@ class ContainerController(CDMIBaseController):
         """
         Handle Container update and create request
         """
+        ctx = env['cdmi.context']
 
-        # First check if the resource exists and if it is a directory
-        path = '/' + concat_parts('v1', self.account_name, self.container_name,
-                                  self.parent_name, self.object_name)
-        exists, headers, dummy = check_resource(env, 'GET', path,
-                                                self.logger, False)
-        if exists:
-            content_type = headers.get('content-type', '')
-            content_type = content_type.lower() if content_type else ''
-            if (content_type.find('application/directory') < 0 and
-                self.object_name):
-                return get_err_response('Conflict')
-        # Not a top container, so it has to be virtual container
-        else:
-            res = self._check_parent(env, start_response)
-            if res:
-                return res
+        # First check if the resource is not a data object and that its
+        # parent is either a real or a virtual directory
+        res = self._check_container_target(env, start_response)
+        if res:
+            return res
 
-        # Create a new WebOb Request object according to the current request
-        req = Request(env)
+        req = ctx.request
 
         # We are creating a container, set the content-type to be
         # application/directory
@@ -75,9 +233,9 @@ class ContainerController(CDMIBaseController):
             if metadata:
                 for key in metadata:
                     if metadata[key] == '':
-                        req.headers[self.metadata_prefix + key] = ''
+                        req.headers[ctx.metadata_prefix + key] = ''
                     else:
-                        req.headers[self.metadata_prefix + key] = \
+                        req.headers[ctx.metadata_prefix + key] = \
                             key + ":" + str(metadata[key])
             else:
                 metadata = {}
@@ -87,6 +245,7 @@ class ContainerController(CDMIBaseController):
         req.headers['Content-Length'] = 0
 
         res = req.get_response(self.app)
+        self._invalidate_resource_type(env, res, Consts.RESOURCE_DIRECTORY)
 
         # Deal with the response now.
         # Build the response message body according to CDMI specification
@@ -96,19 +255,19 @@ class ContainerController(CDMIBaseController):
         if res.status_int == 201:
             body = {}
             body['objectType'] = Consts.CDMI_APP_CONTAINER
-            body['objectName'] = (self.object_name + '/') if self.object_name \
-                else (self.container_name + '/')
-            if self.object_name:
+            body['objectName'] = (ctx.object_name + '/') if ctx.object_name \
+                else (ctx.container_name + '/')
+            if ctx.object_name:
                 body['parentURI'] = '/'.join(['', self.cdmi_root,
-                                              self.account_name,
-                                              self.container_name,
-                                              self.parent_name, ''])
+                                              ctx.account_name,
+                                              ctx.container_name,
+                                              ctx.parent_name, ''])
             else:
                 body['parentURI'] = '/'.join(['', self.cdmi_root,
-                                              self.account_name, ''])
+                                              ctx.account_name, ''])
 
             body['capabilitiesURI'] = '/'.join(['', self.cdmi_root,
-                                                self.account_name,
+                                                ctx.account_name,
                                                 self.cdmi_capability_id,
                                                 'container/'])
             body['completionStatus'] = 'Complete'
@@ -131,38 +290,10 @@ class ObjectController(CDMIBaseController):
         """
         Handle Container update and create request
         """
-        # First check if the resource exists and if it is a directory
-        path = '/' + concat_parts('v1', self.account_name, self.container_name,
-                                  self.parent_name, self.object_name)
-        exists, headers, body = check_resource(env, 'GET', path, self.logger,
-                                               False, None)
-        if exists:
-            content_type = headers.get('content-type', '')
-            content_type = content_type.lower() if content_type else ''
-            if content_type.find('application/directory') >= 0:
-                return get_err_response('Conflict')
-        else:
-            path = '/' + concat_parts('v1', self.account_name,
-                                      self.container_name)
-            query_string = 'delimiter=/&prefix=' + \
-                concat_parts(self.parent_name, self.object_name) + '/'
-            parent_exists, dummy, body = check_resource(env, 'GET', path,
-                                                        self.logger, True,
-                                                        query_string)
-            if parent_exists:
-                try:
-                    children = json.loads(body)
-                    if len(children) > 0:
-                        # No children under, no resource exist
-                        return get_err_response('Conflict')
-                except ValueError:
-                    return get_err_response('InconsistantState')
-            else:
-                return get_err_response('NoParentContainer')
-
-        # Check if the parent is OK. it should be either a real directory or
-        # a virtual directory
-        res = self._check_parent(env, start_response)
+        ctx = env['cdmi.context']
+        # Check if the resource is not a directory nor a virtual container
+        # and that its parent is either a real or a virtual directory
+        res = self._check_object_target(env, start_response)
         if res:
             return res
 
@@ -176,7 +307,7 @@ class ObjectController(CDMIBaseController):
         except Exception as ex:
             return get_err_response(ex.message)
 
-        req = Request(env)
+        req = ctx.request
 
         metadata = {}
         if req.body:
@@ -228,19 +359,19 @@ class ObjectController(CDMIBaseController):
         if res.status_int == 201:
             body = {}
             body['objectType'] = Consts.CDMI_APP_OBJECT
-            body['objectName'] = self.object_name
-            if self.parent_name:
+            body['objectName'] = ctx.object_name
+            if ctx.parent_name:
                 body['parentURI'] = '/'.join(['', self.cdmi_root,
-                                          self.account_name,
-                                          self.container_name,
-                                          self.parent_name, ''])
+                                          ctx.account_name,
+                                          ctx.container_name,
+                                          ctx.parent_name, ''])
             else:
                 body['parentURI'] = '/'.join(['', self.cdmi_root,
-                                          self.account_name,
-                                          self.container_name, ''])
+                                          ctx.account_name,
+                                          ctx.container_name, ''])
 
             body['capabilitiesURI'] = '/'.join(['', self.cdmi_root,
-                                               self.account_name,
+                                               ctx.account_name,
                                                self.cdmi_capability_id,
                                                'dataobject/'])
 
@@ -254,4 +385,5 @@ class ObjectController(CDMIBaseController):
         else:
             res.body = ''
 
+        self._invalidate_resource_type(env, res, Consts.RESOURCE_OBJECT)
         return res
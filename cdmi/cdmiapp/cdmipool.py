@@ -0,0 +1,192 @@
+# Copyright (c) 2011 IBM
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module defines the keep-alive connection pool used by the cdmi
+# utility methods and controllers to talk to the proxy server
+
+from eventlet.green.httplib import \
+    (HTTPConnection, HTTPSConnection, HTTPException)
+from eventlet.green import select
+from eventlet.green import socket
+from eventlet.semaphore import Semaphore
+import time
+
+
+class ConnectionPool(object):
+    """
+    A pool of keep-alive HTTP connections keyed by (host, port, ssl).
+    The pool only keeps idle connections, a connection is taken out of the
+    pool while a request is in flight and put back once its response has
+    been fully read. The idle connections are capped by max_idle for each
+    key, the connections in use by max_size over all the keys, a request
+    waits for a connection to be released when max_size are in use, a
+    max_size of 0 sets no cap. Connecting, waiting for a connection and
+    each read of a response time out after timeout seconds. The pool is
+    shared by green threads, since green threads only switch on I/O and
+    the pool never does I/O while changing its lists, no locking is needed
+    besides the cap on the connections in use.
+    """
+
+    def __init__(self, max_idle=10, idle_timeout=60.0, max_size=100,
+                 timeout=60.0):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.max_size = max_size
+        self.timeout = timeout
+        self.slots = Semaphore(max_size) if max_size > 0 else None
+        # (host, port, ssl) -> list of (connection, last used time)
+        self.pools = {}
+        self.in_use = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """ Returns the pool counters """
+        idle = 0
+        for free in self.pools.values():
+            idle += len(free)
+        return {'hits': self.hits, 'misses': self.misses, 'idle': idle,
+                'in_use': self.in_use}
+
+    def _reap(self, free, now):
+        """ Close and drop the connections which have been idle too long """
+        while free and now - free[0][1] > self.idle_timeout:
+            conn, last_used = free.pop(0)
+            conn.close()
+
+    def _is_healthy(self, conn):
+        """
+        An idle keep-alive connection should have nothing to read, if its
+        socket is readable the server has either closed it or sent data
+        nobody asked for, either way the connection can not be reused.
+        """
+        if conn.sock is None:
+            return False
+        try:
+            readable, dummy, dummy = select.select([conn.sock], [], [], 0)
+        except (socket.error, select.error, ValueError):
+            return False
+        return not readable
+
+    def get(self, host, port, ssl=False):
+        """
+        Get an idle connection from the pool or create a new one. Returns
+        the connection and a flag telling if it was reused.
+        """
+        key = (host, str(port), ssl)
+        free = self.pools.setdefault(key, [])
+        self._reap(free, time.time())
+        while free:
+            conn, last_used = free.pop()
+            if self._is_healthy(conn):
+                self.hits += 1
+                return conn, True
+            conn.close()
+        self.misses += 1
+        return self._connect(host, port, ssl), False
+
+    def _connect(self, host, port, ssl):
+        """ Create a new connection """
+        if ssl:
+            return HTTPSConnection('%s:%s' % (host, port),
+                                   timeout=self.timeout)
+        else:
+            return HTTPConnection('%s:%s' % (host, port),
+                                  timeout=self.timeout)
+
+    def put(self, conn, host, port, ssl=False):
+        """ Put a connection back to the pool once it is idle """
+        key = (host, str(port), ssl)
+        free = self.pools.setdefault(key, [])
+        now = time.time()
+        self._reap(free, now)
+        if len(free) >= self.max_idle:
+            conn.close()
+        else:
+            free.append((conn, now))
+
+    def request(self, host, port, ssl, method, path, headers=None,
+                query_string=None, body=None, read_body=True):
+        """
+        Send a request over a pooled connection and read the response.
+        Returns the response and its body. When read_body is False, the
+        body is not read and None is returned for it, the connection is
+        then closed unless the response has no body.
+        A request which fails on a reused connection is retried once on a
+        new connection, since the server may have dropped the idle one.
+        """
+        if query_string:
+            path += '?' + query_string
+        headers = headers or {}
+        if self.slots is not None and not self.slots.acquire(
+                timeout=self.timeout):
+            raise socket.timeout('No connection to %s:%s released in time'
+                                 % (host, port))
+        self.in_use += 1
+        try:
+            return self._request(host, port, ssl, method, path, headers,
+                                 body, read_body)
+        finally:
+            self.in_use -= 1
+            if self.slots is not None:
+                self.slots.release()
+
+    def _request(self, host, port, ssl, method, path, headers, body,
+                 read_body):
+        conn, reused = self.get(host, port, ssl)
+        try:
+            conn.request(method, path, body, headers)
+            res = conn.getresponse()
+        except (socket.error, HTTPException):
+            conn.close()
+            if not reused:
+                raise
+            conn = self._connect(host, port, ssl)
+            try:
+                conn.request(method, path, body, headers)
+                res = conn.getresponse()
+            except (socket.error, HTTPException):
+                conn.close()
+                raise
+
+        length = res.getheader('content-length')
+        has_body = not (method == 'HEAD' or res.status in (204, 304) or
+                        length == '0')
+        if read_body or not has_body:
+            try:
+                res_body = res.read()
+            except (socket.error, HTTPException):
+                conn.close()
+                raise
+            if res.will_close:
+                conn.close()
+            else:
+                self.put(conn, host, port, ssl)
+        else:
+            res_body = None
+            conn.close()
+        return res, res_body
+
+
+def get_conn_pool(env):
+    """
+    Get the connection pool the middleware shares between requests. Without
+    one, a pool which keeps no idle connection is returned so that every
+    connection gets closed once its response is read.
+    """
+    pool = env.get('cdmi.conn_pool')
+    if pool is None:
+        pool = ConnectionPool(max_idle=0)
+    return pool
@@ -17,10 +17,67 @@
 # none-cdmi controllers
 
 from cdmibase import Consts
-from swift.common.bufferedhttp import http_connect_raw, BufferedHTTPConnection
+from cdmipool import get_conn_pool
 from webob import Request, Response
+from eventlet.event import Event
+from urlparse import parse_qsl
+import base64
+import codecs
+import json
+import sys
 
-from eventlet.green.httplib import HTTPConnection
+# Keys of the original request environment which are carried over to the
+# subrequests, so that the downstream app authorizes them as the caller.
+SUBREQUEST_ENV_KEYS = ('REMOTE_USER', 'SCRIPT_NAME', 'SERVER_NAME',
+                       'SERVER_PORT', 'SERVER_PROTOCOL', 'wsgi.url_scheme',
+                       'swift.authorize', 'swift.authorize_override',
+                       'swift.clean_acl', 'swift.cache', 'swift.trans_id',
+                       'keystone.identity', 'HTTP_X_ROLES', 'HTTP_X_ROLE',
+                       'HTTP_X_USER_ID', 'HTTP_X_USER_NAME', 'HTTP_X_USER',
+                       'HTTP_X_TENANT_ID', 'HTTP_X_TENANT_NAME',
+                       'HTTP_X_TENANT', 'HTTP_X_IDENTITY_STATUS')
+
+
+class ProbeCache(object):
+    """
+    Memo of the resource checks done while serving one request. Each check
+    is keyed by (method, path, query string) and runs at most once, the
+    checks asked for while the same check is still in flight, for example
+    by another green thread, wait for its result instead of sending it
+    again. A check done without its body can not serve a check which needs
+    the body, that check is sent again and replaces the former one.
+    """
+
+    def __init__(self):
+        # key -> (body was read, event holding the result)
+        self.entries = {}
+        self.lookups = 0
+        self.hits = 0
+
+    def check(self, key, get_body, func, *args):
+        """
+        Returns the result of the check for the key, calling func with args
+        to do the check if it is not known yet.
+        """
+        self.lookups += 1
+        entry = self.entries.get(key)
+        if entry is not None and (entry[0] or not get_body):
+            self.hits += 1
+            return entry[1].wait()
+
+        event = Event()
+        self.entries[key] = (get_body, event)
+        try:
+            result = func(*args)
+        except Exception:
+            exc_info = sys.exc_info()
+            if self.entries.get(key) is not None and \
+                    self.entries[key][1] is event:
+                del self.entries[key]
+            event.send_exception(*exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        event.send(result)
+        return result
 
 
 def get_err_response(code):
@@ -32,6 +89,8 @@ def get_err_response(code):
     """
 
     error_table = {
+        'Unauthorized':
+            (401, 'Unauthorized'),
         'AccessDenied':
             (403, 'Access denied'),
         'ContainerAlreadyExists':
@@ -83,6 +142,29 @@ def get_err_response(code):
     return resp
 
 
+# The error codes matching the error statuses of the Swift responses
+SWIFT_ERROR_CODES = {401: 'Unauthorized', 403: 'AccessDenied',
+                     404: 'NoSuchKey', 409: 'Conflict',
+                     416: 'InvalidRange'}
+
+
+def get_swift_err_response(res):
+    """
+    Given an error response of Swift, create the matching error response.
+    A status without a matching error code, like a server error, is kept
+    as it is.
+    """
+    if hasattr(res.app_iter, 'close'):
+        res.app_iter.close()
+    code = SWIFT_ERROR_CODES.get(res.status_int)
+    if code is not None:
+        return get_err_response(code)
+    resp = Response()
+    resp.status = res.status
+    resp.body = 'The storage could not serve the request'
+    return resp
+
+
 def get_pair_from_header(whole_value):
     """
     Parse the value of a metadata saved as OpenStack metadata.
@@ -92,60 +174,147 @@ def get_pair_from_header(whole_value):
     return key, value
 
 
+def get_auth_token(env):
+    """
+    Fixup the auth token, for some reason, the auth token padded the user
+    account at the front with a comma. We need to get rid of it, otherwise,
+    the auth token will be considered invalid.
+    """
+    ctx = env.get('cdmi.context')
+    if ctx is not None and ctx.auth_token is not None:
+        return ctx.auth_token
+    key, sep, value = (env.get('HTTP_X_AUTH_TOKEN') or '').partition(',')
+    return value if value != '' else key
+
+
+def make_subrequest(env, method, path, headers=None, query_string=None):
+    """
+    Create a request which can be sent straight to the downstream app.
+    The request carries the identity of the original caller so that the
+    authorization middleware already in the env applies to it as well.
+    """
+    sub_env = {'REQUEST_METHOD': method,
+               'PATH_INFO': path,
+               'QUERY_STRING': query_string or '',
+               'swift.source': 'CDMI'}
+    for key in SUBREQUEST_ENV_KEYS:
+        if key in env:
+            sub_env[key] = env[key]
+    return Request.blank('/', environ=sub_env, headers=headers)
+
+
+def is_authorized(env, path):
+    """
+    Tells if the caller of a request is allowed into a path without any
+    ACL granting it access, as the owner of the account, by asking the
+    authorization middleware already in the env. Without one, everybody
+    is allowed.
+    """
+    authorize = env.get('swift.authorize')
+    if authorize is None:
+        return True
+    return authorize(make_subrequest(env, 'HEAD', path)) is None
+
+
+def _check_resource_subrequest(env, method, path, headers, get_body,
+                               query_string, app):
+    """
+    Dispatch a check_resource request into the downstream app in-process.
+    """
+    req = make_subrequest(env, method, path, headers, query_string)
+    res = req.get_response(app)
+
+    values = {}
+    for header, value in res.headers.iteritems():
+        values[header.lower()] = value
+    if res.status_int == 200 or res.status_int == 204:
+        body = res.body if get_body else ""
+    else:
+        body = None
+    app_iter = res.app_iter
+    if hasattr(app_iter, 'close'):
+        app_iter.close()
+
+    if res.status_int == 404:
+        return False, {}, None
+    return True, values, body
+
+
+def get_marker_before(name):
+    """
+    Returns a listing marker which sorts right before the name, so that a
+    listing starting after the marker shows the name first. The last
+    character of the name is replaced by the character before it followed
+    by the highest unicode character, which sorts after any real name
+    starting the same way. When that can not be done, the name without its
+    last character is returned, which also sorts before the name but may
+    let a few more names in front of it.
+    """
+    try:
+        uname = name.decode('utf-8')
+    except UnicodeDecodeError:
+        return name[:-1]
+    if not uname:
+        return ''
+    code = ord(uname[-1])
+    if 0xD800 <= code <= 0xDFFF:
+        # Half of a surrogate pair on a narrow build
+        return uname[:-2].encode('utf-8')
+    if code <= 1:
+        return uname[:-1].encode('utf-8')
+    code -= 1
+    if 0xD800 <= code <= 0xDFFF:
+        code = 0xD7FF
+    return (uname[:-1] + unichr(code) + u'\U0010ffff').encode('utf-8')
+
+
 def check_resource(env, method, path, logger, get_body=False,
-                   query_string=None):
+                   query_string=None, app=None):
     """
     Use this method to check if a resource already exist.
     If the resource exists, then it should return True with headers.
     If the resource does not exist, then it should return False with None
     headers
     If the get_body is set to True, the response body will also be returned
+    If the app is given, the request is dispatched into the app as a
+    subrequest instead of going through a new connection to the proxy.
     """
 
     # Create a new Request
     req = Request(env)
     ssl = True if req.scheme.lower() == 'https' else False
 
-    # Fixup the auth token, for some reason, the auth token padded the user
-    # account at the front with a comma. We need to get rid of it, otherwise,
-    # the auth token will be considered invalid.
     headers = {}
     if req.headers.get(Consts.AUTH_TOKEN):
-        key, sep, value = req.headers[Consts.AUTH_TOKEN].partition(',')
-        headers[Consts.AUTH_TOKEN] = value if value != '' else key
+        headers[Consts.AUTH_TOKEN] = get_auth_token(env)
     headers['Accept'] = 'application/json'
     method = 'GET' if not method else method
     path = req.path if not path else path
     path = path.rstrip('/')
 
-    conn = http_connect_raw(req.server_name, req.server_port, method, path,
-                            headers, query_string, ssl)
-    res = conn.getresponse()
+    if app is not None:
+        return _check_resource_subrequest(env, method, path, headers,
+                                          get_body, query_string, app)
+
+    res, body = get_conn_pool(env).request(req.server_name, req.server_port,
+                                           ssl, method, path, headers,
+                                           query_string, None, get_body)
 
     if res.status == 404:
-        conn.close()
         return False, {}, None
     elif res.status == 200 or res.status == 204:
         values = {}
         header_list = res.getheaders()
         for header in header_list:
             values[header[0]] = header[1]
-        if get_body:
-            length = res.getheader('content-length')
-            if length:
-                body = res.read(int(length))
-            else:
-                body = res.read()
-        else:
+        if not get_body:
             body = ""
-        conn.close()
         return True, values, body
     else:
         values = {}
         header_list = res.getheaders()
         for header in header_list:
             values[header[0]] = header[1]
-        conn.close()
         return True, values, None
 
 
@@ -159,25 +328,301 @@ def send_manifest(env, method, path, logger, extra_header, get_body=False,
     req = Request(env)
     ssl = True if req.scheme.lower() == 'https' else False
 
-    # Fixup the auth token, for some reason, the auth token padded the user
-    # account at the front with a comma. We need to get rid of it, otherwise,
-    # the auth token will be considered invalid.
-    key, sep, value = req.headers[Consts.AUTH_TOKEN].partition(',')
     headers = {}
-    headers[Consts.AUTH_TOKEN] = value if value != '' else key
+    headers[Consts.AUTH_TOKEN] = get_auth_token(env)
     headers['Content-Length'] = '0'
     extra_header.update(headers)
     path = path.rstrip('/')
 
-    if ssl:
-        conn = HTTPSConnection('%s:%s' % (req.server_name,
-                                          req.server_portport))
+    res, body = get_conn_pool(env).request(req.server_name, req.server_port,
+                                           ssl, 'PUT', path, extra_header,
+                                           None, '')
+
+    return res
+
+
+# base64.encodestring ends a line every 57 bytes of input
+BASE64_LINE_SIZE = 57
+
+
+def get_base64_value_length(size, newline='\\n'):
+    """
+    Returns the length of the base64 value of a body of the given size,
+    see iter_base64_value.
+    """
+    if size <= 0:
+        return 0
+    lines = (size + BASE64_LINE_SIZE - 1) // BASE64_LINE_SIZE
+    return (size + 2) // 3 * 4 + len(newline) * (lines - 1)
+
+
+def iter_base64_value(app_iter, newline='\\n'):
+    """
+    Base64 encode a response body chunk by chunk, the way
+    base64.encodestring encodes the whole body, without the last newline.
+    By default the other newlines are escaped for a JSON string.
+    """
+    pending = ''
+    first = True
+    try:
+        for chunk in app_iter:
+            pending += chunk
+            size = len(pending) - len(pending) % BASE64_LINE_SIZE
+            if size:
+                encoded = base64.encodestring(pending[:size])
+                pending = pending[size:]
+                yield ('' if first else newline) + \
+                    encoded[:-1].replace('\n', newline)
+                first = False
+        if pending:
+            encoded = base64.encodestring(pending)
+            yield ('' if first else newline) + \
+                encoded[:-1].replace('\n', newline)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+def iter_text_value(app_iter):
+    """
+    Escape a UTF-8 response body for a JSON string chunk by chunk, a
+    character split between two chunks is escaped once it is complete.
+    A character cut at the end of the body, as a byte range may do, is
+    replaced by the unicode replacement character.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for chunk in app_iter:
+            text = decoder.decode(chunk)
+            if text:
+                yield json.dumps(text)[1:-1]
+        try:
+            text = decoder.decode('', True)
+        except UnicodeDecodeError:
+            text = u'\ufffd'
+        if text:
+            yield json.dumps(text)[1:-1]
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+def get_json_envelope(body):
+    """
+    Returns the start and the end of the JSON document of a body with a
+    value added last. The value goes in between as a JSON string escaped
+    chunk by chunk, so that it is never held in memory as a whole.
+    """
+    if not body:
+        return '{\n  "value": "', '"\n}'
+    head = json.dumps(body, indent=2)
+    return head[:-2] + ',\n  "value": "', '"\n}'
+
+
+def iter_json_fields(head, name, chunks, get_tail):
+    """
+    Returns, chunk by chunk, the JSON document of the head fields followed
+    by a field of the given name, whose JSON text comes in chunks, and
+    then by the fields get_tail returns once all the chunks are read.
+    Without a name the chunks are read but not written.
+    """
+    document = json.dumps(head, indent=2)[:-2] if head else '{'
+    separator = ',' if head else ''
+    if name is not None:
+        document += '%s\n  %s: ' % (separator, json.dumps(name))
+        separator = ','
+        yield document
+        for chunk in chunks:
+            yield chunk
+        document = ''
     else:
-        conn = BufferedHTTPConnection('%s:%s' % (req.server_name,
-                                                 req.server_port))
+        for chunk in chunks:
+            pass
+    for key, value in get_tail().iteritems():
+        document += '%s\n  %s: %s' % (
+            separator, json.dumps(key),
+            json.dumps(value, indent=2).replace('\n', '\n  '))
+        separator = ','
+    yield document + ('\n}' if separator else '}')
 
-    conn.request('PUT', path, '', extra_header)
 
-    res = conn.getresponse()
+def _iter_json_strings(items, batch_size):
+    chunk = ['[']
+    count = 0
+    for item in items:
+        chunk.append(('\n    ' if count == 0 else ',\n    ') +
+                     json.dumps(item))
+        count += 1
+        if len(chunk) >= batch_size:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append('\n  ]' if count else ']')
+    yield ''.join(chunk)
 
-    return res
+
+def iter_json_list(head, name, items, get_tail, batch_size=1000):
+    """
+    Returns, chunk by chunk, the JSON document of the head fields followed
+    by a list of strings under the given name, written as the items come,
+    and then by the fields get_tail returns once all the items are read.
+    Without a name the items are read but not written.
+    """
+    return iter_json_fields(head, name, _iter_json_strings(items, batch_size),
+                            get_tail)
+
+
+def iter_json_tree(nodes, depth, batch_size=1000):
+    """
+    Returns, chunk by chunk, the JSON text of a tree of children down to
+    the given depth. A child is a name, and a container above the depth
+    is an object with its name and its own children. The nodes are given
+    in the order they are written, each one as the list of the names from
+    the top of the tree to the node and whether the node is a container.
+    The containers of a node are written before it when they were not
+    already, and nodes below the depth are written as their container at
+    the depth, once.
+    """
+    # The names of the containers written as objects and not closed yet,
+    # and how many children each open list holds
+    path = []
+    counts = [0]
+    last = None
+    chunk = ['[']
+
+    def add_item(text):
+        indent = ' ' * (4 * len(path) + 4)
+        chunk.append((',\n' if counts[-1] else '\n') + indent + text)
+        counts[-1] += 1
+
+    def close_container():
+        path.pop()
+        count = counts.pop()
+        indent = ' ' * (4 * len(path) + 4)
+        chunk.append(('\n' + indent + '  ]' if count else ']') +
+                     '\n' + indent + '}')
+
+    for names, is_container in nodes:
+        if len(names) > depth:
+            names, is_container = names[:depth], True
+        if is_container and len(names) < depth:
+            target, leaf = names, None
+        else:
+            target, leaf = names[:-1], names[-1] + ('/' if is_container
+                                                    else '')
+        common = 0
+        while (common < len(path) and common < len(target) and
+               path[common] == target[common]):
+            common += 1
+        while len(path) > common:
+            close_container()
+        for name in target[common:]:
+            indent = ' ' * (4 * len(path) + 6)
+            add_item('{\n%s"name": %s,\n%s"children": [' %
+                     (indent, json.dumps(name + '/'), indent))
+            path.append(name)
+            counts.append(0)
+        if leaf is not None and (target, leaf) != last:
+            add_item(json.dumps(leaf))
+            last = (target, leaf)
+        if len(chunk) >= batch_size:
+            yield ''.join(chunk)
+            chunk = []
+    while path:
+        close_container()
+    chunk.append('\n  ]' if counts[0] else ']')
+    yield ''.join(chunk)
+
+
+def _get_listing_entry(pairs):
+    return dict([(key, value) for key, value in pairs
+                 if key in ('name', 'subdir', 'content_type')])
+
+
+def load_listing(body):
+    """
+    Parses a JSON container listing. Only the name, the subdir and the
+    content type of the entries are kept, the other fields Swift lists
+    are dropped as soon as each entry is parsed.
+    """
+    return json.loads(body, object_pairs_hook=_get_listing_entry)
+
+
+def get_cdmi_fields(query_string):
+    """
+    Returns the fields a CDMI read asks for in the query string, such as
+    ?metadata;valuerange, as a dict of each lower cased field name to the
+    list of its qualifiers, such as 0-99 in value:0-99 or a prefix in
+    metadata:prefix. Parameters with a value, such as value:bytes=0-99,
+    are not fields.
+    """
+    fields = {}
+    for key, value in parse_qsl(query_string or '', True):
+        if key and value == '':
+            name, sep, qualifier = key.partition(':')
+            qualifiers = fields.setdefault(name.lower(), [])
+            if sep:
+                qualifiers.append(qualifier)
+    return fields
+
+
+def get_value_ranges(spec, size):
+    """
+    Parses byte ranges such as 0-99,200-,-50 and returns them as a list of
+    (first, last) pairs within a value of the given size. Ranges starting
+    past the end of the value are left out, a malformed range raises a
+    ValueError.
+    """
+    ranges = []
+    for item in spec.split(','):
+        first, sep, last = item.strip().partition('-')
+        if not sep:
+            raise ValueError(item)
+        if first:
+            first = int(first)
+            last = int(last) if last else max(first, size - 1)
+            if first < 0 or last < first:
+                raise ValueError(item)
+            if first < size:
+                ranges.append((first, min(last, size - 1)))
+        else:
+            # The last bytes of the value
+            length = int(last)
+            if length > 0 and size > 0:
+                ranges.append((max(size - length, 0), size - 1))
+    return ranges
+
+
+def _get_part_head(boundary, headers):
+    return ('\r\n--' + boundary + '\r\n' +
+            ''.join([header + '\r\n' for header in headers]) + '\r\n')
+
+
+def iter_multipart(boundary, parts):
+    """
+    Yields a multipart body part by part. Each part is a tuple of its
+    headers, an iterable of the chunks of its content and the length of
+    the content, the chunks are passed on as they come.
+    """
+    try:
+        for headers, content, length in parts:
+            yield _get_part_head(boundary, headers)
+            for chunk in content:
+                yield chunk
+        yield '\r\n--' + boundary + '--'
+    finally:
+        for headers, content, length in parts:
+            if hasattr(content, 'close'):
+                content.close()
+
+
+def get_multipart_length(boundary, parts):
+    """
+    Returns the length of the body written by iter_multipart, or None
+    when the length of a part is not known.
+    """
+    total = len(boundary) + 6
+    for headers, content, length in parts:
+        if length is None:
+            return None
+        total += len(_get_part_head(boundary, headers)) + length
+    return total
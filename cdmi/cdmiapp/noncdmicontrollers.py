@@ -14,15 +14,14 @@
 # limitations under the License.
 
 from cdmibase import \
-    (Consts, Controller, concat_parts)
+    (Consts, Controller)
 from cdmiutils import \
-    (check_resource, get_err_response)
+    (get_err_response)
 from cdmicommoncontroller import \
     (CDMIBaseController)
 from urllib import unquote
 from swift.common.utils import split_path
-from webob import Request, Response
-import json
+from webob import Response
 
 
 class NonCDMIContainerController(CDMIBaseController):
@@ -34,29 +33,18 @@ class NonCDMIContainerController(CDMIBaseController):
     def PUT(self, env, start_response):
         """ Handle Container update and create request """
 
-        # First check if the resource exists and if it is a directory
-        path = '/' + concat_parts('v1', self.account_name, self.container_name,
-                                  self.parent_name, self.object_name)
-
-        exists, headers, body = check_resource(env, 'GET', path,
-                                               self.logger, False)
-
-        if exists:
-            content_type = headers.get('content-type', '')
-            content_type = content_type.lower() if content_type else ''
-            if (content_type.find('application/directory') < 0 and
-                self.object_name):
-                return get_err_response('Conflict')
-        else:
-            res = self._check_parent(env, start_response)
-            if res:
-                return res
+        # First check if the resource is not a data object and that its
+        # parent is either a real or a virtual directory
+        res = self._check_container_target(env, start_response)
+        if res:
+            return res
 
-        req = Request(env)
+        req = env['cdmi.context'].request
         req.headers['content-type'] = 'application/directory'
         req.headers['content-length'] = '0'
         req.body = ''
         res = req.get_response(self.app)
+        self._invalidate_resource_type(env, res, Consts.RESOURCE_DIRECTORY)
         return res
 
 
@@ -66,43 +54,9 @@ class NonCDMIObjectController(CDMIBaseController):
     def PUT(self, env, start_response):
         """ Handle non-CDMI Object update and create request. """
 
-        # First check if the resource exists and if it is a directory
-        path = '/' + concat_parts('v1', self.account_name, self.container_name,
-                                  self.parent_name, self.object_name)
-
-        exists, headers, body = check_resource(env, 'GET', path, self.logger,
-                                               False, None)
-
-        if exists:
-            content_type = headers.get('content-type', '')
-            content_type = content_type.lower() if content_type else ''
-            if content_type.find('application/directory') >= 0:
-                return get_err_response('Conflict')
-        else:
-            path = '/' + concat_parts('v1', self.account_name,
-                                      self.container_name)
-
-            query_string = 'delimiter=/&prefix=' + \
-                concat_parts(self.parent_name, self.object_name) + '/'
-
-            parent_exists, dummy, body = check_resource(env, 'GET', path,
-                                                        self.logger, True,
-                                                        query_string)
-
-            if parent_exists:
-                try:
-                    children = json.loads(body)
-                    if len(children) > 0:
-                        #No children under, no resource exist
-                        return get_err_response('Conflict')
-                except ValueError:
-                    return get_err_response('InconsistantState')
-            else:
-                return get_err_response('NoParentContainer')
-
-        # Check if the parent is OK. it should be either a real directory
-        # or a virtual directory
-        res = self._check_parent(env, start_response)
+        # Check if the resource is not a directory nor a virtual container
+        # and that its parent is either a real or a virtual directory
+        res = self._check_object_target(env, start_response)
         if res:
             return res
 
@@ -117,7 +71,7 @@ class NonCDMIObjectController(CDMIBaseController):
             return get_err_response('InvalidBody')
         else:
             env['CONTENT_TYPE'] = body.get('mimetype', 'text/plain')
-            req = Request(env)
+            req = env['cdmi.context'].request
             req.body = body.get('value', '')
             req.headers['content-length'] = len(req.body)
             res = req.get_response(self.app)
@@ -125,4 +79,5 @@ class NonCDMIObjectController(CDMIBaseController):
                 env.get('HTTP_X_USE_EXTRA_REQUEST')):
                 extra_res = self._put_manifest(env)
                 res.status_int = extra_res.status
+            self._invalidate_resource_type(env, res, Consts.RESOURCE_OBJECT)
             return res
@@ -328,6 +328,26 @@ class TestCDMIContainer(unittest.TestCase):
                          'application/cdmi-container',
                          'objectType must be application/cdmi-container')
 
+    def test_read_top_container_children_range(self):
+        conn = httplib.HTTPConnection(self.conf.get('auth_host'),
+                                      self.conf.get('access_port'))
+        headers = {'X-Auth-Token': self.auth_token,
+                   'X-CDMI-Specification-Version': '1.0.1',
+                   'Accept': 'application/cdmi-container'}
+        conn.request('GET', (self.access_root + '/' + self.top_container +
+                             '?children:1-5;childrenRange;metadata'),
+                     None, headers)
+        res = conn.getresponse()
+        self.assertEqual(res.status, 200, 'Container read failed')
+        body = json.loads(res.read())
+        conn.close()
+        self.assertEqual(body['children'], [self.child_container + '/'],
+                         'Only the children in the range are returned')
+        self.assertEqual(body['childrenRange'], '1-1',
+                         'The range returned is not correct')
+        self.assertEqual(body['metadata'].get('cdmi_childrencount'), '2',
+                         'The number of children is not correct')
+
     def test_read_top_account_cdmi(self):
         conn = httplib.HTTPConnection(self.conf.get('auth_host'),
                                       self.conf.get('access_port'))
@@ -355,6 +375,26 @@ class TestCDMIContainer(unittest.TestCase):
                          'application/cdmi-container',
                          'objectType must be application/cdmi-container')
 
+    def test_read_top_account_children_details(self):
+        conn = httplib.HTTPConnection(self.conf.get('auth_host'),
+                                      self.conf.get('access_port'))
+        headers = {'X-Auth-Token': self.auth_token,
+                   'X-CDMI-Specification-Version': '1.0.1',
+                   'Accept': 'application/cdmi-container'}
+        conn.request('GET', self.access_root + '/?children;childrenDetails',
+                     None, headers)
+        res = conn.getresponse()
+        self.assertEqual(res.status, 200, "Account read failed")
+        body = json.loads(res.read())
+        conn.close()
+        self.assertIn(self.top_container + '/', body['children'],
+                      'The test container is not listed')
+        details = body['childrenDetails'][self.top_container + '/']
+        self.assertIsNotNone(details['count'],
+                             'No object count found for the container')
+        self.assertIsNotNone(details['bytes'],
+                             'No bytes used found for the container')
+
     def test_read_top_account_non_cdmi(self):
         conn = httplib.HTTPConnection(self.conf.get('auth_host'),
                                       self.conf.get('access_port'))
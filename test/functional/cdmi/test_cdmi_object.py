@@ -22,6 +22,7 @@ from email.MIMEBase import MIMEBase
 import httplib
 import time
 import json
+import email
 import base64
 import os
 
@@ -781,6 +782,118 @@ class TestCDMIObject(unittest.TestCase):
         self.assertIsNotNone(body['objectType'],
                              'Not objectType found which is required.')
 
+    def test_partial_cdmi_read_value_field_object(self):
+        conn = httplib.HTTPConnection(self.conf.get('auth_host'),
+                                      self.conf.get('access_port'))
+        headers = {'X-Auth-Token': self.auth_token,
+                   'X-CDMI-Specification-Version': '1.0.1',
+                   'Accept': 'application/cdmi-object'}
+        conn.request('GET', (self.access_root + '/' + self.top_container +
+                             '/' + self.child_container + '/' +
+                             self.object_test +
+                             '?valuerange;metadata;value:5-10'),
+                     None, headers)
+        res = conn.getresponse()
+        self.assertEqual(res.status, 206, 'Object read failed')
+        data = res.read()
+        try:
+            body = json.loads(data)
+        except Exception as parsing_error:
+            raise parsing_error
+        self.assertEqual('5-10', body['valuerange'],
+                         'The value range should be 5-10')
+        self.assertEqual('16', body['metadata'].get('cdmi_size'),
+                         'The size of the whole value should be 16')
+        self.assertEqual('object', base64.decodestring(body['value']),
+                         'The value should be the asked range')
+
+    def test_partial_cdmi_read_several_ranges_object(self):
+        conn = httplib.HTTPConnection(self.conf.get('auth_host'),
+                                      self.conf.get('access_port'))
+        headers = {'X-Auth-Token': self.auth_token,
+                   'X-CDMI-Specification-Version': '1.0.1',
+                   'Accept': 'multipart/mixed'}
+        conn.request('GET', (self.access_root + '/' + self.top_container +
+                             '/' + self.child_container + '/' +
+                             self.object_test +
+                             '?valuerange;value:0-3;value:12-'),
+                     None, headers)
+        res = conn.getresponse()
+        self.assertEqual(res.status, 206, 'Object read failed')
+        data = res.read()
+        msg = email.message_from_string('Content-Type: ' +
+                                        res.getheader('content-type') +
+                                        '\r\n\r\n' + data)
+        parts = msg.get_payload()
+        self.assertEqual(3, len(parts), 'There should be a part per range')
+        body = json.loads(parts[0].get_payload())
+        self.assertEqual('0-3,12-15', body['valuerange'],
+                         'The value range should tell both ranges')
+        self.assertEqual('bytes 0-3/16', parts[1]['Content-Range'])
+        self.assertEqual('test', parts[1].get_payload())
+        self.assertEqual('bytes 12-15/16', parts[2]['Content-Range'])
+        self.assertEqual('body', parts[2].get_payload())
+
+    def test_read_object_selected_fields(self):
+        conn = httplib.HTTPConnection(self.conf.get('auth_host'),
+                                      self.conf.get('access_port'))
+        headers = {'X-Auth-Token': self.auth_token,
+                   'X-CDMI-Specification-Version': '1.0.1',
+                   'Accept': 'application/cdmi-object'}
+        conn.request('GET', (self.access_root + '/' + self.top_container +
+                             '/' + self.child_container + '/' +
+                             self.object_test + '?objectName;valuerange'),
+                     None, headers)
+        res = conn.getresponse()
+        self.assertEqual(res.status, 200, 'Object read failed')
+        data = res.read()
+        try:
+            body = json.loads(data)
+        except Exception as parsing_error:
+            raise parsing_error
+        self.assertEqual(['objectName', 'valuerange'], sorted(body.keys()),
+                         'Only the fields asked for should be returned')
+        self.assertEqual('0-15', body['valuerange'],
+                         'The value range should be 0-15')
+
+    def test_read_object_not_modified(self):
+        conn = httplib.HTTPConnection(self.conf.get('auth_host'),
+                                      self.conf.get('access_port'))
+        headers = {'X-Auth-Token': self.auth_token,
+                   'X-CDMI-Specification-Version': '1.0.1',
+                   'Accept': 'application/cdmi-object'}
+        path = (self.access_root + '/' + self.top_container + '/' +
+                self.child_container + '/' + self.object_test)
+        conn.request('GET', path, None, headers)
+        res = conn.getresponse()
+        self.assertEqual(res.status, 200, 'Object read failed')
+        res.read()
+        etag = res.getheader('etag')
+        self.assertIsNotNone(etag, 'The read should carry an ETag')
+        self.assertIn('X-CDMI-Specification-Version',
+                      res.getheader('vary', ''),
+                      'The read should vary on the CDMI version')
+        headers['If-None-Match'] = etag
+        conn.request('GET', path, None, headers)
+        res = conn.getresponse()
+        self.assertEqual(res.status, 304, 'The object should not be modified')
+        self.assertEqual('', res.read(), 'A 304 should have no body')
+
+    def test_head_object(self):
+        conn = httplib.HTTPConnection(self.conf.get('auth_host'),
+                                      self.conf.get('access_port'))
+        headers = {'X-Auth-Token': self.auth_token,
+                   'X-CDMI-Specification-Version': '1.0.1',
+                   'Accept': 'application/cdmi-object'}
+        conn.request('HEAD', (self.access_root + '/' + self.top_container +
+                              '/' + self.child_container + '/' +
+                              self.object_test), None, headers)
+        res = conn.getresponse()
+        self.assertEqual(res.status, 200, 'Object head failed')
+        self.assertEqual('application/cdmi-object',
+                         res.getheader('content-type', ''),
+                         'The content type should be application/cdmi-object')
+
     def test_partial_noncdmi_read_object(self):
         conn = httplib.HTTPConnection(self.conf.get('auth_host'),
                                       self.conf.get('access_port'))
@@ -0,0 +1,316 @@
+# Copyright (c) 2010-2011 IBM.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import time
+from cdmi.cdmiapp.cdmibase import Consts
+from cdmi.cdmiapp.cdmicache import \
+    (ResourceTypeCache, MemcacheResourceTypeCache,
+     RequestTypeCache, InMemoryMemcache, HierarchyIndex, ListingCheckpoints)
+
+
+class TestResourceTypeCache(unittest.TestCase):
+    """ Test the resource type cache kept by each process """
+
+    def test_get_and_set(self):
+        cache = ResourceTypeCache()
+        self.assertIsNone(cache.get('acc', 'con', 'a/b'))
+        cache.set('acc', 'con', 'a/b', Consts.RESOURCE_DIRECTORY)
+        self.assertEqual(Consts.RESOURCE_DIRECTORY,
+                         cache.get('acc', 'con', 'a/b/'))
+        self.assertIsNone(cache.get('acc', 'other', 'a/b'))
+        stats = cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+
+    def test_lru_eviction(self):
+        cache = ResourceTypeCache(max_size=2)
+        cache.set('acc', 'con', 'a', Consts.RESOURCE_OBJECT)
+        cache.set('acc', 'con', 'b', Consts.RESOURCE_OBJECT)
+        # a becomes the most recently used, so b gets evicted
+        cache.get('acc', 'con', 'a')
+        cache.set('acc', 'con', 'c', Consts.RESOURCE_OBJECT)
+        self.assertEqual(Consts.RESOURCE_OBJECT, cache.get('acc', 'con', 'a'))
+        self.assertIsNone(cache.get('acc', 'con', 'b'))
+        self.assertEqual(Consts.RESOURCE_OBJECT, cache.get('acc', 'con', 'c'))
+
+    def test_ttl(self):
+        cache = ResourceTypeCache(ttl=10, negative_ttl=0.01)
+        cache.set('acc', 'con', 'a', Consts.RESOURCE_VIRTUAL)
+        cache.set('acc', 'con', 'b', Consts.RESOURCE_MISSING)
+        time.sleep(0.02)
+        self.assertEqual(Consts.RESOURCE_VIRTUAL,
+                         cache.get('acc', 'con', 'a'))
+        self.assertIsNone(cache.get('acc', 'con', 'b'))
+
+    def test_invalidate(self):
+        cache = ResourceTypeCache()
+        for name in ('a', 'a/b', 'a/b/c', 'a/d'):
+            cache.set('acc', 'con', name, Consts.RESOURCE_DIRECTORY)
+        cache.set('acc', 'other', 'a', Consts.RESOURCE_DIRECTORY)
+        # A write drops the whole container
+        cache.invalidate('acc', 'con', 'a/b/c')
+        for name in ('a', 'a/b', 'a/b/c', 'a/d'):
+            self.assertIsNone(cache.get('acc', 'con', name))
+        self.assertEqual(Consts.RESOURCE_DIRECTORY,
+                         cache.get('acc', 'other', 'a'))
+
+    def test_stale_set(self):
+        cache = ResourceTypeCache()
+        generation = cache.generation('acc', 'con')
+        cache.invalidate('acc', 'con', 'a')
+        # A type checked before the write is not stored
+        cache.set('acc', 'con', 'a', Consts.RESOURCE_MISSING, generation)
+        self.assertIsNone(cache.get('acc', 'con', 'a'))
+
+    def test_generations_bounded(self):
+        cache = ResourceTypeCache(max_size=2)
+        cache.set('acc', 'quiet', 'a', Consts.RESOURCE_OBJECT)
+        for container in ('a', 'b', 'c'):
+            cache.invalidate('acc', container, '')
+        self.assertEqual(2, len(cache.generations))
+        # Forgetting a generation drops the entries of the containers
+        # which share the floor generation
+        self.assertIsNone(cache.get('acc', 'quiet', 'a'))
+        cache.set('acc', 'a', 'x', Consts.RESOURCE_OBJECT)
+        self.assertEqual(Consts.RESOURCE_OBJECT, cache.get('acc', 'a', 'x'))
+
+
+class TestMemcacheResourceTypeCache(unittest.TestCase):
+    """ Test the resource type cache shared through memcache """
+
+    def test_get_and_set(self):
+        cache = MemcacheResourceTypeCache(InMemoryMemcache())
+        self.assertIsNone(cache.get('acc', 'con', 'a'))
+        cache.set('acc', 'con', 'a', Consts.RESOURCE_OBJECT)
+        self.assertEqual(Consts.RESOURCE_OBJECT,
+                         cache.get('acc', 'con', 'a'))
+        self.assertEqual(1, cache.stats()['hits'])
+        self.assertEqual(1, cache.stats()['misses'])
+
+    def test_shared_between_caches(self):
+        memcache = InMemoryMemcache()
+        first = MemcacheResourceTypeCache(memcache)
+        second = MemcacheResourceTypeCache(memcache)
+        first.set('acc', 'con', 'a', Consts.RESOURCE_VIRTUAL)
+        self.assertEqual(Consts.RESOURCE_VIRTUAL,
+                         second.get('acc', 'con', 'a'))
+        second.invalidate('acc', 'con', 'a')
+        self.assertIsNone(first.get('acc', 'con', 'a'))
+
+    def test_invalidate_container(self):
+        cache = MemcacheResourceTypeCache(InMemoryMemcache())
+        cache.set('acc', 'con', 'a/b', Consts.RESOURCE_DIRECTORY)
+        cache.set('acc', 'con', 'x', Consts.RESOURCE_OBJECT)
+        cache.set('acc', 'other', 'x', Consts.RESOURCE_OBJECT)
+        cache.invalidate('acc', 'con', 'a/b/c')
+        self.assertIsNone(cache.get('acc', 'con', 'a/b'))
+        self.assertIsNone(cache.get('acc', 'con', 'x'))
+        self.assertEqual(Consts.RESOURCE_OBJECT,
+                         cache.get('acc', 'other', 'x'))
+
+
+class TestRequestTypeCache(unittest.TestCase):
+    """ Test the resource type cache as seen by a request """
+
+    def _check_stale_probe(self, cache, first, second):
+        # The first request looks the name up before checking it
+        self.assertIsNone(first.get('acc', 'con', 'a'))
+        # Another request writes in the container meanwhile
+        second.invalidate('acc', 'con', '')
+        # The outdated type checked before the write is not seen
+        first.set('acc', 'con', 'a', Consts.RESOURCE_MISSING)
+        self.assertIsNone(second.get('acc', 'con', 'a'))
+        second.set('acc', 'con', 'a', Consts.RESOURCE_OBJECT)
+        self.assertEqual(Consts.RESOURCE_OBJECT,
+                         second.get('acc', 'con', 'a'))
+
+    def test_stale_probe(self):
+        cache = ResourceTypeCache()
+        self._check_stale_probe(cache, RequestTypeCache(cache),
+                                RequestTypeCache(cache))
+
+    def test_stale_probe_memcache(self):
+        memcache = InMemoryMemcache()
+        cache = MemcacheResourceTypeCache()
+        self._check_stale_probe(cache, RequestTypeCache(cache, memcache),
+                                RequestTypeCache(cache, memcache))
+
+    def test_memcache_per_request(self):
+        cache = MemcacheResourceTypeCache()
+        first = RequestTypeCache(cache, InMemoryMemcache())
+        second = RequestTypeCache(cache, InMemoryMemcache())
+        first.set('acc', 'con', 'a', Consts.RESOURCE_OBJECT)
+        self.assertIsNone(second.get('acc', 'con', 'a'))
+        self.assertEqual(Consts.RESOURCE_OBJECT,
+                         first.get('acc', 'con', 'a'))
+        self.assertIsNone(cache.memcache)
+
+    def test_own_write(self):
+        cache = ResourceTypeCache()
+        request = RequestTypeCache(cache)
+        self.assertIsNone(request.get('acc', 'con', 'a'))
+        request.invalidate('acc', 'con', '')
+        # The types checked after its own write are kept
+        request.set('acc', 'con', 'a', Consts.RESOURCE_OBJECT)
+        self.assertEqual(Consts.RESOURCE_OBJECT,
+                         RequestTypeCache(cache).get('acc', 'con', 'a'))
+
+
+class TestHierarchyIndex(unittest.TestCase):
+    """ Test the in-process index of the names of a container """
+
+    def _listing(self):
+        return [{'name': 'a', 'content_type': 'application/directory'},
+                {'subdir': 'a/'},
+                {'name': 'o', 'content_type': 'text/plain'},
+                {'subdir': 'v/'}]
+
+    def test_complete_listing(self):
+        index = HierarchyIndex()
+        index.add_listing('acc', 'con', '', self._listing(), True)
+        self.assertEqual(Consts.RESOURCE_DIRECTORY,
+                         index.get('acc', 'con', 'a'))
+        self.assertEqual(Consts.RESOURCE_OBJECT, index.get('acc', 'con', 'o'))
+        self.assertEqual(Consts.RESOURCE_VIRTUAL,
+                         index.get('acc', 'con', 'v/'))
+        self.assertEqual(Consts.RESOURCE_MISSING,
+                         index.get('acc', 'con', 'x/y'))
+        # Nothing is known under a directory which was not listed
+        self.assertIsNone(index.get('acc', 'con', 'a/b'))
+
+    def test_non_ascii_names(self):
+        index = HierarchyIndex()
+        index.add_listing('acc', 'con', 'd\xc3\xa9',
+                          [{'name': u'd\xe9/\xe9',
+                            'content_type': 'text/plain'},
+                           {'subdir': u'd\xe9/v\xe9/'}], True)
+        self.assertEqual(Consts.RESOURCE_OBJECT,
+                         index.get('acc', 'con', 'd\xc3\xa9/\xc3\xa9'))
+        self.assertEqual(Consts.RESOURCE_VIRTUAL,
+                         index.get('acc', 'con', 'd\xc3\xa9/v\xc3\xa9'))
+        self.assertEqual(Consts.RESOURCE_MISSING,
+                         index.get('acc', 'con', 'd\xc3\xa9/x'))
+
+    def test_partial_listing(self):
+        index = HierarchyIndex()
+        index.add_listing('acc', 'con', '', self._listing(), False)
+        self.assertEqual(Consts.RESOURCE_OBJECT, index.get('acc', 'con', 'o'))
+        self.assertIsNone(index.get('acc', 'con', 'v'))
+        self.assertIsNone(index.get('acc', 'con', 'x'))
+
+    def test_writes(self):
+        index = HierarchyIndex()
+        index.add_listing('acc', 'con', '', self._listing(), True)
+        index.add_listing('acc', 'con', 'v',
+                          [{'name': 'v/o', 'content_type': 'text/plain'}],
+                          True)
+        index.set('acc', 'con', 'x', Consts.RESOURCE_OBJECT)
+        self.assertEqual(Consts.RESOURCE_OBJECT, index.get('acc', 'con', 'x'))
+        # Removing the last name of a virtual container removes it too
+        index.remove('acc', 'con', 'v/o')
+        self.assertEqual(Consts.RESOURCE_MISSING,
+                         index.get('acc', 'con', 'v'))
+        # A name written with an unknown outcome is no longer known
+        index.discard('acc', 'con', 'o')
+        self.assertIsNone(index.get('acc', 'con', 'o'))
+        self.assertIsNone(index.get('acc', 'con', 'y'))
+
+    def test_limits(self):
+        index = HierarchyIndex(max_containers=1, max_entries=3)
+        # Too many names for the container, the listing is not indexed
+        index.add_listing('acc', 'con', '', self._listing(), True)
+        self.assertIsNone(index.get('acc', 'con', 'o'))
+        index.set('acc', 'con', 'a', Consts.RESOURCE_DIRECTORY)
+        index.set('acc', 'other', 'a', Consts.RESOURCE_DIRECTORY)
+        self.assertIsNone(index.get('acc', 'con', 'a'))
+        self.assertEqual(Consts.RESOURCE_DIRECTORY,
+                         index.get('acc', 'other', 'a'))
+
+    def test_max_age(self):
+        index = HierarchyIndex(max_age=0.01)
+        index.set('acc', 'con', 'a', Consts.RESOURCE_DIRECTORY)
+        time.sleep(0.02)
+        self.assertIsNone(index.get('acc', 'con', 'a'))
+
+
+class TestListingCheckpoints(unittest.TestCase):
+    """ Test the checkpoints kept in the listings of large containers """
+
+    def test_closest_checkpoint(self):
+        checkpoints = ListingCheckpoints()
+        self.assertIsNone(checkpoints.get('acc', 'con', 'a/', 100))
+        checkpoints.add('acc', 'con', 'a/', 50, 'a/m')
+        checkpoints.add('acc', 'con', 'a/', 90, 'a/x', ['a/w/'])
+        self.assertEqual((90, 'a/x', ('a/w/',)),
+                         checkpoints.get('acc', 'con', 'a/', 100))
+        self.assertEqual((50, 'a/m', ()),
+                         checkpoints.get('acc', 'con', 'a/', 60))
+        self.assertIsNone(checkpoints.get('acc', 'con', 'a/', 10))
+        self.assertIsNone(checkpoints.get('acc', 'con', '', 100))
+        self.assertEqual(2, checkpoints.stats()['hits'])
+
+    def test_invalidate(self):
+        checkpoints = ListingCheckpoints()
+        checkpoints.add('acc', 'con', '', 10, 'm')
+        checkpoints.add('acc', 'other', '', 10, 'm')
+        checkpoints.invalidate('acc', 'con')
+        self.assertIsNone(checkpoints.get('acc', 'con', '', 10))
+        self.assertEqual((10, 'm', ()),
+                         checkpoints.get('acc', 'other', '', 10))
+
+    def test_count(self):
+        checkpoints = ListingCheckpoints()
+        self.assertIsNone(checkpoints.get_count('acc', 'con', 'a/'))
+        checkpoints.set_count('acc', 'con', 'a/', 12)
+        self.assertEqual(12, checkpoints.get_count('acc', 'con', 'a/'))
+        checkpoints.invalidate('acc', 'con')
+        self.assertIsNone(checkpoints.get_count('acc', 'con', 'a/'))
+
+    def test_stale_generation(self):
+        checkpoints = ListingCheckpoints()
+        generation = checkpoints.generation('acc', 'con')
+        # The container is written while it is listed
+        checkpoints.invalidate('acc', 'con')
+        checkpoints.add('acc', 'con', '', 10, 'm', (), generation)
+        checkpoints.set_count('acc', 'con', '', 12, generation)
+        self.assertIsNone(checkpoints.get('acc', 'con', '', 10))
+        self.assertIsNone(checkpoints.get_count('acc', 'con', ''))
+        generation = checkpoints.generation('acc', 'con')
+        checkpoints.set_count('acc', 'con', '', 12, generation)
+        self.assertEqual(12, checkpoints.get_count('acc', 'con', ''))
+
+    def test_generations_bounded(self):
+        checkpoints = ListingCheckpoints(max_listings=2)
+        checkpoints.set_count('acc', 'con', '', 12)
+        for name in ('a', 'b', 'c'):
+            checkpoints.invalidate('acc', name)
+        self.assertEqual(2, len(checkpoints.generations))
+        # The containers without a generation of their own share the floor
+        self.assertEqual(checkpoints.generation('acc', 'a'),
+                         checkpoints.generation('acc', 'con'))
+        self.assertIsNone(checkpoints.get_count('acc', 'con', ''))
+
+    def test_limits(self):
+        checkpoints = ListingCheckpoints(max_listings=1, ttl=0.01)
+        checkpoints.add('acc', 'con', '', 10, 'm')
+        checkpoints.add('acc', 'con', 'a/', 10, 'a/m')
+        self.assertIsNone(checkpoints.get('acc', 'con', '', 10))
+        time.sleep(0.02)
+        self.assertIsNone(checkpoints.get('acc', 'con', 'a/', 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
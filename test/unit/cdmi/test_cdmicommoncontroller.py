@@ -0,0 +1,317 @@
+# Copyright (c) 2010-2011 IBM.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import base64
+import json
+from webob import Request, Response
+from cdmi import filter_factory
+from cdmi.cdmiapp.cdmibase import Consts
+from cdmi.cdmiapp.cdmicommoncontroller import CDMIBaseController
+from cdmi.cdmiapp.cdmicontrollers import AccountController
+
+BINARY_VALUE = ''.join([chr(code % 256) for code in range(200)])
+
+
+class FakeApp(object):
+    """ Swift holding a container with a directory and a data object """
+
+    def __init__(self):
+        self.calls = []
+        self.fail_pages = False
+        self.etag = 'e1'
+
+    def __call__(self, env, start_response):
+        req = Request(env)
+        self.calls.append((req.method, req.path_info))
+        if req.method == 'PUT':
+            res = Response(status=201)
+        elif self.fail_pages and req.GET.get('marker'):
+            res = Response(status=503)
+        elif req.path_info == '/v1/AUTH_test':
+            listing = [{'name': 'other', 'count': 0, 'bytes': 0},
+                       {'name': 'top', 'count': 3, 'bytes': 5}]
+            marker = req.GET.get('marker', '')
+            listing = [entry for entry in listing if entry['name'] > marker]
+            listing = listing[:int(req.GET.get('limit', 10000))]
+            res = Response(body=json.dumps(listing),
+                           content_type='application/json')
+        elif req.path_info == '/v1/AUTH_test/top':
+            if req.GET.get('prefix') == 'dir/':
+                listing = [{'name': 'dir/o', 'content_type': 'text/plain'},
+                           {'name': u'dir/\xe9', 'content_type': 'text/plain'}]
+            elif 'delimiter' not in req.GET:
+                listing = [{'name': 'dir',
+                            'content_type': 'application/directory'},
+                           {'name': 'dir/o', 'content_type': 'text/plain'},
+                           {'name': 'o', 'content_type': 'text/plain'}]
+            else:
+                listing = [{'name': 'dir',
+                            'content_type': 'application/directory'},
+                           {'subdir': 'dir/'},
+                           {'name': 'o', 'content_type': 'text/plain'}]
+            marker = req.GET.get('marker', '')
+            prefix = req.GET.get('prefix', '')
+            listing = [entry for entry in listing
+                       if (entry.get('name') or entry['subdir']) > marker and
+                       (entry.get('name') or entry['subdir']).startswith(
+                           prefix)]
+            listing = listing[:int(req.GET.get('limit', 10000))]
+            res = Response(body=json.dumps(listing),
+                           content_type='application/json')
+            res.headers['X-Container-Meta-Cdmi-0'] = 'color:blue'
+            res.headers['X-Container-Object-Count'] = '3'
+            res.headers['X-Container-Bytes-Used'] = '5'
+        elif req.path_info == '/v1/AUTH_test/top/dir':
+            res = Response(content_type='application/directory')
+        elif req.path_info == '/v1/AUTH_test/top/o':
+            if req.if_match and self.etag not in req.if_match:
+                res = Response(status=412)
+            else:
+                res = Response(body='hello', content_type='text/plain',
+                               conditional_response=True)
+                res.etag = self.etag
+        elif req.path_info == '/v1/AUTH_test/top/bin':
+            res = Response(body=BINARY_VALUE,
+                           content_type='application/octet-stream')
+        elif req.path_info == '/v1/AUTH_test/top/secret':
+            res = Response(status=401, body='Unauthorized')
+        else:
+            res = Response(status=404)
+        return res(env, start_response)
+
+
+class TestCDMICommonController(unittest.TestCase):
+    """ Test the requests a CDMI read sends to Swift """
+
+    def setUp(self):
+        self.app = FakeApp()
+        self.cdmi = filter_factory({})(self.app)
+
+    def _read(self, path, accept):
+        req = Request.blank('/cdmi/AUTH_test/' + path,
+                            headers={'X-Auth-Token': 'token',
+                                     'X-CDMI-Specification-Version': '1.0.1',
+                                     'Accept': accept})
+        return req.get_response(self.cdmi)
+
+    def test_read_top_container(self):
+        res = self._read('top/', 'application/cdmi-container')
+        self.assertEqual(200, res.status_int)
+        body = json.loads(res.body)
+        self.assertEqual(['dir/', 'o'], body['children'])
+        metadata = {'color': 'blue', 'cdmi_size': '5',
+                    'cdmi_objectcount': '3'}
+        self.assertEqual(metadata, body['metadata'])
+        # The listing also gives the headers of the container
+        self.assertEqual([('GET', '/v1/AUTH_test/top')], self.app.calls)
+        # The metadata alone is the same as in the whole body
+        res = self._read('top/?metadata', 'application/cdmi-container')
+        self.assertEqual({'metadata': metadata}, json.loads(res.body))
+
+    def test_read_top_container_pages(self):
+        limit = CDMIBaseController.listing_limit
+        CDMIBaseController.listing_limit = 2
+        try:
+            res = self._read('top/', 'application/cdmi-container')
+            body = json.loads(res.body)
+        finally:
+            CDMIBaseController.listing_limit = limit
+        self.assertEqual(200, res.status_int)
+        # The directory marker and the subdir are in different pages
+        self.assertEqual(['dir/', 'o'], body['children'])
+        self.assertEqual('0-1', body['childrenRange'])
+        self.assertEqual([('GET', '/v1/AUTH_test/top')] * 2, self.app.calls)
+
+    def test_read_top_container_failed_page(self):
+        limit = CDMIBaseController.listing_limit
+        CDMIBaseController.listing_limit = 2
+        self.app.fail_pages = True
+        try:
+            res = self._read('top/', 'application/cdmi-container')
+            body = json.loads(res.body)
+            self.assertEqual(2, len(self.app.calls))
+            selected = json.loads(self._read(
+                'top/?children', 'application/cdmi-container').body)
+        finally:
+            CDMIBaseController.listing_limit = limit
+        # The body ends with the children read before the failed page and
+        # tells they are not all of them
+        self.assertEqual(200, res.status_int)
+        self.assertEqual(['dir/', 'o'], body['children'])
+        self.assertEqual('0-1', body['childrenRange'])
+        self.assertEqual(Consts.LISTING_INCOMPLETE, body['completionStatus'])
+        # Even when the read did not ask for the completion status
+        self.assertEqual({'children': ['dir/', 'o'],
+                          'completionStatus': Consts.LISTING_INCOMPLETE},
+                         selected)
+
+    def test_read_account_failed_page(self):
+        limit = AccountController.listing_limit
+        AccountController.listing_limit = 1
+        self.app.fail_pages = True
+        try:
+            res = self._read('', 'application/cdmi-container')
+            body = json.loads(res.body)
+        finally:
+            AccountController.listing_limit = limit
+        self.assertEqual(200, res.status_int)
+        self.assertEqual(['other/'], body['children'])
+        self.assertEqual('0-0', body['childrenRange'])
+        self.assertEqual(Consts.LISTING_INCOMPLETE, body['completionStatus'])
+
+    def test_read_top_container_tree(self):
+        res = self._read('top/?children&depth=2',
+                         'application/cdmi-container')
+        self.assertEqual(200, res.status_int)
+        self.assertEqual([{'name': 'dir/', 'children': ['o']}, 'o'],
+                         json.loads(res.body)['children'])
+        # The whole tree comes from a listing without a delimiter
+        self.assertEqual([('GET', '/v1/AUTH_test/top')] * 2, self.app.calls)
+
+    def test_read_children_count(self):
+        res = self._read('top/?childrenrange', 'application/cdmi-container')
+        self.assertEqual({'childrenRange': '0-1'}, json.loads(res.body))
+        # The number of children is known from the first listing
+        del self.app.calls[:]
+        res = self._read('top/?childrenrange', 'application/cdmi-container')
+        self.assertEqual({'childrenRange': '0-1'}, json.loads(res.body))
+        self.assertEqual([('HEAD', '/v1/AUTH_test/top')], self.app.calls)
+
+    def test_read_directory(self):
+        res = self._read('top/dir/', 'application/cdmi-container')
+        self.assertEqual(200, res.status_int)
+        self.assertEqual(['o', u'\xe9'], json.loads(res.body)['children'])
+        # The directory is checked while its children are listed
+        self.assertEqual([('GET', '/v1/AUTH_test/top'),
+                          ('HEAD', '/v1/AUTH_test/top/dir')],
+                         sorted(self.app.calls))
+
+    def test_write_object_non_ascii_name(self):
+        req = Request.blank('/cdmi/AUTH_test/top/dir/%C3%A9',
+                            method='PUT', body=json.dumps({'value': 'x'}),
+                            headers={'X-Auth-Token': 'token',
+                                     'X-CDMI-Specification-Version': '1.0.1',
+                                     'Accept': 'application/cdmi-object',
+                                     'Content-Type':
+                                     'application/cdmi-object'})
+        res = req.get_response(self.cdmi)
+        self.assertEqual(201, res.status_int)
+        # The listing of the parent tells the object exists, it is not
+        # checked on its own.
+        self.assertEqual(['GET', 'HEAD', 'PUT'],
+                         sorted([call[0] for call in self.app.calls]))
+
+    def test_read_object(self):
+        res = self._read('top/o', 'application/cdmi-object')
+        self.assertEqual(200, res.status_int)
+        self.assertEqual('hello', json.loads(res.body)['value'])
+        self.assertEqual([('GET', '/v1/AUTH_test/top/o')], self.app.calls)
+
+    def test_read_object_ranges(self):
+        res = self._read('top/o?value:0-1,3-4', 'application/cdmi-object')
+        self.assertEqual(206, res.status_int)
+        self.assertEqual(res.content_length, len(res.body))
+        self.assertTrue('\r\n\r\nhe\r\n' in res.body)
+        self.assertTrue('\r\n\r\nlo\r\n' in res.body)
+        # Each range is read from the object the ranges were resolved for
+        res = self._read('top/o?value:0-1,3-4', 'application/cdmi-object')
+        self.app.etag = 'e2'
+        self.assertRaises(IOError, getattr, res, 'body')
+
+    def test_read_object_multipart(self):
+        for encoding in ('binary', 'base64'):
+            self.cdmi = filter_factory(
+                {'cdmi_multipart_encoding': encoding})(self.app)
+            res = self._read('top/bin', 'multipart/mixed')
+            self.assertEqual(200, res.status_int)
+            self.assertEqual(res.content_length, len(res.body))
+            boundary = res.headers['Content-Type'].split('boundary=')[1]
+            parts = res.body.split('\r\n--' + boundary)
+            head, value = parts[2].split('\r\n\r\n', 1)
+            self.assertTrue('Content-Transfer-Encoding: ' + encoding in head)
+            if encoding == 'base64':
+                value = base64.decodestring(value)
+            self.assertEqual(BINARY_VALUE, value)
+            # The JSON part tells the encoding of the value in CDMI
+            body = json.loads(parts[1].split('\r\n\r\n', 1)[1])
+            self.assertEqual('base64', body['valuetransferencoding'])
+
+    def test_read_object_error(self):
+        res = self._read('top/secret', 'application/cdmi-object')
+        self.assertEqual(401, res.status_int)
+        self.assertIsNone(res.etag)
+        self.assertRaises(ValueError, json.loads, res.body)
+        # A read without CDMI gets the answer of Swift
+        req = Request.blank('/cdmi/AUTH_test/top/secret',
+                            headers={'X-Auth-Token': 'token'})
+        res = req.get_response(self.cdmi)
+        self.assertEqual(401, res.status_int)
+        self.assertEqual('Unauthorized', res.body)
+
+    def test_cached_type_needs_owner(self):
+        res = self._read('top/missing', 'application/cdmi-object')
+        self.assertEqual(404, res.status_int)
+        del self.app.calls[:]
+        # The owner is answered from the cached type
+        res = self._read('top/missing', 'application/cdmi-object')
+        self.assertEqual(404, res.status_int)
+        self.assertEqual([], self.app.calls)
+        # Any other caller is checked by Swift
+        req = Request.blank('/cdmi/AUTH_test/top/missing',
+                            environ={'swift.authorize':
+                                     lambda req: Response(status=401)},
+                            headers={'X-Auth-Token': 'token',
+                                     'X-CDMI-Specification-Version': '1.0.1',
+                                     'Accept': 'application/cdmi-object'})
+        req.get_response(self.cdmi)
+        self.assertEqual(('GET', '/v1/AUTH_test/top/missing'),
+                         self.app.calls[0])
+
+    def _check_head(self, path, accept):
+        get = self._read(path, accept)
+        del self.app.calls[:]
+        req = Request.blank('/cdmi/AUTH_test/' + path,
+                            environ={'REQUEST_METHOD': 'HEAD'},
+                            headers={'X-Auth-Token': 'token',
+                                     'X-CDMI-Specification-Version': '1.0.1',
+                                     'Accept': accept})
+        head = req.get_response(self.cdmi)
+        self.assertEqual(200, head.status_int)
+        self.assertEqual('', head.body)
+        for header in ('Content-Type', 'Content-Length', 'ETag',
+                       'X-CDMI-Specification-Version'):
+            self.assertEqual(get.headers.get(header),
+                             head.headers.get(header))
+        return head
+
+    def test_head_container(self):
+        head = self._check_head('top/', 'application/cdmi-container')
+        self.assertIsNotNone(head.etag)
+        self.assertEqual('1.0.1', head.headers['X-CDMI-Specification-Version'])
+
+    def test_head_object(self):
+        head = self._check_head('top/bin', 'application/cdmi-object')
+        self.assertTrue(int(head.headers['Content-Length']) > 0)
+        # The value is not read
+        self.assertEqual([('HEAD', '/v1/AUTH_test/top/bin')], self.app.calls)
+        # The length of a text value is not known without reading it
+        head = self._check_head('top/o', 'application/cdmi-object')
+        self.assertIsNone(head.headers.get('Content-Length'))
+        self.assertEqual([('HEAD', '/v1/AUTH_test/top/o')], self.app.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
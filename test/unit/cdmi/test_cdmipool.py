@@ -0,0 +1,190 @@
+# Copyright (c) 2010-2011 IBM.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import socket
+import time
+import eventlet
+from cdmi.cdmiapp.cdmipool import ConnectionPool
+
+
+class FakeResponse(object):
+
+    def __init__(self, status=200, body='', will_close=False):
+        self.status = status
+        self.body = body
+        self.will_close = will_close
+
+    def getheader(self, name, default=None):
+        if name.lower() == 'content-length':
+            return str(len(self.body))
+        return default
+
+    def read(self):
+        return self.body
+
+
+class FakeConnection(object):
+
+    def __init__(self, fail=False, delay=0):
+        self.sock = None
+        self.fail = fail
+        self.delay = delay
+        self.closed = False
+        self.requests = []
+
+    def request(self, method, path, body, headers):
+        if self.fail:
+            raise socket.error('connection reset')
+        self.requests.append((method, path))
+
+    def getresponse(self):
+        if self.delay:
+            eventlet.sleep(self.delay)
+        return FakeResponse(body='ok')
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(ConnectionPool):
+    """ A pool whose connections never touch the network """
+
+    def __init__(self, *args, **kwargs):
+        self.delay = kwargs.pop('delay', 0)
+        ConnectionPool.__init__(self, *args, **kwargs)
+        self.created = []
+        self.most_in_use = 0
+
+    def _connect(self, host, port, ssl):
+        conn = FakeConnection(delay=self.delay)
+        self.created.append(conn)
+        self.most_in_use = max(self.most_in_use, self.in_use)
+        return conn
+
+    def _is_healthy(self, conn):
+        return not conn.closed
+
+
+class TestConnectionPool(unittest.TestCase):
+    """ Test the keep-alive connection pool """
+
+    def test_reuse(self):
+        pool = FakePool()
+        res, body = pool.request('host', 80, False, 'GET', '/a')
+        self.assertEqual('ok', body)
+        res, body = pool.request('host', 80, False, 'GET', '/b',
+                                 query_string='c=d')
+        self.assertEqual(1, len(pool.created))
+        self.assertEqual([('GET', '/a'), ('GET', '/b?c=d')],
+                         pool.created[0].requests)
+        pool.request('other', 80, False, 'GET', '/a')
+        self.assertEqual(2, len(pool.created))
+        self.assertEqual({'hits': 1, 'misses': 2, 'idle': 2, 'in_use': 0},
+                         pool.stats())
+
+    def test_max_idle(self):
+        pool = FakePool(max_idle=1)
+        first, reused = pool.get('host', 80)
+        second, reused = pool.get('host', 80)
+        pool.put(first, 'host', 80)
+        pool.put(second, 'host', 80)
+        self.assertFalse(first.closed)
+        self.assertTrue(second.closed)
+        self.assertEqual(1, pool.stats()['idle'])
+
+    def test_idle_reaping(self):
+        pool = FakePool(idle_timeout=60)
+        conn, reused = pool.get('host', 80)
+        pool.put(conn, 'host', 80)
+        # Make the connection look idle for too long
+        free = pool.pools[('host', '80', False)]
+        free[0] = (conn, time.time() - 61)
+        new_conn, reused = pool.get('host', 80)
+        self.assertFalse(reused)
+        self.assertTrue(conn.closed)
+        self.assertIsNot(conn, new_conn)
+
+    def test_health_check(self):
+        pool = ConnectionPool()
+        conn = FakeConnection()
+        self.assertFalse(pool._is_healthy(conn))
+        conn.sock, peer = socket.socketpair()
+        try:
+            self.assertTrue(pool._is_healthy(conn))
+            # A connection closed by the server becomes readable
+            peer.close()
+            self.assertFalse(pool._is_healthy(conn))
+        finally:
+            conn.sock.close()
+        conn.sock, peer = socket.socketpair()
+        try:
+            # So does a connection with data nobody asked for
+            peer.sendall('HTTP/1.1 408 Request Timeout\r\n\r\n')
+            self.assertFalse(pool._is_healthy(conn))
+        finally:
+            conn.sock.close()
+            peer.close()
+
+    def test_retry_after_reused_connection_fails(self):
+        pool = FakePool()
+        stale = FakeConnection(fail=True)
+        pool.pools[('host', '80', False)] = [(stale, time.time())]
+        res, body = pool.request('host', 80, False, 'GET', '/a')
+        self.assertEqual('ok', body)
+        self.assertTrue(stale.closed)
+        self.assertEqual(1, len(pool.created))
+        self.assertEqual([('GET', '/a')], pool.created[0].requests)
+
+    def test_no_retry_on_new_connection(self):
+        pool = FakePool()
+        pool._connect = lambda host, port, ssl: FakeConnection(fail=True)
+        self.assertRaises(socket.error, pool.request, 'host', 80, False,
+                          'GET', '/a')
+
+    def test_max_size(self):
+        pool = FakePool(max_size=2, delay=0.01)
+        green_pool = eventlet.GreenPool()
+        results = [green_pool.spawn(pool.request, 'host', 80, False, 'GET',
+                                    '/' + str(index))
+                   for index in range(5)]
+        green_pool.waitall()
+        self.assertEqual(['ok'] * 5, [result.wait()[1]
+                                      for result in results])
+        # The other requests waited for a connection to be released
+        self.assertEqual(2, pool.most_in_use)
+        self.assertEqual(2, len(pool.created))
+        self.assertEqual(0, pool.stats()['in_use'])
+
+    def test_max_size_timeout(self):
+        pool = FakePool(max_size=1, timeout=0.01, delay=0.05)
+        green_pool = eventlet.GreenPool()
+        green_pool.spawn(pool.request, 'host', 80, False, 'GET', '/a')
+        eventlet.sleep(0)
+        self.assertRaises(socket.timeout, pool.request, 'host', 80, False,
+                          'GET', '/b')
+        green_pool.waitall()
+        # The connection is released once its request is done
+        res, body = pool.request('host', 80, False, 'GET', '/c')
+        self.assertEqual('ok', body)
+
+    def test_timeout(self):
+        pool = ConnectionPool(timeout=5)
+        self.assertEqual(5, pool._connect('host', 80, False).timeout)
+        self.assertEqual(5, pool._connect('host', 443, True).timeout)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+# Copyright (c) 2010-2011 IBM.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import base64
+import eventlet
+from cdmi.cdmiapp.cdmiutils import (ProbeCache, iter_base64_value,
+                                    get_base64_value_length, iter_multipart,
+                                    get_multipart_length)
+
+
+class FakeCheck(object):
+    """ A resource check which counts its calls """
+
+    def __init__(self, delay=0, error=None):
+        self.delay = delay
+        self.error = error
+        self.calls = []
+
+    def __call__(self, path, get_body):
+        self.calls.append((path, get_body))
+        if self.delay:
+            eventlet.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return True, {}, 'body' if get_body else ''
+
+
+class TestProbeCache(unittest.TestCase):
+    """ Test the memo of the resource checks of a request """
+
+    def test_dedupe(self):
+        cache = ProbeCache()
+        check = FakeCheck()
+        key = ('HEAD', '/v1/acc/con', '')
+        first = cache.check(key, False, check, '/v1/acc/con', False)
+        second = cache.check(key, False, check, '/v1/acc/con', False)
+        self.assertEqual(first, second)
+        self.assertEqual(1, len(check.calls))
+        other = ('HEAD', '/v1/acc/other', '')
+        cache.check(other, False, check, '/v1/acc/other', False)
+        self.assertEqual(2, len(check.calls))
+        self.assertEqual(3, cache.lookups)
+        self.assertEqual(1, cache.hits)
+
+    def test_in_flight(self):
+        cache = ProbeCache()
+        check = FakeCheck(delay=0.01)
+        key = ('GET', '/v1/acc/con', 'delimiter=/')
+        pool = eventlet.GreenPool()
+        first = pool.spawn(cache.check, key, True, check, '/v1/acc/con',
+                           True)
+        # The second check starts while the first one is in flight
+        eventlet.sleep(0)
+        second = pool.spawn(cache.check, key, True, check, '/v1/acc/con',
+                            True)
+        pool.waitall()
+        self.assertEqual((True, {}, 'body'), first.wait())
+        self.assertEqual((True, {}, 'body'), second.wait())
+        self.assertEqual(1, len(check.calls))
+        self.assertEqual(1, cache.hits)
+
+    def test_get_body_upgrade(self):
+        cache = ProbeCache()
+        check = FakeCheck()
+        key = ('GET', '/v1/acc/con', '')
+        self.assertEqual((True, {}, ''),
+                         cache.check(key, False, check, '/v1/acc/con',
+                                     False))
+        # A check without the body can not serve a check needing it
+        self.assertEqual((True, {}, 'body'),
+                         cache.check(key, True, check, '/v1/acc/con', True))
+        self.assertEqual(2, len(check.calls))
+        # The check with the body serves both kinds from now on
+        self.assertEqual((True, {}, 'body'),
+                         cache.check(key, False, check, '/v1/acc/con',
+                                     False))
+        self.assertEqual((True, {}, 'body'),
+                         cache.check(key, True, check, '/v1/acc/con', True))
+        self.assertEqual(2, len(check.calls))
+        self.assertEqual(2, cache.hits)
+
+    def test_exception(self):
+        cache = ProbeCache()
+        check = FakeCheck(delay=0.01, error=IOError('connection reset'))
+        key = ('HEAD', '/v1/acc/con', '')
+        errors = []
+
+        def run():
+            try:
+                cache.check(key, False, check, '/v1/acc/con', False)
+            except IOError as err:
+                errors.append(err)
+
+        pool = eventlet.GreenPool()
+        pool.spawn(run)
+        eventlet.sleep(0)
+        pool.spawn(run)
+        pool.waitall()
+        # Both the check and the one waiting for it get the error
+        self.assertEqual(2, len(errors))
+        self.assertEqual(1, len(check.calls))
+        # A failed check is not kept, the next one is sent again
+        check.error = None
+        self.assertEqual((True, {}, ''),
+                         cache.check(key, False, check, '/v1/acc/con',
+                                     False))
+        self.assertEqual(2, len(check.calls))
+
+
+def split_chunks(data, size):
+    """ Cut a body into the chunks of the given size an app_iter yields """
+    return [data[at:at + size] for at in range(0, len(data), size)]
+
+
+class TestBase64Value(unittest.TestCase):
+    """ Test the base64 value written chunk by chunk """
+
+    def test_chunks(self):
+        data = ''.join([chr(code % 256) for code in range(1000)])
+        for size in (0, 1, 2, 3, 56, 57, 58, 114, 115, 1000):
+            value = data[:size]
+            expected = base64.encodestring(value)[:-1]
+            for chunk_size in (1, 7, 56, 57, 58, 100, 1000):
+                chunks = split_chunks(value, chunk_size)
+                encoded = ''.join(iter_base64_value(chunks, '\n'))
+                self.assertEqual(expected, encoded)
+                self.assertEqual(get_base64_value_length(size, '\n'),
+                                 len(encoded))
+                # Escaped for a JSON string by default
+                escaped = ''.join(iter_base64_value(chunks))
+                self.assertEqual(expected.replace('\n', '\\n'), escaped)
+                self.assertEqual(get_base64_value_length(size),
+                                 len(escaped))
+
+    def test_empty(self):
+        self.assertEqual('', ''.join(iter_base64_value([])))
+        self.assertEqual('', ''.join(iter_base64_value(['', ''])))
+        self.assertEqual(0, get_base64_value_length(0))
+        # Empty chunks in the body change nothing
+        self.assertEqual(base64.encodestring('abcd')[:-1],
+                         ''.join(iter_base64_value(['', 'ab', '', 'cd'],
+                                                   '\n')))
+
+
+class FakeBody(object):
+    """ The chunks of a response body, which tells when it is closed """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+class TestMultipart(unittest.TestCase):
+    """ Test the multipart body written part by part """
+
+    def test_body(self):
+        value = FakeBody(['hel', '', 'lo'])
+        parts = [(['Content-Type: application/cdmi-object'], ['{}'], 2),
+                 (['Content-Type: text/plain'], value, 5)]
+        body = ''.join(iter_multipart('b', parts))
+        self.assertEqual('\r\n--b\r\n'
+                         'Content-Type: application/cdmi-object\r\n\r\n'
+                         '{}'
+                         '\r\n--b\r\n'
+                         'Content-Type: text/plain\r\n\r\n'
+                         'hello'
+                         '\r\n--b--', body)
+        self.assertEqual(get_multipart_length('b', parts), len(body))
+        self.assertTrue(value.closed)
+
+    def test_length(self):
+        boundary = '%.32x' % 7
+        for size in (0, 1, 57, 1000):
+            value = 'x' * size
+            parts = [(['Content-Type: application/cdmi-object'], ['{}'], 2),
+                     (['Content-Type: text/plain',
+                       'Content-Range: bytes 0-%d/%d' % (size - 1, size)],
+                      split_chunks(value, 7), size),
+                     ([], [], 0)]
+            body = ''.join(iter_multipart(boundary, parts))
+            self.assertEqual(get_multipart_length(boundary, parts),
+                             len(body))
+        # Without the length of a part, the length is not known
+        parts = [(['Content-Type: text/plain'], ['hello'], None)]
+        self.assertIsNone(get_multipart_length(boundary, parts))
+
+    def test_value_encodings(self):
+        value = ''.join([chr(code % 256) for code in range(200)])
+        for encoding in ('binary', 'base64'):
+            content = split_chunks(value, 50)
+            length = len(value)
+            if encoding == 'base64':
+                # The base64 value of a part is not escaped
+                content = iter_base64_value(content, '\n')
+                length = get_base64_value_length(length, '\n')
+            parts = [(['Content-Type: application/cdmi-object'], ['{}'], 2),
+                     (['Content-Type: application/octet-stream',
+                       'Content-Transfer-Encoding: ' + encoding],
+                      content, length)]
+            body = ''.join(iter_multipart('b', parts))
+            self.assertEqual(get_multipart_length('b', parts), len(body))
+            part = body.split('\r\n\r\n')[2][:-len('\r\n--b--')]
+            if encoding == 'base64':
+                part = base64.decodestring(part)
+            self.assertEqual(value, part)
+
+    def test_close(self):
+        first = FakeBody(['a'])
+        second = FakeBody(['b'])
+        body = iter_multipart('b', [([], first, 1), ([], second, 1)])
+        body.next()
+        body.close()
+        # The parts not written yet are closed as well
+        self.assertTrue(first.closed)
+        self.assertTrue(second.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()